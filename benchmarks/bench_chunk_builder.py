@@ -0,0 +1,105 @@
+"""Benchmark of the vectorized chunk builder against the former per-row loops of
+`SpecificMediaAnalysis.run` and `TimeBasedOriented.run`. Both paths must produce identical chunks.
+
+Usage:
+    python benchmarks/bench_chunk_builder.py [messages.csv] [--rows 2000000]
+Without a csv, the bundled parsed media files are repeated until `--rows` messages are reached.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from telellmgram.utils.text_utils import count_persian_letters
+from telellmgram.utils.pipeline_utils import valid_text_mask, build_chunks
+from telellmgram.pipelines.social_pipelines import SpecificMediaAnalysis, new_line_token
+
+dir_parsed = os.path.join(dirname(dirname(abspath(__file__))), "telellmgram", "media", "media_parsed")
+PREFIX = "header\nMessages:\n"
+FOOTER = "\n\nfooter\n"
+
+
+def legacy_specific_chunks(table):
+    chunks = []
+    chunk = PREFIX
+    for i in range(len(table)):
+        row = table.iloc[i]
+        if not isinstance(row['cleaned_text'], str):
+            continue
+        if count_persian_letters(row['cleaned_text']) < 20:
+            continue
+        chunk = chunk + f'Message : {row["message_id"]}--{row["cleaned_text"].replace(new_line_token, "")}--{row["reactions"]}' + '\n'
+        if len(chunk) >= 200_000:
+            chunks.append(chunk + FOOTER)
+            chunk = PREFIX
+    if len(chunk) > len(PREFIX):
+        chunks.append(chunk + FOOTER)
+    return chunks
+
+
+def legacy_time_based_chunks(table):
+    prompts = []
+    prompt = PREFIX
+    for i in range(len(table)):
+        text = table.iloc[i]['cleaned_text']
+        if not isinstance(text, str):
+            continue
+        if count_persian_letters(text) < 10:
+            continue
+        prompt += f"{i+1}){text}\n"
+        if len(prompt) > 200_000:
+            prompts.append(prompt + FOOTER)
+            prompt = PREFIX
+    return prompts
+
+
+def vectorized_specific_chunks(table):
+    pipeline = SpecificMediaAnalysis.__new__(SpecificMediaAnalysis)
+    lines = pipeline._format_rows_for_prompt(table[valid_text_mask(table, 20)])
+    return build_chunks(lines, PREFIX, FOOTER, limit=200_000)
+
+
+def vectorized_time_based_chunks(table):
+    positions = np.flatnonzero(valid_text_mask(table, 10))
+    texts = table['cleaned_text'].iloc[positions].reset_index(drop=True)
+    lines = pd.Series(positions + 1).astype(str) + ")" + texts + "\n"
+    return build_chunks(lines, PREFIX, FOOTER, limit=200_000, inclusive=False, keep_last=False)
+
+
+def load_table(csv_file, rows):
+    if csv_file:
+        return pd.read_csv(csv_file)
+    tables = [pd.read_csv(os.path.join(dir_parsed, f)) for f in sorted(os.listdir(dir_parsed)) if f.endswith(".csv")]
+    table = pd.concat(tables, ignore_index=True)
+    return pd.concat([table] * int(np.ceil(rows / len(table))), ignore_index=True).head(rows)
+
+
+def timed(fn, table):
+    start = time.perf_counter()
+    out = fn(table)
+    return out, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_file", nargs="?", default=None)
+    parser.add_argument("--rows", type=int, default=200_000)
+    args = parser.parse_args()
+    table = load_table(args.csv_file, args.rows)
+    print(f"Messages: {len(table)}")
+    for name, legacy, vectorized in [("SpecificMediaAnalysis", legacy_specific_chunks, vectorized_specific_chunks),
+                                     ("TimeBasedOriented", legacy_time_based_chunks, vectorized_time_based_chunks)]:
+        old_chunks, old_seconds = timed(legacy, table)
+        new_chunks, new_seconds = timed(vectorized, table)
+        assert old_chunks == new_chunks, f"{name}: chunks differ"
+        print(f"{name:<22} chunks={len(new_chunks):<5} loop={old_seconds:8.2f}s  vectorized={new_seconds:8.2f}s  "
+              f"speedup={old_seconds / new_seconds:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Application wide data shared by all pages: media list, fonts and a warm cache of media tables."""
+
+import pandas as pd
+from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtGui import QFontDatabase, QFont
+from telellmgram.media.media_db import metadata_file
+from telellmgram.pipelines.social_pipelines import new_media_cache
+
+
+class AppDataModel(QObject):
+    """Created once at startup. Pages read the media list and fonts from it and run their pipelines on `cache`.
+    Selecting a medium or a date range on a page calls `prefetch`, so the table is loaded, filtered (and indexed)
+    in the background while the user types the prompt.
+    """
+    prefetched = pyqtSignal(int)   # media id
+    prefetch_failed = pyqtSignal(int, str)
+
+    def __init__(self):
+        super().__init__()
+        self.load_media_list()
+        self.load_fonts()
+        self.cache = new_media_cache()
+
+    def load_media_list(self):
+        try:
+            metadata = pd.read_csv(metadata_file)
+            self.items = metadata['name'].astype(str).tolist()
+            self.item_ids = metadata['id'].astype(int).tolist()
+            self.media_types = dict(zip(self.item_ids, metadata['type']))
+        except Exception as e:
+            print(f"Error loading CSV: {e}")
+            self.items = ["Sample 1", "Sample 2"]
+            self.item_ids = [1, 2]
+            self.media_types = {}
+
+    def load_fonts(self):
+        id_titr = QFontDatabase.addApplicationFont("resources/titr.ttf")
+        id_vazir = QFontDatabase.addApplicationFont("resources/vazir.ttf")
+        self.titr_family = QFontDatabase.applicationFontFamilies(id_titr)[0]
+        self.vazir_family = QFontDatabase.applicationFontFamilies(id_vazir)[0]
+
+    def font_titr(self, size):
+        return QFont(self.titr_family, size)
+
+    def font_vazir(self, size):
+        return QFont(self.vazir_family, size)
+
+    def prefetch(self, media_idx, start_date=None, end_date=None, with_index=False):
+        future = self.cache.prefetch(media_idx, start_date, end_date, with_index)
+        future.add_done_callback(lambda f: self._on_prefetched(media_idx, f))
+        return future
+
+    def _on_prefetched(self, media_idx, future):
+        # Runs on the prefetch thread; the signals are delivered queued to the pages.
+        if future.exception() is not None:
+            self.prefetch_failed.emit(media_idx, str(future.exception()))
+        else:
+            self.prefetched.emit(media_idx)
+
+
+_app_model = None
+
+
+def get_app_model():
+    """The shared model, created on first use (after the QApplication exists)."""
+    global _app_model
+    if _app_model is None:
+        _app_model = AppDataModel()
+    return _app_model
@@ -9,6 +9,7 @@ from PyQt5.QtCore import Qt
 # Import the pages
 from pages.media_analysis import MediaAnalysisPage
 from pages.topic_analysis import TopicAnalysisPage
+from telellmgram.application.data_model import get_app_model
 
 class TeleLLMgramApp(QWidget):
     def __init__(self):
@@ -17,15 +18,14 @@ class TeleLLMgramApp(QWidget):
         self.resize(1200, 900)
         self.setStyleSheet("background: qlineargradient(x1:0, y1:0, x2:0, y2:1, stop:0 #0a0f1a, stop:1 #060910); color: #f0f0f0;")
         
+        self.model = get_app_model()
         self.load_fonts()
         self.init_ui()
 
     def load_fonts(self):
-        # Load Persian fonts
-        id_titr = QFontDatabase.addApplicationFont("resources/titr.ttf")
-        id_vazir = QFontDatabase.addApplicationFont("resources/vazir.ttf")
-        self.font_titr = QFont(QFontDatabase.applicationFontFamilies(id_titr)[0], 28)
-        self.font_vazir = QFont(QFontDatabase.applicationFontFamilies(id_vazir)[0], 12)
+        # Persian fonts, loaded once by the shared model
+        self.font_titr = self.model.font_titr(28)
+        self.font_vazir = self.model.font_vazir(12)
 
     def init_ui(self):
         main_layout = QVBoxLayout()
@@ -160,12 +160,16 @@ class TeleLLMgramApp(QWidget):
         outer_layout.addWidget(scroll)
 
     def open_media_analysis(self):
-        self.pages['media'] = MediaAnalysisPage()
+        if 'media' not in self.pages:
+            self.pages['media'] = MediaAnalysisPage()
         self.pages['media'].show()
+        self.pages['media'].raise_()
 
     def open_topic_analysis(self):
-        self.pages['topic'] = TopicAnalysisPage()
+        if 'topic' not in self.pages:
+            self.pages['topic'] = TopicAnalysisPage()
         self.pages['topic'].show()
+        self.pages['topic'].raise_()
 
 
 if __name__ == "__main__":
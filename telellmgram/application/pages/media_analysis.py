@@ -1,17 +1,21 @@
 import sys
-import csv
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QLabel, QVBoxLayout, QHBoxLayout,
-    QPushButton, QComboBox, QLineEdit, QTextEdit, QDateEdit
+    QPushButton, QComboBox, QLineEdit, QTextEdit, QDateEdit, QProgressBar
 )
-from PyQt5.QtCore import Qt, QDate
-from PyQt5.QtGui import QFontDatabase, QFont, QColor
+from PyQt5.QtCore import Qt, QDate, QThreadPool, QTimer
+from PyQt5.QtGui import QFontDatabase, QFont, QColor, QTextCursor
 from telellmgram.pipelines.social_pipelines import SpecificMediaAnalysis
+from telellmgram.application.workers import PipelineWorker
+from telellmgram.application.data_model import get_app_model
 
-# Dummy function to simulate analysis
-def analyze_media(prompt: str, selected_id: int, start_date: str, end_date: str) -> str:
-    pipeline = SpecificMediaAnalysis(prompt, selected_id, start_date, end_date)
-    return pipeline.run()
+STAGE_NAMES = {"load": "بارگذاری داده", "select": "انتخاب پیام‌ها", "keywords": "استخراج کلیدواژه", "retrieve": "بازیابی پیام‌ها",
+               "llm_map": "تحلیل بخش‌ها", "reduce": "جمع‌بندی نهایی"}
+PREFETCH_DEBOUNCE_MS = 400
+
+# Analysis pipeline, built and run on a worker thread
+def analyze_media(prompt: str, selected_id: int, start_date: str, end_date: str, cache=None):
+    return lambda: SpecificMediaAnalysis(prompt, selected_id, start_date, end_date, cache=cache)
 
 class MediaAnalysisPage(QWidget):
     def __init__(self):
@@ -24,34 +28,22 @@ class MediaAnalysisPage(QWidget):
                 color: #f0f0f0;
             }
         """)
+        self.model = get_app_model()
         self.load_fonts()
         self.init_ui()
 
     def load_fonts(self):
-        id_titr = QFontDatabase.addApplicationFont("resources/titr.ttf")
-        id_vazir = QFontDatabase.addApplicationFont("resources/vazir.ttf")
-        self.font_titr = QFont(QFontDatabase.applicationFontFamilies(id_titr)[0], 16)
-        self.font_vazir = QFont(QFontDatabase.applicationFontFamilies(id_vazir)[0], 13)
+        self.font_titr = self.model.font_titr(16)
+        self.font_vazir = self.model.font_vazir(13)
 
     def init_ui(self):
         layout = QVBoxLayout()
         layout.setAlignment(Qt.AlignTop)
         layout.setSpacing(15)
 
-        # Load CSV
-        self.items = []
-        self.item_ids = []
-        csv_path = "/home/omid/workspace/Telellmgram/telellmgram/media/metadata.csv"
-        try:
-            with open(csv_path, newline='', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    self.items.append(row['name'])
-                    self.item_ids.append(int(row['id']))
-        except Exception as e:
-            print(f"Error loading CSV: {e}")
-            self.items = ["Sample 1", "Sample 2"]
-            self.item_ids = [1, 2]
+        # Media list (loaded once by the shared model)
+        self.items = self.model.items
+        self.item_ids = self.model.item_ids
 
         # ComboBox
         layout.addWidget(QLabel("انتخاب رسانه:"))
@@ -130,6 +122,49 @@ class MediaAnalysisPage(QWidget):
         self.analyze_btn.clicked.connect(self.on_analyze_clicked)
         layout.addWidget(self.analyze_btn)
 
+        # Cancel button
+        self.cancel_btn = QPushButton("لغو")
+        self.cancel_btn.setFont(self.font_titr)
+        self.cancel_btn.setCursor(Qt.PointingHandCursor)
+        self.cancel_btn.setEnabled(False)
+        self.cancel_btn.setStyleSheet("""
+            QPushButton {
+                background: rgba(229, 62, 62, 0.2);
+                border-radius: 10px;
+                padding: 8px;
+                color: #f0f0f0;
+            }
+            QPushButton:hover {
+                background: rgba(229, 62, 62, 0.35);
+            }
+            QPushButton:disabled {
+                background: rgba(255, 255, 255, 0.03);
+                color: #777777;
+            }
+        """)
+        self.cancel_btn.clicked.connect(self.on_cancel_clicked)
+        layout.addWidget(self.cancel_btn)
+
+        # Progress
+        self.status_label = QLabel("")
+        self.status_label.setFont(self.font_vazir)
+        layout.addWidget(self.status_label)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setTextVisible(False)
+        self.progress_bar.setMaximumHeight(8)
+        self.progress_bar.setStyleSheet("""
+            QProgressBar {
+                background-color: rgba(255, 255, 255, 0.05);
+                border: none;
+                border-radius: 4px;
+            }
+            QProgressBar::chunk {
+                background-color: #4fd1c5;
+                border-radius: 4px;
+            }
+        """)
+        layout.addWidget(self.progress_bar)
+
         # Result display
         layout.addWidget(QLabel("نتیجه تحلیل:"))
         self.result_text = QTextEdit()
@@ -149,13 +184,88 @@ class MediaAnalysisPage(QWidget):
 
         self.setLayout(layout)
 
-    def on_analyze_clicked(self):
-        prompt = self.prompt_edit.text()
-        selected_index = self.combo.currentIndex()
-        selected_id = self.item_ids[selected_index]
+        # Warm the selected medium while the prompt is typed. Only the unfiltered table (and index) is prefetched, the
+        # date filter is applied when the run starts; date edits are debounced so stepping through dates loads once.
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.setInterval(PREFETCH_DEBOUNCE_MS)
+        self.prefetch_timer.timeout.connect(self.prefetch_selected)
+        self.combo.currentIndexChanged.connect(self.prefetch_selected)
+        self.start_date_edit.dateChanged.connect(lambda date: self.prefetch_timer.start())
+        self.end_date_edit.dateChanged.connect(lambda date: self.prefetch_timer.start())
+        self.prefetch_selected()
+
+    def selected_request(self):
+        selected_id = self.item_ids[self.combo.currentIndex()]
         start_date = self.start_date_edit.date().toString("dd/MM/yy")
         end_date = self.end_date_edit.date().toString("dd/MM/yy")
+        return selected_id, start_date, end_date
+
+    def prefetch_selected(self, *args):
+        if self.item_ids:
+            self.model.prefetch(self.item_ids[self.combo.currentIndex()], with_index=False)
+
+    def on_analyze_clicked(self):
+        prompt = self.prompt_edit.text()
+        selected_id, start_date, end_date = self.selected_request()
+
+        # Run the analysis on the thread pool; results arrive through the worker signals
+        self.result_text.clear()
+        self.streaming = False
+        self.worker = PipelineWorker(analyze_media(prompt, selected_id, start_date, end_date, self.model.cache))
+        self.worker.signals.progress.connect(self.on_progress)
+        self.worker.signals.partial.connect(self.on_partial)
+        self.worker.signals.token.connect(self.on_token)
+        self.worker.signals.finished.connect(self.on_finished)
+        self.worker.signals.failed.connect(self.on_failed)
+        self.worker.signals.cancelled.connect(self.on_cancelled)
+        self.set_running(True)
+        QThreadPool.globalInstance().start(self.worker)
 
-        # Call analysis function
-        result = analyze_media(prompt, selected_id, start_date, end_date)
+    def on_cancel_clicked(self):
+        if getattr(self, "worker", None) is not None:
+            self.worker.cancel()
+            self.status_label.setText("در حال لغو ...")
+
+    def set_running(self, running):
+        self.analyze_btn.setEnabled(not running)
+        self.cancel_btn.setEnabled(running)
+        if running:
+            self.progress_bar.setRange(0, 0)  # busy until the first progress report
+
+    def on_progress(self, stage, done, total):
+        self.status_label.setText(f"{STAGE_NAMES.get(stage, stage)} ({done}/{total})")
+        self.progress_bar.setRange(0, max(total, 1))
+        self.progress_bar.setValue(done)
+
+    def on_partial(self, index, text):
+        self.result_text.append(f"[{index + 1}] {text}\n")
+
+    def on_token(self, token):
+        # The streamed final answer replaces the partial results
+        if not self.streaming:
+            self.streaming = True
+            self.result_text.clear()
+        cursor = self.result_text.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(token)
+        self.result_text.setTextCursor(cursor)
+
+    def on_finished(self, result):
         self.result_text.setText(result)
+        self.status_label.setText("پایان تحلیل")
+        self.progress_bar.setRange(0, 1)
+        self.progress_bar.setValue(1)
+        self.set_running(False)
+
+    def on_failed(self, error):
+        self.status_label.setText(f"خطا: {error}")
+        self.progress_bar.setRange(0, 1)
+        self.progress_bar.setValue(0)
+        self.set_running(False)
+
+    def on_cancelled(self):
+        self.status_label.setText("تحلیل لغو شد")
+        self.progress_bar.setRange(0, 1)
+        self.progress_bar.setValue(0)
+        self.set_running(False)
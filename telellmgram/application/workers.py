@@ -0,0 +1,48 @@
+"""Running pipelines off the Qt main thread, with progress, partial results, streaming and cancellation."""
+
+import threading
+import traceback
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+from telellmgram.utils.pipeline_utils import RunControl
+from telellmgram.utils.llm_utils import LLMCallCancelled
+
+
+class WorkerSignals(QObject):
+    progress = pyqtSignal(str, int, int)   # stage, done, total
+    partial = pyqtSignal(int, str)         # index of the map call, its response
+    token = pyqtSignal(str)                # piece of the streamed final response
+    finished = pyqtSignal(str)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+
+class PipelineWorker(QRunnable):
+    """Builds a pipeline with `pipeline_factory()` and runs it on a pool thread.
+    Building is done on the worker too, since loading and filtering the tables is also slow.
+    Signals are queued to the receiver's thread, so the slots of a page run on the main thread.
+    Connect to `worker.signals` before handing the worker to `QThreadPool.globalInstance().start`.
+    """
+    def __init__(self, pipeline_factory):
+        super().__init__()
+        self.pipeline_factory = pipeline_factory
+        self.signals = WorkerSignals()
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        control = RunControl(on_progress=self.signals.progress.emit, on_partial=self.signals.partial.emit,
+                             on_token=self.signals.token.emit, cancel_event=self.cancel_event)
+        try:
+            control.progress("load", 0, 1)
+            pipeline = self.pipeline_factory()
+            result = pipeline.run(control)
+        except LLMCallCancelled:
+            self.signals.cancelled.emit()
+        except Exception:
+            traceback.print_exc()
+            self.signals.failed.emit(traceback.format_exc(limit=1))
+        else:
+            self.signals.finished.emit(result)
+
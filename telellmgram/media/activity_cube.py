@@ -0,0 +1,185 @@
+"""Pre-aggregated activity cube of all media: message counts by media x day x hour, reaction totals and sender totals.
+It is built at ingest, updated incrementally when a media is (re)parsed, and answers the statistics queries
+without loading any messages table.
+"""
+
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from os.path import dirname
+
+dir_root = dirname(dirname(__file__))
+activity_cube_file = os.path.join(dir_root, "media", "activity_cube.npz")
+SECONDS_PER_DAY = 86_400
+
+
+class ActivityCube:
+    """Arrays, all indexed by the position of a media in `media_ids`:
+        - counts : (n_media, n_days, 24) int32, messages per day and hour
+        - reactions : (n_media, n_days) int64, reactions received by the messages of each day
+        - sender_media / sender_ids / sender_counts : messages per (media, sender), groups only
+        - versions : (n_media,) int64, fingerprint of the aggregates of a media, recomputed on every update; used as
+          data version by caches, so a media re-ingested with other messages gets a new one even in a fresh cube
+    Days are counted from `first_day` (days since 1970-01-01).
+    """
+    def __init__(self, media_ids=None, first_day=0, counts=None, reactions=None,
+                 sender_media=None, sender_ids=None, sender_counts=None, versions=None):
+        self.media_ids = np.asarray(media_ids if media_ids is not None else [], dtype=np.int64)
+        self.first_day = int(first_day)
+        self.counts = counts if counts is not None else np.zeros((0, 0, 24), dtype=np.int32)
+        self.reactions = reactions if reactions is not None else np.zeros((0, 0), dtype=np.int64)
+        self.sender_media = np.asarray(sender_media if sender_media is not None else [], dtype=np.int64)
+        self.sender_ids = np.asarray(sender_ids if sender_ids is not None else [], dtype=str)
+        self.sender_counts = np.asarray(sender_counts if sender_counts is not None else [], dtype=np.int64)
+        self.versions = np.asarray(versions if versions is not None else np.zeros(len(self.media_ids)), dtype=np.int64)
+
+    @classmethod
+    def load(cls, path=activity_cube_file):
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path) as data:
+            return cls(**{key: data[key] for key in data.files})
+
+    def save(self, path=activity_cube_file):
+        np.savez_compressed(path, media_ids=self.media_ids, first_day=self.first_day, counts=self.counts,
+                            reactions=self.reactions, sender_media=self.sender_media, sender_ids=self.sender_ids,
+                            sender_counts=self.sender_counts, versions=self.versions)
+
+    @property
+    def n_days(self):
+        return self.counts.shape[1]
+
+    def __contains__(self, media_idx):
+        return int(media_idx) in set(self.media_ids.tolist())
+
+    def _media_position(self, media_idx):
+        positions = np.flatnonzero(self.media_ids == media_idx)
+        if len(positions):
+            return int(positions[0])
+        self.media_ids = np.append(self.media_ids, media_idx)
+        self.counts = np.concatenate([self.counts, np.zeros((1, self.n_days, 24), dtype=np.int32)])
+        self.reactions = np.concatenate([self.reactions, np.zeros((1, self.n_days), dtype=np.int64)])
+        self.versions = np.append(self.versions, 0)
+        return len(self.media_ids) - 1
+
+    def _cover_days(self, first_day, last_day):
+        if self.n_days == 0:
+            self.first_day = first_day
+        pad_before = max(0, self.first_day - first_day)
+        pad_after = max(0, last_day - (self.first_day + self.n_days - 1))
+        if pad_before or pad_after:
+            self.counts = np.pad(self.counts, ((0, 0), (pad_before, pad_after), (0, 0)))
+            self.reactions = np.pad(self.reactions, ((0, 0), (pad_before, pad_after)))
+            self.first_day -= pad_before
+
+    def add_messages(self, media_idx, table, replace=True):
+        """Adds a parsed messages table (with the ingest feature columns) to the cube.
+        With `replace=True` the previous counts of this media are dropped first, so re-parsing a media is idempotent;
+        with `replace=False` the table is treated as newly ingested messages and accumulated.
+        """
+        valid = table['timestamp'].to_numpy() >= 0
+        days = table['timestamp'].to_numpy()[valid] // SECONDS_PER_DAY
+        hours = table['hour'].to_numpy()[valid].astype(np.int64)
+        position = self._media_position(media_idx)
+        if replace:
+            self.counts[position] = 0
+            self.reactions[position] = 0
+            keep = self.sender_media != media_idx
+            self.sender_media, self.sender_ids, self.sender_counts = self.sender_media[keep], self.sender_ids[keep], self.sender_counts[keep]
+        if not len(days):
+            self.versions[position] = self._content_version(position)
+            return self
+        self._cover_days(int(days.min()), int(days.max()))
+        day_positions = days - self.first_day
+        np.add.at(self.counts[position], (day_positions, hours), 1)
+        np.add.at(self.reactions[position], day_positions, table['engagement'].to_numpy()[valid].astype(np.int64))
+
+        if 'sender_id' in table.columns:
+            senders = table['sender_id'].astype(object).fillna("").astype(str).value_counts()
+            merged = pd.concat([pd.Series(self.sender_counts[self.sender_media == media_idx],
+                                          index=self.sender_ids[self.sender_media == media_idx]), senders])
+            merged = merged.groupby(level=0).sum()
+            keep = self.sender_media != media_idx
+            self.sender_media = np.concatenate([self.sender_media[keep], np.full(len(merged), media_idx, dtype=np.int64)])
+            self.sender_ids = np.concatenate([self.sender_ids[keep], merged.index.to_numpy(dtype=str)])
+            self.sender_counts = np.concatenate([self.sender_counts[keep], merged.to_numpy(dtype=np.int64)])
+        self.versions[position] = self._content_version(position)
+        return self
+
+    def _content_version(self, position):
+        """Hash of the counts, reactions and senders of a media, with absolute days (independent of `first_day`)."""
+        digest = hashlib.sha256()
+        days, hours = np.nonzero(self.counts[position])
+        reaction_days = np.flatnonzero(self.reactions[position])
+        senders = np.flatnonzero(self.sender_media == self.media_ids[position])
+        senders = senders[np.argsort(self.sender_ids[senders], kind="stable")]
+        for values in (days + self.first_day, hours, self.counts[position][days, hours], reaction_days + self.first_day,
+                       self.reactions[position][reaction_days], self.sender_counts[senders]):
+            digest.update(np.asarray(values, dtype=np.int64).tobytes())
+        digest.update("\0".join(self.sender_ids[senders].tolist()).encode("utf-8"))
+        return int.from_bytes(digest.digest()[:8], "little", signed=True)
+
+    def _select(self, media_ids=None, start_date=None, end_date=None):
+        """Media rows and day slice of a query. Dates are pandas Timestamps (or None), end date inclusive."""
+        if media_ids is None:
+            rows = np.arange(len(self.media_ids))
+        else:
+            rows = np.flatnonzero(np.isin(self.media_ids, np.atleast_1d(media_ids)))
+        start = 0 if start_date is None else (start_date - pd.Timestamp("1970-01-01")).days - self.first_day
+        stop = self.n_days if end_date is None else (end_date - pd.Timestamp("1970-01-01")).days - self.first_day + 1
+        start, stop = int(np.clip(start, 0, self.n_days)), int(np.clip(stop, 0, self.n_days))
+        return rows, slice(start, max(start, stop))
+
+    def data_version(self, media_ids=None):
+        """Changes whenever any of the selected media is updated."""
+        rows, _ = self._select(media_ids)
+        return "-".join(f"{media}:{version}" for media, version in zip(self.media_ids[rows], self.versions[rows]))
+
+    def hour_histogram(self, media_ids=None, start_date=None, end_date=None):
+        rows, days = self._select(media_ids, start_date, end_date)
+        return self.counts[rows, days].sum(axis=(0, 1))
+
+    def daily_counts(self, media_ids=None, start_date=None, end_date=None):
+        """Messages per day as a Series indexed by date."""
+        rows, days = self._select(media_ids, start_date, end_date)
+        index = pd.to_datetime(np.arange(days.start, days.stop) + self.first_day, unit="D")
+        return pd.Series(self.counts[rows, days].sum(axis=(0, 2)), index=index)
+
+    def reaction_total(self, media_ids=None, start_date=None, end_date=None):
+        rows, days = self._select(media_ids, start_date, end_date)
+        return int(self.reactions[rows, days].sum())
+
+    def top_senders(self, media_ids=None, k=10):
+        """Most active senders as a Series indexed by (media id, sender id). Date ranges are not tracked for senders."""
+        keep = np.ones(len(self.sender_media), dtype=bool) if media_ids is None else np.isin(self.sender_media, np.atleast_1d(media_ids))
+        senders = pd.Series(self.sender_counts[keep], index=pd.MultiIndex.from_arrays([self.sender_media[keep], self.sender_ids[keep]]))
+        return senders.sort_values(ascending=False).head(k)
+
+    def corpus_summary(self, start_date=None, end_date=None):
+        """Per media totals over all sources: messages, reactions, active days, first and last active day."""
+        rows, days = self._select(None, start_date, end_date)
+        per_day = self.counts[rows, days].sum(axis=2)
+        active = per_day > 0
+        dates = pd.to_datetime(np.arange(days.start, days.stop) + self.first_day, unit="D")
+        first = [dates[a.argmax()] if a.any() else pd.NaT for a in active]
+        last = [dates[len(a) - 1 - a[::-1].argmax()] if a.any() else pd.NaT for a in active]
+        return pd.DataFrame({"messages": per_day.sum(axis=1), "reactions": self.reactions[rows, days].sum(axis=1),
+                             "active_days": active.sum(axis=1), "first_day": first, "last_day": last},
+                            index=pd.Index(self.media_ids[rows], name="id"))
+
+
+def load_activity_cube():
+    return ActivityCube.load()
+
+
+def build_activity_cube(metadata_table, read_table):
+    """Builds the cube of every media in `metadata_table` from scratch. `read_table(path)` returns a table with feature columns."""
+    cube = ActivityCube()
+    seen = set()
+    for media_idx, messages_file in zip(metadata_table['id'], metadata_table['messages']):
+        # The same media can be exported more than once (several folders); those exports add up.
+        cube.add_messages(int(media_idx), read_table(messages_file), replace=int(media_idx) not in seen)
+        seen.add(int(media_idx))
+    cube.save()
+    return cube
@@ -0,0 +1,176 @@
+"""Streaming reader of Telegram Desktop exports: `result.json` read straight out of a folder, a zip, a tar (plain,
+gzip, bzip2, xz) or a zstd archive and decoded incrementally, one message at a time, so no extracted copy is written
+and the whole export is never held in memory.
+"""
+
+import io
+import os
+import json
+import tarfile
+import zipfile
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for .zst exports
+    zstandard = None
+
+EXPORT_FILE = "result.json"
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".tar.zst", ".tzst", ".json.zst")
+READ_SIZE = 1 << 20
+
+
+def is_export(path):
+    """Folders holding a result.json, json files and supported archives."""
+    name = os.path.basename(path).lower()
+    if os.path.isdir(path):
+        return os.path.exists(os.path.join(path, EXPORT_FILE))
+    return name.endswith(".json") or name.endswith(ARCHIVE_SUFFIXES)
+
+
+def find_raw_exports(dir_raw_data):
+    """Exports in `dir_raw_data`, by name."""
+    if not os.path.isdir(dir_raw_data):
+        return []
+    return [os.path.join(dir_raw_data, name) for name in sorted(os.listdir(dir_raw_data)) if is_export(os.path.join(dir_raw_data, name))]
+
+
+def _zstd_reader(f):
+    if zstandard is None:
+        raise ImportError("Reading .zst exports needs the `zstandard` package (pip install zstandard).")
+    return zstandard.ZstdDecompressor().stream_reader(f, read_size=READ_SIZE)
+
+
+def _tar_member(tar):
+    for member in tar:
+        if member.isfile() and os.path.basename(member.name) == EXPORT_FILE:
+            return tar.extractfile(member)
+    raise FileNotFoundError(f"No {EXPORT_FILE} in the archive")
+
+
+class CountingReader(io.RawIOBase):
+    """Binary stream wrapper counting the bytes read through it."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        self.bytes_read += len(data)
+        return len(data)
+
+
+@contextmanager
+def open_export(path):
+    """Binary stream of the (decompressed) result.json of an export, wrapped in a CountingReader."""
+    with _open_raw(path) as stream:
+        yield CountingReader(stream)
+
+
+@contextmanager
+def _open_raw(path):
+    name = os.path.basename(path).lower()
+    if os.path.isdir(path):
+        path, name = os.path.join(path, EXPORT_FILE), EXPORT_FILE
+    if name.endswith(".json"):
+        with open(path, "rb") as f:
+            yield f
+    elif name.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            members = [m for m in archive.namelist() if os.path.basename(m) == EXPORT_FILE]
+            if not members:
+                raise FileNotFoundError(f"No {EXPORT_FILE} in {path}")
+            with archive.open(min(members, key=len)) as f:
+                yield f
+    elif name.endswith((".tar.zst", ".tzst")):
+        with open(path, "rb") as raw, _zstd_reader(raw) as f, tarfile.open(fileobj=f, mode="r|") as tar:
+            yield _tar_member(tar)
+    elif name.endswith(".json.zst"):
+        with open(path, "rb") as raw, _zstd_reader(raw) as f:
+            yield f
+    elif name.endswith((".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")):
+        with tarfile.open(path, mode="r|*") as tar:
+            yield _tar_member(tar)
+    else:
+        raise ValueError(f"Unsupported export: {path}")
+
+
+class JsonStream:
+    """Incremental decoding of a text stream with `json.JSONDecoder.raw_decode` over a sliding buffer."""
+    def __init__(self, stream):
+        self.text = io.TextIOWrapper(io.BufferedReader(stream, READ_SIZE), encoding="utf-8")
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.text.read(READ_SIZE)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+        return bool(chunk)
+
+    def peek(self):
+        """Next non-whitespace character ('' at the end)."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} in the export, found {self.peek()!r}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue  # a number may go on in the next chunk
+            self.pos = end
+            return value
+
+
+def iter_export(stream):
+    """(header, messages) of a result.json stream. `header` holds the top-level fields written before "messages"
+    (Telegram writes name, type and id first); `messages` yields the messages one by one and, once exhausted, adds
+    the fields written after them to `header`.
+    """
+    json_stream = JsonStream(stream)
+    json_stream.expect("{")
+    header = {}
+    while json_stream.peek() != "}":
+        key = json_stream.value()
+        json_stream.expect(":")
+        if key == "messages":
+            return header, _iter_messages(json_stream, header)
+        header[key] = json_stream.value()
+        if json_stream.peek() == ",":
+            json_stream.expect(",")
+    return header, iter(())
+
+
+def _iter_messages(json_stream, header):
+    json_stream.expect("[")
+    while json_stream.peek() != "]":
+        yield json_stream.value()
+        if json_stream.peek() == ",":
+            json_stream.expect(",")
+    json_stream.expect("]")
+    while json_stream.peek() == ",":
+        json_stream.expect(",")
+        key = json_stream.value()
+        json_stream.expect(":")
+        header[key] = json_stream.value()
@@ -0,0 +1,181 @@
+"""Read-only message arena: the messages of all media in flat files that worker processes memory-map.
+`cleaned_text` is stored as concatenated UTF-8 bytes (each text followed by a NUL byte) with an int64 offset array,
+next to fixed-width numeric side columns. Every process maps the same files, so a pool of N workers shares one copy
+of the corpus in the page cache instead of each parsing the CSVs or receiving pickled DataFrames.
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from os.path import dirname
+
+dir_root = dirname(dirname(__file__))
+message_arena_dir = os.path.join(dir_root, "media", "message_arena")
+TEXT_FILE = "text.bin"
+# Side columns and their dtypes. `row` is the offset of the message in the parsed table of its media, `sender` the
+# numeric part of the sender id (-1 for channels).
+ARENA_COLUMNS = {
+    'media': 'int64', 'row': 'int64', 'message_id': 'int64', 'timestamp': 'int64', 'sender': 'int64',
+    'persian_letters': 'int16', 'token_count': 'int16', 'est_tokens': 'int16', 'persian_ratio': 'float32',
+    'has_link': 'bool', 'has_hashtag': 'bool', 'engagement': 'int32', 'hour': 'int8', 'thread_id': 'int32',
+    'reply_depth': 'int16', 'spam_score': 'float32',
+}
+
+
+def file_version(path):
+    """Size and modification time of a file, changed by every rewrite."""
+    stat = os.stat(path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def sender_numbers(sender_ids):
+    """Numeric part of Telegram sender ids ('user123' -> 123), -1 when there is none."""
+    digits = pd.Series(sender_ids, dtype=object).astype(str).str.extract(r"(\d+)", expand=False)
+    return pd.to_numeric(digits, errors="coerce").fillna(-1).to_numpy(dtype=np.int64)
+
+
+class MessageArenaWriter:
+    """Writes an arena media by media into `path + '.tmp'` and moves it over `path` on `close()`, so readers never
+    see a half written arena (processes that mapped the previous one keep reading its unlinked files).
+    """
+    def __init__(self, path=message_arena_dir):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self._text = open(os.path.join(self.tmp_path, TEXT_FILE), "wb")
+        self._lengths = []
+        self._columns = {name: [] for name in ARENA_COLUMNS}
+        self._media = []
+        self._n = 0
+
+    def add(self, media_idx, table, version=""):
+        """Appends every message of a parsed table with feature columns; `version` is the `file_version` of its csv."""
+        texts = table['cleaned_text'].to_numpy(dtype=object)
+        encoded = [(text if isinstance(text, str) else "").encode("utf-8") for text in texts]
+        self._text.write(b"\0".join(encoded) + (b"\0" if encoded else b""))
+        self._lengths.append(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)) + 1)
+        n = len(table)
+        side = {'media': np.full(n, int(media_idx)), 'row': table.index.to_numpy(),
+                'sender': sender_numbers(table['sender_id']) if 'sender_id' in table.columns else np.full(n, -1)}
+        for name, dtype in ARENA_COLUMNS.items():
+            values = side[name] if name in side else table[name].to_numpy()
+            self._columns[name].append(np.asarray(values).astype(dtype))
+        self._media.append({"id": int(media_idx), "start": self._n, "end": self._n + n, "version": version})
+        self._n += n
+        return self
+
+    def close(self):
+        self._text.close()
+        lengths = np.concatenate(self._lengths) if self._lengths else np.zeros(0, dtype=np.int64)
+        np.save(os.path.join(self.tmp_path, "offsets.npy"), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+        for name, dtype in ARENA_COLUMNS.items():
+            values = np.concatenate(self._columns[name]) if self._columns[name] else np.zeros(0, dtype=dtype)
+            np.save(os.path.join(self.tmp_path, f"{name}.npy"), values)
+        with open(os.path.join(self.tmp_path, "meta.json"), "w") as f:
+            json.dump({"n_messages": self._n, "media": self._media, "columns": ARENA_COLUMNS}, f)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+
+
+class MessageArena:
+    """Memory-mapped view of an arena. Columns are read-only numpy memmaps; slicing them or the text bytes copies
+    nothing. The messages of a media are contiguous, in the row order of its parsed table.
+    """
+    def __init__(self, path=message_arena_dir):
+        self.path = path
+        self.media = {}
+        self.columns = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.text = np.zeros(0, dtype=np.uint8)
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            return
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.media = {entry["id"]: entry for entry in meta["media"]}
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in meta["columns"]}
+        if self.offsets[-1] > 0:
+            self.text = np.memmap(os.path.join(path, TEXT_FILE), dtype=np.uint8, mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __contains__(self, media_idx):
+        return int(media_idx) in self.media
+
+    def covers(self, media_idx, columns, version):
+        """Whether the arena holds `columns` of an up to date copy (same csv `version`) of a media."""
+        entry = self.media.get(int(media_idx))
+        return entry is not None and entry["version"] == version and all(c == 'cleaned_text' or c in self.columns for c in columns)
+
+    def media_slice(self, media_idx):
+        entry = self.media[int(media_idx)]
+        return slice(entry["start"], entry["end"])
+
+    def column(self, name, media_idx=None):
+        """A side column of all messages, or of one media."""
+        return self.columns[name] if media_idx is None else self.columns[name][self.media_slice(media_idx)]
+
+    def text_bytes(self, i):
+        """UTF-8 bytes of message `i` as a zero-copy memoryview."""
+        return memoryview(self.text[self.offsets[i]:self.offsets[i + 1] - 1])
+
+    def texts(self, positions):
+        """Decoded texts of arena positions (None for messages without text)."""
+        return [bytes(self.text_bytes(i)).decode("utf-8") or None for i in np.asarray(positions, dtype=np.int64)]
+
+    def media_texts(self, media_idx):
+        """Decoded texts of a media in one pass over its contiguous bytes (None for messages without text). Texts are
+        split on the NUL separators unless one of them contains a NUL itself; then they are sliced by their offsets.
+        """
+        span = self.media_slice(media_idx)
+        if span.stop == span.start:
+            return []
+        raw = bytes(self.text[self.offsets[span.start]:self.offsets[span.stop] - 1])
+        if raw.count(b"\0") == span.stop - span.start - 1:
+            return [text or None for text in raw.decode("utf-8").split("\0")]
+        bounds = np.asarray(self.offsets[span.start:span.stop + 1]) - self.offsets[span.start]
+        return [raw[start:end - 1].decode("utf-8") or None for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def table(self, media_idx, columns, rows=None):
+        """Messages table of a media with `columns` (`cleaned_text` and side columns), indexed by row offset like the
+        tables of `read_messages_table`. The frame owns copies of its columns (pandas copies the memory-mapped slices
+        and the texts are decoded), so callers select on the mapped columns first and pass `rows` (a boolean mask or
+        positions within the media) to copy only the messages they need.
+        """
+        span = self.media_slice(media_idx)
+        select = span if rows is None else np.arange(span.start, span.stop)[np.asarray(rows)]
+        data = {}
+        for name in columns:
+            if name == 'cleaned_text':
+                texts = self.media_texts(media_idx) if rows is None else self.texts(select)
+                data[name] = pd.array(texts, dtype="str")
+            else:
+                data[name] = self.columns[name][select]
+        return pd.DataFrame(data, index=pd.Index(self.columns['row'][select], dtype=np.int64), columns=list(columns))
+
+
+ARENA = None
+
+
+def get_message_arena():
+    """The arena mapped by this process, opened on first use (once per worker process)."""
+    global ARENA
+    if ARENA is None:
+        ARENA = MessageArena()
+    return ARENA
+
+
+def build_message_arena(metadata_table, read_table, path=message_arena_dir):
+    """Builds the arena of every media in `metadata_table`. `read_table(path)` returns a table with feature columns."""
+    writer = MessageArenaWriter(path)
+    seen = set()
+    for media_idx, messages_file in zip(metadata_table['id'], metadata_table['messages']):
+        if int(media_idx) not in seen:
+            writer.add(int(media_idx), read_table(messages_file), file_version(messages_file))
+            seen.add(int(media_idx))
+    writer.close()
+    return MessageArena(path)
@@ -2,13 +2,25 @@
 
 import os, re
 import json
+import time
+import argparse
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from typing import Union
 from os.path import dirname
 from datetime import datetime
 from telellmgram.utils.text_utils import preprocess_persian_sentence
-from telellmgram.utils.text_utils import remove_extra_newlines, clean_text
+from telellmgram.utils.text_utils import remove_extra_newlines, clean_text, add_message_features
+from telellmgram.media.activity_cube import ActivityCube
+from telellmgram.media.trend_monitor import TrendMonitor
+from telellmgram.media.posting_index import PostingIndex
+from telellmgram.media.reaction_matrix import ReactionMatrix
+from telellmgram.media.export_reader import find_raw_exports, open_export, iter_export
+from telellmgram.media.message_arena import MessageArenaWriter, file_version
+from telellmgram.utils.spam_utils import build_spam_model, spam_scores
+from telellmgram.utils.trace_utils import TRACER
+from telellmgram.utils.queue_utils import WorkQueue
 
 
 # ====== Initialization =========== #
@@ -16,10 +28,6 @@ dir_root = dirname(dirname(__file__))
 dir_raw_data = os.path.join(dir_root, 'media', 'media_raw')
 dir_parsed_data = os.path.join(dir_root, 'media', 'media_parsed')
 
-folders_raw = os.listdir(dir_raw_data)
-folders_raw = [os.path.join(dir_raw_data, f) for f in folders_raw if not '.' in f]  # skip names with extension (files)
-print(f"Found {len(folders_raw)} in raw data folder.")
-
 
 # ======= Define required functions ======== #
 def detect_chat_type(json_data: Union[str, dict]):
@@ -171,17 +179,26 @@ def telegram_json_group_to_dataframe(data):
     return pd.DataFrame(messages)
 
 
-def parse_all_media():
-    meta_data = []  # Initialize an empty metadata file 
+def _export_size(path):
+    if os.path.isdir(path):
+        path = os.path.join(path, 'result.json')
+    return os.path.getsize(path)
+
 
-    for i, media_data in enumerate(folders_raw):
-        print(f"{i+1}/{len(folders_raw)}) Parsing: {media_data}")
+def _export_version(path):
+    return file_version(os.path.join(path, 'result.json') if os.path.isdir(path) else path)
 
-        if not media_data.endswith('.json'):
-            media_data = os.path.join(media_data, 'result.json')
-        with open(media_data, 'r', encoding='utf-8') as f:
-            data = json.load(f)
 
+def parse_export(export):
+    """Parses one export (folder, result.json or archive, see export_reader) into (header, chat type, messages table).
+    The messages are decoded from the stream one by one, without extracting the archive.
+    Returns the bytes of result.json read as well.
+    """
+    with open_export(export) as stream:
+        header, messages = iter_export(stream)
+        if 'type' not in header:
+            raise ValueError(f'{export}: the chat type must come before the messages in result.json')
+        data = {**header, 'messages': messages}
         chat_type = detect_chat_type(data)
         if chat_type == 'channel':
             media = telegram_json_channel_to_dataframe(data)
@@ -189,19 +206,149 @@ def parse_all_media():
             media = telegram_json_group_to_dataframe(data)
         else:
             raise ValueError('Unknown chat type. Chat type must be either a channel or a group')
+        for _ in messages:
+            pass  # read the fields written after the messages into the header
+        return header, chat_type, media, stream.bytes_read
+
 
-        output_filename = os.path.join(dir_parsed_data, f'{i+1}{chat_type[0]}.csv')
+def parse_export_to_csv(export, index, dir_parsed=None):
+    """Parses one export, adds the message features and writes the table to `<index><c|g>.csv` in `dir_parsed`.
+    Returns (metadata entry with the ingest report of the export and the version of the written table, messages table).
+    """
+    started = time.time()
+    with TRACER.span("ingest", export=os.path.basename(export)) as span:
+        data, chat_type, media, json_bytes = parse_export(export)
+        media = add_message_features(media)
+
+        output_filename = os.path.join(dir_parsed or dir_parsed_data, f'{index}{chat_type[0]}.csv')
         media.to_csv(output_filename, index=False)
+        span.add(rows_out=len(media), bytes_read=json_bytes)
+    seconds = time.time() - started
+    report = {"export": os.path.basename(export), "archive_mb": _export_size(export) / 2**20, "json_mb": json_bytes / 2**20,
+              "messages": len(media), "seconds": seconds, "json_mb_per_s": json_bytes / 2**20 / max(seconds, 1e-9),
+              "messages_per_s": len(media) / max(seconds, 1e-9), "written_mb": os.path.getsize(output_filename) / 2**20}
+    return {"id": data['id'], "name": data['name'], "type": chat_type, "messages": output_filename,
+            "file_version": file_version(output_filename), "report": report}, media
+
+
+def parse_export_task(export, index, dir_parsed):
+    """Work queue task (queue_utils): parses one export into the shared parsed folder and returns its metadata entry."""
+    entry, _ = parse_export_to_csv(export, index, dir_parsed)
+    return entry
+
+
+def _is_current(entry):
+    """Whether the table a parse task wrote is still on disk as the task left it."""
+    try:
+        return file_version(entry["messages"]) == entry.get("file_version")
+    except FileNotFoundError:
+        return False
+
+
+def _parse_on_queue(exports, queue):
+    """Metadata entries of every export, in order, parsed by the workers of a work queue. Results of earlier ingests
+    are reused only while their table is unchanged; the others are dropped and the export is parsed again.
+    """
+    tasks = [({"export": os.path.abspath(export), "index": i + 1, "dir_parsed": dir_parsed_data}, _export_version(export))
+             for i, export in enumerate(exports)]
+    ids = [queue.submit("parse_export", args, version=version) for args, version in tasks]
+    print(f"[Runtime Log] -- Queued {len(ids)} exports on {queue.root}; waiting for the workers.")
+    entries = queue.wait(ids, poll_seconds=2.0)
+    stale = [i for i, tid in enumerate(ids) if not _is_current(entries[tid])]
+    while stale:
+        print(f"[Runtime Log] -- {len(stale)} parse results are out of date with their tables; parsing them again.")
+        for i in stale:
+            queue.discard(ids[i])
+            queue.submit("parse_export", *tasks[i])
+        entries.update(queue.wait([ids[i] for i in stale], poll_seconds=2.0))
+        stale = [i for i in stale if not _is_current(entries[ids[i]])]
+    return [entries[tid] for tid in ids]
+
+
+def _rescore_spam(messages_file):
+    """Reads back a parsed table and, when the current spam model scores it differently than at parse time, rewrites
+    its `spam_score` column (the other columns are copied as text, unchanged).
+    """
+    media = pd.read_csv(messages_file)
+    scores = spam_scores(media)
+    if not np.array_equal(scores, media['spam_score'].to_numpy(dtype=np.float32)):
+        raw = pd.read_csv(messages_file, dtype=str, keep_default_na=False)
+        raw['spam_score'] = media['spam_score'] = scores
+        raw.to_csv(messages_file, index=False)
+    return media
+
+
+def parse_all_media(dir_raw=dir_raw_data, queue=None, train_spam=True):
+    """Parses every export of `dir_raw`, writes the messages tables and metadata.csv and rebuilds the corpus structures.
+    Returns the ingest report: one row per export with its size on disk, the bytes of result.json decoded from it,
+    the time taken, the throughput and the bytes written.
+    With a `queue` (queue_utils.WorkQueue) the exports are parsed by its workers, on any node sharing the media folder;
+    the tables they write are then merged in the order of the exports, so the result is the same as parsing here.
+    With `train_spam` the spam model is trained on the parsed tables (`build_spam_model`) and the tables are re-scored
+    with it before the corpus structures and the message arena are built.
+    """
+    exports = find_raw_exports(dir_raw)
+    print(f"Found {len(exports)} exports in raw data folder.")
+    meta_data = []  # Initialize an empty metadata file 
+    activity_cube = ActivityCube()
+    trend_monitor = TrendMonitor()
+    posting_index = PostingIndex()
+    reaction_matrix = ReactionMatrix()
+    message_arena = MessageArenaWriter()
+    report = []
+
+    if queue is None:
+        entries = [_parse_here(i, export, len(exports))[0] for i, export in enumerate(exports)]
+    else:
+        entries = _parse_on_queue(exports, queue)
+    if train_spam and entries:
+        with TRACER.span("spam_training", tables=len(entries)):
+            build_spam_model(pd.DataFrame(entries), pd.read_csv)
+    for entry in entries:
+        media = _rescore_spam(entry["messages"])
+        report.append(entry["report"])
+        output_filename = entry["messages"]
+        data = {'id': entry['id'], 'name': entry['name']}
+        activity_cube.add_messages(int(data['id']), media, replace=data['id'] not in [m[0] for m in meta_data])
+        trend_monitor.add_messages(int(data['id']), media)
+        posting_index.add_messages(int(data['id']), media, replace=data['id'] not in [m[0] for m in meta_data])
+        reaction_matrix.add_messages(int(data['id']), media, replace=data['id'] not in [m[0] for m in meta_data])
+        if data['id'] not in [m[0] for m in meta_data]:
+            message_arena.add(int(data['id']), media, file_version(output_filename))
         meta_data.append([
             data['id'],
             data['name'],
-            chat_type,
+            entry['type'],
             output_filename,
         ])
 
     meta_data_df = pd.DataFrame(meta_data, columns=['id', 'name', 'type', 'messages'])
     meta_data_df.to_csv(os.path.join(dir_root, 'media', 'metadata.csv'))
+    activity_cube.save()
+    trend_monitor.save()
+    posting_index.save()
+    reaction_matrix.save()
+    message_arena.close()
+
+    report = pd.DataFrame(report)
+    if len(report):
+        # nothing is extracted, so the peak disk usage of the ingest is what it writes: the tables (plus the small indexes)
+        print(f"[Runtime Log] -- Ingested {report['messages'].sum()} messages from {report['json_mb'].sum():.1f} MB of json "
+              f"({report['archive_mb'].sum():.1f} MB on disk) in {report['seconds'].sum():.1f} s: "
+              f"{report['json_mb'].sum() / max(report['seconds'].sum(), 1e-9):.1f} MB/s. "
+              f"Disk written: {report['written_mb'].sum():.1f} MB, no extracted copy.")
+    return report
+
+
+def _parse_here(i, export, n_exports):
+    print(f"{i+1}/{n_exports}) Parsing: {export}")
+    return parse_export_to_csv(export, i + 1)
 
 
 if __name__ == "__main__":
-    parse_all_media()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Parse the Telegram exports of the raw data folder.")
+    parser.add_argument("--raw", default=dir_raw_data, help="Folder of the exports.")
+    parser.add_argument("--queue", default=None, help="Work queue directory: let its workers (queue_utils) parse the exports.")
+    parser.add_argument("--no-spam-training", action="store_true", help="Keep the current spam model instead of training it on the exports.")
+    args = parser.parse_args()
+    parse_all_media(args.raw, None if args.queue is None else WorkQueue(args.queue), train_spam=not args.no_spam_training)
\ No newline at end of file
@@ -0,0 +1,200 @@
+"""Posting tables of hashtags, @mentions and link domains over all media.
+Every occurrence is a posting (key id, media id, timestamp, row offset of the message in its parsed table), with the
+keys dictionary encoded. It is built at ingest and answers "which media pushed #X, and when?" without reading any
+messages table.
+"""
+
+import os
+import re
+import numpy as np
+import pandas as pd
+from os.path import dirname
+
+dir_root = dirname(dirname(__file__))
+posting_index_file = os.path.join(dir_root, "media", "posting_index.npz")
+KINDS = {"hashtag": "#", "mention": "@"}
+TELEGRAM_LINK = re.compile(r"^(?:https?://)?(?:www\.)?(?:t|telegram)\.me/(?:s/)?([A-Za-z]\w{3,})", re.IGNORECASE)
+DOMAIN = re.compile(r"^(?:https?://)?(?:www\.)?([^/?#:\s]+)", re.IGNORECASE)
+
+
+def normalize_link(link):
+    """'@name' for mentions and t.me links, the lowercase domain (without 'www.') for any other link."""
+    link = link.strip().rstrip(".,;:!?)»")
+    if link.startswith("@"):
+        return link.lower()
+    match = TELEGRAM_LINK.match(link)
+    if match:
+        return "@" + match.group(1).lower()
+    match = DOMAIN.match(link)
+    return match.group(1).lower() if match else None
+
+
+def message_keys(table):
+    """(message position, key) pairs of a messages table, each key counted once per message."""
+    positions, keys = [], []
+    hashtags = table['hashtags'].to_numpy() if 'hashtags' in table.columns else np.full(len(table), None)
+    links = table['links'].to_numpy() if 'links' in table.columns else np.full(len(table), None)
+    for i, (tags, urls) in enumerate(zip(hashtags, links)):
+        found = set()
+        if isinstance(tags, str):
+            found.update(tag.strip().lower() for tag in tags.split(",") if tag.strip())
+        if isinstance(urls, str):
+            found.update(key for key in map(normalize_link, urls.split(",")) if key)
+        positions.extend([i] * len(found))
+        keys.extend(found)
+    return np.asarray(positions, dtype=np.int64), np.asarray(keys, dtype=object)
+
+
+def key_kind(keys):
+    """'hashtag', 'mention' or 'domain' of every key."""
+    first = np.asarray([key[:1] for key in keys])
+    return np.where(first == "#", "hashtag", np.where(first == "@", "mention", "domain"))
+
+
+class PostingIndex:
+    """Arrays:
+        - keys : (n_keys,) str, the dictionary; a key id is a position in it
+        - key_ids, media, timestamps, rows : one entry per posting
+    Timestamps are unix seconds (-1 if unknown), rows the offset of the message in the parsed table of its media.
+    """
+    def __init__(self, keys=None, key_ids=None, media=None, timestamps=None, rows=None):
+        self.keys = np.asarray(keys if keys is not None else [], dtype=str)
+        self.key_ids = np.asarray(key_ids if key_ids is not None else [], dtype=np.int32)
+        self.media = np.asarray(media if media is not None else [], dtype=np.int64)
+        self.timestamps = np.asarray(timestamps if timestamps is not None else [], dtype=np.int64)
+        self.rows = np.asarray(rows if rows is not None else [], dtype=np.int64)
+        self._lookup = {key: i for i, key in enumerate(self.keys.tolist())}
+
+    @classmethod
+    def load(cls, path=posting_index_file):
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path) as data:
+            return cls(**{key: data[key] for key in data.files})
+
+    def save(self, path=posting_index_file):
+        np.savez_compressed(path, keys=self.keys, key_ids=self.key_ids, media=self.media, timestamps=self.timestamps, rows=self.rows)
+
+    def __len__(self):
+        return len(self.key_ids)
+
+    def __contains__(self, media_idx):
+        return bool(np.any(self.media == int(media_idx)))
+
+    def key_id(self, key):
+        return self._lookup.get(key.lower(), -1)
+
+    def add_messages(self, media_idx, table, replace=True):
+        """Adds the postings of a parsed messages table. Rows are taken from the table index, so pass the whole table
+        of a media. With `replace=True` the previous postings of this media are dropped first.
+        """
+        if replace:
+            keep = self.media != int(media_idx)
+            self.key_ids, self.media, self.timestamps, self.rows = self.key_ids[keep], self.media[keep], self.timestamps[keep], self.rows[keep]
+        positions, keys = message_keys(table)
+        if not len(keys):
+            return self
+        new_keys = sorted(set(keys.tolist()) - self._lookup.keys())
+        self._lookup.update({key: len(self.keys) + i for i, key in enumerate(new_keys)})
+        self.keys = np.concatenate([self.keys, np.asarray(new_keys, dtype=str)])
+        timestamps = table['timestamp'].to_numpy() if 'timestamp' in table.columns else np.full(len(table), -1)
+        self.key_ids = np.concatenate([self.key_ids, np.fromiter((self._lookup[key] for key in keys), dtype=np.int32, count=len(keys))])
+        self.media = np.concatenate([self.media, np.full(len(keys), int(media_idx), dtype=np.int64)])
+        self.timestamps = np.concatenate([self.timestamps, timestamps[positions].astype(np.int64)])
+        self.rows = np.concatenate([self.rows, table.index.to_numpy()[positions].astype(np.int64)])
+        return self
+
+    def _select(self, media_ids=None, start_date=None, end_date=None, kind=None):
+        """Mask of the postings of a query. Dates are pandas Timestamps (or None), end date inclusive."""
+        mask = np.ones(len(self), dtype=bool)
+        if media_ids is not None:
+            mask &= np.isin(self.media, np.atleast_1d(media_ids))
+        if start_date is not None:
+            mask &= self.timestamps >= (start_date - pd.Timestamp("1970-01-01")) // pd.Timedelta(seconds=1)
+        if end_date is not None:
+            mask &= self.timestamps < (end_date + pd.Timedelta(days=1) - pd.Timestamp("1970-01-01")) // pd.Timedelta(seconds=1)
+        if kind is not None:
+            mask &= (key_kind(self.keys) == kind)[self.key_ids]
+        return mask
+
+    def postings(self, key, media_ids=None, start_date=None, end_date=None):
+        """Occurrences of a key, oldest first: media, timestamp, row."""
+        mask = self._select(media_ids, start_date, end_date) & (self.key_ids == self.key_id(key))
+        order = np.argsort(self.timestamps[mask], kind="stable")
+        return pd.DataFrame({"media": self.media[mask][order], "timestamp": self.timestamps[mask][order], "row": self.rows[mask][order]})
+
+    def rows_of(self, keys, media_idx, start_date=None, end_date=None):
+        """Row offsets of the messages of a media that carry any of `keys`."""
+        ids = [key_id for key_id in map(self.key_id, keys) if key_id >= 0]
+        mask = self._select(media_idx, start_date, end_date) & np.isin(self.key_ids, ids)
+        return np.unique(self.rows[mask])
+
+    def top_keys(self, media_ids=None, start_date=None, end_date=None, kind=None, k=20):
+        """Most used keys of a period as a DataFrame: key, messages, media (number of media using it)."""
+        mask = self._select(media_ids, start_date, end_date, kind)
+        counts = np.bincount(self.key_ids[mask], minlength=len(self.keys))
+        top = np.argsort(-counts, kind="stable")[:k]
+        top = top[counts[top] > 0]
+        pairs = np.unique(self.key_ids[mask].astype(np.int64) * (1 << 40) + self.media[mask])
+        spread = np.bincount(pairs >> 40, minlength=len(self.keys))
+        return pd.DataFrame({"key": self.keys[top], "messages": counts[top], "media": spread[top]})
+
+    def spread(self, key, freq="D", start_date=None, end_date=None):
+        """Cross-media timeline of a key: messages per period (rows) and media (columns)."""
+        postings = self.postings(key, start_date=start_date, end_date=end_date)
+        postings = postings[postings["timestamp"] >= 0]
+        if not len(postings):
+            return pd.DataFrame()
+        periods = pd.to_datetime(postings["timestamp"], unit="s").dt.to_period(freq).dt.start_time
+        return postings.groupby([periods.rename("period"), "media"]).size().unstack(fill_value=0)
+
+    def first_seen(self, key):
+        """When each media first used a key, earliest first."""
+        postings = self.postings(key)
+        postings = postings[postings["timestamp"] >= 0]
+        first = postings.groupby("media")["timestamp"].min().sort_values()
+        return pd.to_datetime(first, unit="s")
+
+    def cooccurrence(self, media_ids=None, start_date=None, end_date=None, kind=None, min_count=2):
+        """Sparse (COO) key x key co-occurrence counts: key_a, key_b (key_a < key_b) and the number of messages with both."""
+        mask = self._select(media_ids, start_date, end_date, kind)
+        messages = self.media[mask] * (1 << 32) + self.rows[mask]
+        order = np.lexsort((self.key_ids[mask], messages))
+        messages, key_ids = messages[order], self.key_ids[mask][order].astype(np.int64)
+        # keys of a message are consecutive: pair every posting with the ones 1, 2, ... positions after it
+        pairs = []
+        for distance in range(1, len(messages)):
+            same = messages[distance:] == messages[:-distance]
+            if not same.any():
+                break
+            pairs.append(key_ids[:-distance][same] * len(self.keys) + key_ids[distance:][same])
+        if not pairs:
+            return pd.DataFrame(columns=["key_a", "key_b", "count"])
+        codes, counts = np.unique(np.concatenate(pairs), return_counts=True)
+        keep = counts >= min_count
+        codes, counts = codes[keep], counts[keep]
+        order = np.argsort(-counts, kind="stable")
+        return pd.DataFrame({"key_a": self.keys[codes[order] // len(self.keys)], "key_b": self.keys[codes[order] % len(self.keys)],
+                             "count": counts[order]})
+
+    def related(self, key, k=10, **query):
+        """Keys most often posted together with `key`."""
+        pairs = self.cooccurrence(min_count=1, **query)
+        with_key = pd.concat([pairs.loc[pairs["key_a"] == key.lower(), ["key_b", "count"]].set_axis(["key", "count"], axis=1),
+                              pairs.loc[pairs["key_b"] == key.lower(), ["key_a", "count"]].set_axis(["key", "count"], axis=1)])
+        return with_key.sort_values("count", ascending=False).head(k).reset_index(drop=True)
+
+
+def load_posting_index():
+    return PostingIndex.load()
+
+
+def build_posting_index(metadata_table, read_table):
+    """Builds the postings of every media in `metadata_table` from scratch. `read_table(path)` returns a table with feature columns."""
+    index = PostingIndex()
+    seen = set()
+    for media_idx, messages_file in zip(metadata_table['id'], metadata_table['messages']):
+        index.add_messages(int(media_idx), read_table(messages_file), replace=int(media_idx) not in seen)
+        seen.add(int(media_idx))
+    index.save()
+    return index
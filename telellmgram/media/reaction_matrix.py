@@ -0,0 +1,169 @@
+"""Reactions of all media as a sparse message x emoji count matrix.
+It is built at ingest from the `emoji:count,...` strings of the parser and answers engagement queries (most reacted
+messages of a period, emoji totals, per message engagement) with array operations instead of string parsing.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from os.path import dirname
+
+dir_root = dirname(dirname(__file__))
+reaction_matrix_file = os.path.join(dir_root, "media", "reaction_matrix.npz")
+SECONDS_PER_WEEK = 7 * 86_400
+
+
+def parse_reaction_strings(reactions):
+    """(message position, emoji, count) arrays of the `emoji:count,emoji:count` strings written by the parser."""
+    pairs = pd.Series(reactions, dtype=object).fillna("").map(str).str.split(",").explode()
+    pairs = pairs[pairs.str.contains(":", regex=False)].str.rpartition(":")
+    if not len(pairs):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=object), np.zeros(0, dtype=np.int64)
+    count = pd.to_numeric(pairs[2], errors="coerce").fillna(0).to_numpy(dtype=np.int64)
+    return pairs.index.to_numpy(dtype=np.int64), pairs[0].to_numpy(dtype=object), count
+
+
+class ReactionMatrix:
+    """CSR matrix with one row per message of every media and one column per emoji:
+        - emojis : (n_emojis,) str, the dictionary; an emoji id is a position in it
+        - media, rows, timestamps : (n_messages,) media id, row offset in its parsed table and send time of each message
+        - indptr, emoji_ids, counts : the reactions of message i are emoji_ids / counts[indptr[i]:indptr[i + 1]]
+        - totals : (n_messages,) reactions per message
+    """
+    def __init__(self, emojis=None, media=None, rows=None, timestamps=None, indptr=None, emoji_ids=None, counts=None, totals=None):
+        self.emojis = np.asarray(emojis if emojis is not None else [], dtype=str)
+        self.media = np.asarray(media if media is not None else [], dtype=np.int64)
+        self.rows = np.asarray(rows if rows is not None else [], dtype=np.int64)
+        self.timestamps = np.asarray(timestamps if timestamps is not None else [], dtype=np.int64)
+        self.indptr = np.asarray(indptr if indptr is not None else [0], dtype=np.int64)
+        self.emoji_ids = np.asarray(emoji_ids if emoji_ids is not None else [], dtype=np.int32)
+        self.counts = np.asarray(counts if counts is not None else [], dtype=np.int32)
+        self.totals = np.asarray(totals if totals is not None else [], dtype=np.int64)
+        self._lookup = {emoji: i for i, emoji in enumerate(self.emojis.tolist())}
+
+    @classmethod
+    def load(cls, path=reaction_matrix_file):
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path) as data:
+            return cls(**{key: data[key] for key in data.files})
+
+    def save(self, path=reaction_matrix_file):
+        np.savez_compressed(path, emojis=self.emojis, media=self.media, rows=self.rows, timestamps=self.timestamps,
+                            indptr=self.indptr, emoji_ids=self.emoji_ids, counts=self.counts, totals=self.totals)
+
+    def __len__(self):
+        return len(self.media)
+
+    def __contains__(self, media_idx):
+        return bool(np.any(self.media == int(media_idx)))
+
+    def _entry_messages(self):
+        return np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+    def _drop_media(self, media_idx):
+        keep = self.media != int(media_idx)
+        keep_entries = np.repeat(keep, np.diff(self.indptr))
+        self.indptr = np.concatenate([[0], np.cumsum(np.diff(self.indptr)[keep])])
+        self.emoji_ids, self.counts = self.emoji_ids[keep_entries], self.counts[keep_entries]
+        self.media, self.rows, self.timestamps, self.totals = self.media[keep], self.rows[keep], self.timestamps[keep], self.totals[keep]
+
+    def add_messages(self, media_idx, table, replace=True):
+        """Adds every message of a parsed table (rows taken from the table index). With `replace=True` the previous
+        messages of this media are dropped first.
+        """
+        if replace:
+            self._drop_media(media_idx)
+        positions, emojis, counts = parse_reaction_strings(table['reactions'].to_numpy() if 'reactions' in table.columns else np.full(len(table), ""))
+        new_emojis = sorted(set(emojis.tolist()) - self._lookup.keys())
+        self._lookup.update({emoji: len(self.emojis) + i for i, emoji in enumerate(new_emojis)})
+        self.emojis = np.concatenate([self.emojis, np.asarray(new_emojis, dtype=str)])
+        per_message = np.bincount(positions, minlength=len(table))
+        self.indptr = np.concatenate([self.indptr, self.indptr[-1] + np.cumsum(per_message)])
+        self.emoji_ids = np.concatenate([self.emoji_ids, np.fromiter((self._lookup[e] for e in emojis), dtype=np.int32, count=len(emojis))])
+        self.counts = np.concatenate([self.counts, counts.astype(np.int32)])
+        timestamps = table['timestamp'].to_numpy() if 'timestamp' in table.columns else np.full(len(table), -1)
+        self.media = np.concatenate([self.media, np.full(len(table), int(media_idx), dtype=np.int64)])
+        self.rows = np.concatenate([self.rows, table.index.to_numpy().astype(np.int64)])
+        self.timestamps = np.concatenate([self.timestamps, timestamps.astype(np.int64)])
+        self.totals = np.concatenate([self.totals, np.bincount(positions, weights=counts, minlength=len(table)).astype(np.int64)])
+        return self
+
+    def _select(self, media_ids=None, start_date=None, end_date=None):
+        """Mask of the messages of a query. Dates are pandas Timestamps (or None), end date inclusive."""
+        mask = np.ones(len(self), dtype=bool)
+        if media_ids is not None:
+            mask &= np.isin(self.media, np.atleast_1d(media_ids))
+        if start_date is not None:
+            mask &= self.timestamps >= (start_date - pd.Timestamp("1970-01-01")) // pd.Timedelta(seconds=1)
+        if end_date is not None:
+            mask &= self.timestamps < (end_date + pd.Timedelta(days=1) - pd.Timestamp("1970-01-01")) // pd.Timedelta(seconds=1)
+        return mask
+
+    def scores(self, emoji=None, weights=None):
+        """Per message engagement: all reactions, the count of one `emoji`, or the sum weighted by `weights` {emoji: weight}."""
+        if emoji is None and weights is None:
+            return self.totals
+        weights = {emoji: 1.0} if emoji is not None else weights
+        per_emoji = np.zeros(len(self.emojis))
+        for key, weight in weights.items():
+            if key in self._lookup:
+                per_emoji[self._lookup[key]] = weight
+        return np.bincount(self._entry_messages(), weights=self.counts * per_emoji[self.emoji_ids], minlength=len(self))
+
+    def top_messages(self, media_ids=None, start_date=None, end_date=None, k=20, emoji=None, weights=None):
+        """Most reacted messages of a query, best first: media, row, timestamp, score."""
+        mask = np.flatnonzero(self._select(media_ids, start_date, end_date))
+        scores = self.scores(emoji, weights)
+        top = mask[np.argsort(-scores[mask], kind="stable")[:k]]
+        top = top[scores[top] > 0]
+        return pd.DataFrame({"media": self.media[top], "row": self.rows[top], "timestamp": self.timestamps[top], "score": scores[top]})
+
+    def emoji_totals(self, media_ids=None, start_date=None, end_date=None):
+        """Reactions per emoji as a Series, most used first."""
+        entries = np.repeat(self._select(media_ids, start_date, end_date), np.diff(self.indptr))
+        totals = np.bincount(self.emoji_ids[entries], weights=self.counts[entries], minlength=len(self.emojis))
+        return pd.Series(totals.astype(np.int64), index=self.emojis).sort_values(ascending=False)
+
+    def reactions_of(self, media_idx, row):
+        """{emoji: count} of one message."""
+        message = np.flatnonzero((self.media == int(media_idx)) & (self.rows == row))
+        if not len(message):
+            return {}
+        start, end = self.indptr[message[0]], self.indptr[message[0] + 1]
+        return dict(zip(self.emojis[self.emoji_ids[start:end]].tolist(), self.counts[start:end].tolist()))
+
+    def engagement_of(self, media_idx, rows, relative=False, weights=None):
+        """Engagement of the given rows of a media (0 for unknown rows).
+        With `relative=True` it is divided by the mean engagement of the media's messages of the same week, so messages
+        of a channel's early, smaller audience compete fairly with recent ones.
+        """
+        messages = np.flatnonzero(self.media == int(media_idx))
+        scores = np.asarray(self.scores(weights=weights), dtype=np.float64)[messages]
+        if relative:
+            weeks = np.where(self.timestamps[messages] >= 0, self.timestamps[messages] // SECONDS_PER_WEEK, -1)
+            _, week_of = np.unique(weeks, return_inverse=True)
+            week_mean = np.bincount(week_of, weights=scores) / np.bincount(week_of)
+            scores = scores / (week_mean[week_of] + 1.0)
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(messages):
+            return np.zeros(len(rows))
+        order = np.argsort(self.rows[messages], kind="stable")
+        sorted_rows = self.rows[messages][order]
+        found = np.minimum(np.searchsorted(sorted_rows, rows), len(messages) - 1)
+        return np.where(sorted_rows[found] == rows, scores[order][found], 0.0)
+
+
+def load_reaction_matrix():
+    return ReactionMatrix.load()
+
+
+def build_reaction_matrix(metadata_table, read_table):
+    """Builds the matrix of every media in `metadata_table` from scratch. `read_table(path)` returns a parsed table."""
+    matrix = ReactionMatrix()
+    seen = set()
+    for media_idx, messages_file in zip(metadata_table['id'], metadata_table['messages']):
+        matrix.add_messages(int(media_idx), read_table(messages_file), replace=int(media_idx) not in seen)
+        seen.add(int(media_idx))
+    matrix.save()
+    return matrix
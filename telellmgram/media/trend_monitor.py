@@ -0,0 +1,157 @@
+"""Streaming trend monitor: rolling term, hashtag and link counts per media in fixed-memory sliding-window sketches.
+It is fed with newly ingested messages and answers "what is hot now" without reading any messages table.
+"""
+
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from collections import Counter
+from os.path import dirname
+from telellmgram.utils.burst_utils import extract_terms
+from telellmgram.utils.sketch_utils import CountMinSketch, SpaceSaving
+
+dir_root = dirname(dirname(__file__))
+trend_monitor_file = os.path.join(dir_root, "media", "trend_monitor.pkl")
+
+
+def message_keys(table):
+    """Keys counted for every message: words and '#hashtags' of the text, and its links (e.g. '@channel')."""
+    hashtags = table['hashtags'].to_numpy() if 'hashtags' in table.columns else None
+    positions, terms = extract_terms(table['cleaned_text'].to_numpy(), hashtags)
+    if 'links' not in table.columns:
+        return positions, terms
+    link_positions, link_terms = [], []
+    for i, links in enumerate(table['links'].to_numpy()):
+        if isinstance(links, str):
+            found = {link.strip().lower() for link in links.split(",") if link.strip()}
+            link_positions.extend([i] * len(found))
+            link_terms.extend(found)
+    return (np.concatenate([positions, np.asarray(link_positions, dtype=np.int64)]),
+            np.concatenate([terms, np.asarray(link_terms, dtype=object)]))
+
+
+class SlidingTermWindow:
+    """Ring of `n_buckets` time buckets of `bucket_seconds`, each holding a count-min sketch and heavy hitters.
+    Buckets are keyed by event time; when a newer bucket starts, the slot of the bucket falling out of the window is
+    cleared, so memory stays at n_buckets * (depth * width counters + capacity heavy hitters).
+    """
+    def __init__(self, bucket_seconds=6 * 3_600, n_buckets=28, width=2048, depth=4, capacity=256):
+        self.bucket_seconds = bucket_seconds
+        self.n_buckets = n_buckets
+        self.sketches = [CountMinSketch(width, depth) for _ in range(n_buckets)]
+        self.heavy = [SpaceSaving(capacity) for _ in range(n_buckets)]
+        self.bucket_ids = np.full(n_buckets, -1, dtype=np.int64)
+        self.messages = np.zeros(n_buckets, dtype=np.int64)
+        self.newest = -1
+
+    def add(self, timestamps, positions, terms):
+        """`timestamps` of the messages (unix seconds), and the (message position, term) pairs of their keys."""
+        buckets = timestamps // self.bucket_seconds
+        self.newest = max(self.newest, int(buckets.max()) if len(buckets) else -1)
+        for bucket in np.unique(buckets):
+            if bucket <= self.newest - self.n_buckets:
+                continue  # older than the window
+            slot = bucket % self.n_buckets
+            if self.bucket_ids[slot] > bucket:
+                continue
+            if self.bucket_ids[slot] != bucket:
+                self.sketches[slot].clear()
+                self.heavy[slot].clear()
+                self.messages[slot] = 0
+                self.bucket_ids[slot] = bucket
+            in_bucket = buckets == bucket
+            counts = Counter(terms[in_bucket[positions]].tolist())
+            self.sketches[slot].add(list(counts), list(counts.values()))
+            self.heavy[slot].add_counts(counts)
+            self.messages[slot] += int(in_bucket.sum())
+
+    def _slots(self, first_bucket, last_bucket):
+        return np.flatnonzero((self.bucket_ids >= first_bucket) & (self.bucket_ids <= last_bucket))
+
+    def emerging(self, k=20, recent_buckets=4, min_count=3):
+        """Keys counted far more often in the last `recent_buckets` buckets than in the rest of the window.
+        Candidates are the heavy hitters of the recent buckets; their counts are summed from the sketches and scored
+        with a Poisson z-score against the rate of the older buckets.
+        """
+        columns = ["term", "recent", "expected", "z"]
+        recent = self._slots(self.newest - recent_buckets + 1, self.newest)
+        older = self._slots(self.newest - self.n_buckets + 1, self.newest - recent_buckets)
+        candidates = sorted({key for slot in recent for key, _, _ in self.heavy[slot].top()})
+        if not candidates:
+            return pd.DataFrame(columns=columns)
+        recent_counts = sum(self.sketches[slot].estimate(candidates) for slot in recent)
+        older_counts = sum((self.sketches[slot].estimate(candidates) for slot in older), np.zeros(len(candidates)))
+        rate = (older_counts + 0.5) / (self.messages[older].sum() + 1.0)
+        expected = rate * self.messages[recent].sum()
+        z = (recent_counts - expected) / np.sqrt(expected + 1.0)
+        result = pd.DataFrame({"term": candidates, "recent": recent_counts, "expected": expected, "z": z})
+        return result[result["recent"] >= min_count].sort_values("z", ascending=False).head(k).reset_index(drop=True)
+
+    @property
+    def window_start(self):
+        return pd.to_datetime((self.newest - self.n_buckets + 1) * self.bucket_seconds, unit="s")
+
+
+class TrendMonitor:
+    """One sliding window per media. Subscribers registered with `subscribe(callback)` receive
+    callback(media_idx, emerging) every time messages of a media are added.
+    """
+    def __init__(self, **window_args):
+        self.window_args = window_args
+        self.windows = {}
+        self.subscribers = []
+
+    def __contains__(self, media_idx):
+        return int(media_idx) in self.windows
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["subscribers"] = []
+        return state
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def add_messages(self, media_idx, table):
+        """Adds newly ingested messages (a table with the ingest feature columns) of a media."""
+        media_idx = int(media_idx)
+        valid = table['timestamp'].to_numpy() >= 0
+        table = table[valid]
+        if media_idx not in self.windows:
+            self.windows[media_idx] = SlidingTermWindow(**self.window_args)
+        positions, terms = message_keys(table)
+        self.windows[media_idx].add(table['timestamp'].to_numpy(), positions, terms)
+        if self.subscribers:
+            emerging = self.emerging(media_idx)
+            for callback in self.subscribers:
+                callback(media_idx, emerging)
+        return self
+
+    def emerging(self, media_idx=None, k=20, recent_buckets=4, min_count=3):
+        """Emerging keys of a media, or with `media_idx=None` of all media (with a `media` column), best first."""
+        if media_idx is not None:
+            if int(media_idx) not in self.windows:
+                return pd.DataFrame(columns=["term", "recent", "expected", "z"])
+            return self.windows[int(media_idx)].emerging(k, recent_buckets, min_count)
+        frames = [window.emerging(k, recent_buckets, min_count).assign(media=media) for media, window in self.windows.items()]
+        frames = [frame for frame in frames if len(frame)]
+        if not frames:
+            return pd.DataFrame(columns=["term", "recent", "expected", "z", "media"])
+        return pd.concat(frames).sort_values("z", ascending=False).head(k).reset_index(drop=True)
+
+    @classmethod
+    def load(cls, path=trend_monitor_file):
+        if not os.path.exists(path):
+            return cls()
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def save(self, path=trend_monitor_file):
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(self, f)
+        os.replace(path + ".tmp", path)
+
+
+def load_trend_monitor():
+    return TrendMonitor.load()
@@ -0,0 +1,472 @@
+"""Headless HTTP/JSON server running the social pipelines as queued jobs in one warm process.
+
+Example:
+    python -m telellmgram.pipelines.analysis_server --port 8080 --workers 1
+
+    curl -X POST localhost:8080/jobs -d '{"pipeline": "topic", "priority": 0,
+                                          "params": {"prompt": "...", "media": [1213225656], "start_date": "01/01/24"}}'
+    curl localhost:8080/jobs/<id>            # status and progress
+    curl localhost:8080/jobs/<id>/result     # final output
+    curl -X DELETE localhost:8080/jobs/<id>  # cancel
+    curl -X POST localhost:8080/plan -d '{"pipeline": "specific", "params": {...}, "target_seconds": 300}'  # dry run
+
+Endpoints: POST /jobs, GET /jobs, GET /jobs/<id>, GET /jobs/<id>/result, DELETE /jobs/<id>, POST /plan, GET /health,
+GET /metrics.
+Lower `priority` values run first. Jobs are written to `logs/jobs/<id>.json` and their partials and result to
+`logs/jobs/<id>.result.json`; jobs that were still queued or running when the server stopped are queued again on the
+next start. Finished jobs of earlier runs are not loaded: they are read from disk when asked for by id.
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import threading
+import dataclasses
+import pandas as pd
+from os.path import dirname
+from concurrent.futures import ThreadPoolExecutor
+from telellmgram.utils.llm_utils import LLMCallCancelled, enable_llm_cache, LLM_FLIGHT
+from telellmgram.utils.pipeline_utils import RunControl, SPAM_THRESHOLD
+from telellmgram.utils.trace_utils import TRACER
+from telellmgram.pipelines import social_pipelines as sp
+
+dir_root = dirname(dirname(__file__))
+dir_jobs = os.path.join(dir_root, "logs", "jobs")
+llm_cache_file = os.path.join(dir_root, "logs", "llm_cache.jsonl")
+PIPELINES = ("specific", "topic", "time", "trend", "person", "stats", "report")
+HTTP_STATUS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               409: "Conflict", 413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error"}
+MAX_BODY_BYTES = 1 << 20  # job requests are small JSON documents
+
+
+def build_pipeline(pipeline, params, cache=None):
+    """Pipeline object of a job. `params` uses the same names as the command line runner."""
+    media = params.get("media")
+    media = [int(code) for code in media] if isinstance(media, list) else media
+    first_media = media[0] if isinstance(media, list) else media
+    start_date, end_date = params.get("start_date"), params.get("end_date")
+    spam = params.get("spam_threshold", SPAM_THRESHOLD)
+    if pipeline == "specific":
+        return sp.SpecificMediaAnalysis(params["prompt"], first_media, start_date, end_date, cache=cache, spam_threshold=spam)
+    if pipeline == "topic":
+        return sp.TopicOriented(params["prompt"], media if isinstance(media, list) else [media], params.get("keywords"),
+                                start_date, end_date, retrieval=params.get("retrieval", "semantic"), cache=cache,
+                                parallel=params.get("parallel", False), spam_threshold=spam)
+    if pipeline == "time":
+        return sp.TimeBasedOriented(params["prompt"], first_media, start_date, end_date, cache=cache, spam_threshold=spam)
+    if pipeline == "trend":
+        return sp.TrendDetection(first_media, start_date, end_date, cache=cache, mode=params.get("mode", "burst"), spam_threshold=spam)
+    if pipeline == "person":
+        return sp.IndividualPersonAnalysis(params["prompt"], first_media, params["user_id"], cache=cache, spam_threshold=spam)
+    if pipeline == "stats":
+        return sp.StatisticalInformation(media, start_date, end_date)
+    if pipeline == "report":
+        return sp.Reporting(first_media, start_date, end_date, topics=params.get("topics"), trend_mode=params.get("mode", "burst"), cache=cache,
+                            spam_threshold=spam)
+    raise ValueError(f"Unknown pipeline: {pipeline}")
+
+
+def _normalize_date(date_str, default=None):
+    if date_str is None:
+        date_str = default
+    if date_str is None:
+        return None
+    parsed = sp._parse_filter_date(str(date_str).strip())
+    return str(date_str) if pd.isna(parsed) else parsed.strftime("%d/%m/%Y")
+
+
+def normalize_params(pipeline, params):
+    """Canonical parameters of a job: only the ones the pipeline uses, defaults filled in, media ids sorted,
+    dates in one format and whitespace of the prompt collapsed. Jobs with equal normalized parameters produce
+    the same analysis, so they are run once.
+    """
+    media = params.get("media")
+    media = [] if media is None else [int(code) for code in (media if isinstance(media, list) else [media])]
+    normalized = {}
+    if pipeline in ("specific", "topic", "time", "person"):
+        normalized["prompt"] = " ".join(str(params.get("prompt", "")).split())
+    if pipeline == "topic":
+        normalized["media"] = sorted(set(media))
+        keywords = params.get("keywords")
+        normalized["keywords"] = sorted(kw.strip() for kw in keywords if kw.strip()) if keywords else None
+        normalized["retrieval"] = params.get("retrieval", "semantic")
+        normalized["parallel"] = bool(params.get("parallel", False))
+    elif pipeline == "stats":
+        normalized["media"] = sorted(set(media)) if media else None
+    else:
+        normalized["media"] = media[:1]
+    if pipeline in ("trend", "report"):
+        normalized["mode"] = params.get("mode", "burst")
+    if pipeline == "report":
+        normalized["topics"] = sorted({topic.strip() for topic in params.get("topics") or [] if topic.strip()})
+    if pipeline != "stats":
+        spam = params.get("spam_threshold", SPAM_THRESHOLD)
+        normalized["spam_threshold"] = None if spam is None else float(spam)
+    if pipeline == "person":
+        normalized["user_id"] = params.get("user_id")
+    elif pipeline in ("specific", "topic"):
+        normalized["start_date"] = _normalize_date(params.get("start_date"), "01/01/00")
+        normalized["end_date"] = _normalize_date(params.get("end_date"), "01/01/30")
+    else:
+        normalized["start_date"] = _normalize_date(params.get("start_date"))
+        normalized["end_date"] = _normalize_date(params.get("end_date"))
+    return normalized
+
+
+class Job:
+    def __init__(self, pipeline, params, priority=0, job_id=None, submitted=None):
+        self.id = job_id or uuid.uuid4().hex[:12]
+        self.pipeline = pipeline
+        self.params = params
+        self.priority = priority
+        self.submitted = submitted or time.time()
+        self.state = "queued"   # queued -> running -> done | failed | cancelled
+        self.started = None
+        self.finished = None
+        self.progress = {}
+        self.partials = []
+        self.result = None
+        self.n_partials = None  # count of the partials while they are on disk only (partials is None)
+        self.error = None
+        self.coalesced = False  # attached to the execution of an identical job
+        self.flight = None  # the Flight running it, while queued or running
+
+    def status(self):
+        return {"id": self.id, "pipeline": self.pipeline, "params": self.params, "priority": self.priority,
+                "state": self.state, "submitted": self.submitted, "started": self.started, "finished": self.finished,
+                "progress": dict(self.progress), "partials": self.n_partials if self.partials is None else len(self.partials),
+                "error": self.error, "coalesced": self.coalesced}
+
+    @classmethod
+    def from_status(cls, record):
+        """Job of a status record, with its partials and result left on disk."""
+        job = cls(record["pipeline"], record["params"], record["priority"], record["id"], record["submitted"])
+        for key in ("state", "started", "finished", "progress", "error"):
+            setattr(job, key, record[key])
+        job.partials, job.n_partials = None, record["partials"]
+        job.coalesced = record.get("coalesced", False)
+        return job
+
+
+class Flight:
+    """Jobs with the same normalized parameters, sharing one place in the queue and one execution. The jobs share
+    the progress dict and the partials list of the flight, so a job attached while it runs sees what was done so far.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.jobs = []
+        self.progress = {}
+        self.partials = []
+        self.priority = None
+        self.seq = None  # queue entry that runs it; older entries (before a priority raise) are skipped
+        self.started = None
+        self.cancel_event = threading.Event()
+
+    def attach(self, job):
+        job.flight, job.progress, job.partials = self, self.progress, self.partials
+        if self.started is not None:
+            job.state, job.started = "running", self.started
+        self.jobs.append(job)
+
+    def detach(self, job):
+        self.jobs.remove(job)
+        job.flight, job.progress, job.partials = None, dict(job.progress), list(job.partials)
+
+
+class AnalysisServer:
+    """Bounded priority queue of jobs served by `workers` pipeline threads, sharing one warm media cache.
+    A job submitted while an identical one (same normalized parameters) is queued or running is attached to it instead
+    of being queued: it follows the same progress and partials and gets the same result. Cancelling a job detaches it;
+    the execution is cancelled only when no job is left on it.
+    """
+    def __init__(self, workers=1, max_queue=64, jobs_dir=dir_jobs, max_body=MAX_BODY_BYTES):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_body = max_body
+        self.jobs_dir = jobs_dir
+        self.jobs = {}
+        self.cache = sp.new_media_cache()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._queue = None
+        self._queued = 0  # flights waiting to run; cancelled ones stay in the heap until popped but are not counted
+        self._seq = 0
+        self._flights = {}  # key -> Flight of the queued and running executions
+        self.leaders = 0
+        self.followers = 0
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def _write(self, name, record):
+        path = os.path.join(self.jobs_dir, name)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False, default=str)
+        os.replace(path + ".tmp", path)
+
+    def _read(self, name):
+        path = os.path.join(self.jobs_dir, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _persist(self, job):
+        """Writes the status of a job, and its partials and result once it finished (before the status says so)."""
+        if job.finished is not None and job.partials is not None:
+            self._write(f"{job.id}.result.json", {"partials": job.partials, "result": job.result})
+        self._write(f"{job.id}.json", job.status())
+
+    def _restore(self):
+        """Queues again the jobs left queued or running; finished jobs stay on disk (see `get_job`)."""
+        for name in sorted(os.listdir(self.jobs_dir)):
+            if not name.endswith(".json") or name.endswith(".result.json"):
+                continue
+            record = self._read(name)
+            if record["state"] in ("queued", "running"):
+                job = Job.from_status(record)
+                job.state, job.started = "queued", None
+                self.jobs[job.id] = job
+                self._attach(job)
+        print(f"[Runtime Log] -- Restored {len(self.jobs)} unfinished jobs, {self._queued} queued.")
+
+    def get_job(self, job_id):
+        """A job of this run, or the status of a finished job of an earlier run read from disk (None if unknown)."""
+        job = self.jobs.get(job_id)
+        if job is None and all(c.isalnum() for c in job_id):
+            record = self._read(f"{job_id}.json")
+            job = None if record is None else Job.from_status(record)
+        return job
+
+    def job_result(self, job):
+        """(partials, result) of a finished job, read from disk when not in memory."""
+        if job.partials is None:
+            record = self._read(f"{job.id}.result.json") or {}
+            return record.get("partials", []), record.get("result")
+        return job.partials, job.result
+
+    def _enqueue(self, flight, priority):
+        self._seq += 1
+        flight.priority, flight.seq = priority, self._seq
+        self._queue.put_nowait((priority, self._seq, flight))
+
+    def _set_queued(self, queued):
+        self._queued = queued
+        TRACER.set_gauge("queued_jobs", queued)
+
+    @staticmethod
+    def job_key(pipeline, params):
+        return json.dumps([pipeline, normalize_params(pipeline, params)], sort_keys=True, ensure_ascii=False)
+
+    def _attach(self, job):
+        """Attaches a job to the queued or running flight of an identical job, or queues a new flight for it."""
+        key = self.job_key(job.pipeline, job.params)
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = Flight(key)
+            flight.attach(job)
+            self._enqueue(flight, job.priority)
+            self._set_queued(self._queued + 1)
+            self.leaders += 1
+        else:
+            flight.attach(job)
+            job.coalesced = True
+            if flight.started is None and job.priority < flight.priority:
+                self._enqueue(flight, job.priority)  # runs at the best priority of its jobs
+            self.followers += 1
+            TRACER.add(coalesced=1)
+        TRACER.set_gauge("singleflight_pipeline_leaders", self.leaders)
+        TRACER.set_gauge("singleflight_pipeline_followers", self.followers)
+
+    def submit(self, pipeline, params, priority=0):
+        if self._queued >= self.max_queue and self.job_key(pipeline, params) not in self._flights:
+            raise OverflowError("job queue is full")
+        job = Job(pipeline, params, priority)
+        self._attach(job)
+        self.jobs[job.id] = job
+        self._persist(job)
+        return job
+
+    def cancel(self, job):
+        flight = job.flight
+        if flight is None:
+            return  # finished
+        flight.detach(job)
+        job.state, job.finished = "cancelled", time.time()
+        self._persist(job)
+        if not flight.jobs:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            if flight.started is None:
+                self._set_queued(self._queued - 1)  # skipped when it reaches the head of the queue
+            else:
+                flight.cancel_event.set()
+
+    def _run_flight(self, flight, pipeline, params):
+        """Runs on a worker thread."""
+        def on_progress(stage, done, total):
+            flight.progress.update(stage=stage, done=done, total=total)
+
+        control = RunControl(on_progress=on_progress, on_partial=lambda i, text: flight.partials.append(text),
+                             cancel_event=flight.cancel_event)
+        with TRACER.span("job", pipeline=pipeline, jobs=len(flight.jobs)):
+            control.progress("load", 0, 1)
+            analysis = build_pipeline(pipeline, normalize_params(pipeline, params), self.cache)
+            if pipeline == "stats":
+                return json.dumps(analysis.chart_paths(), ensure_ascii=False)
+            return analysis.run(control)
+
+    def plan(self, pipeline, params, target_seconds=None):
+        """Estimated calls, tokens and wall time of a job (a RunPlan as a dict), without running it."""
+        if pipeline == "stats":
+            return {"pipeline": "stats", "llm_calls": 0}
+        with TRACER.span("plan", pipeline=pipeline):
+            plan = build_pipeline(pipeline, normalize_params(pipeline, params), self.cache).plan(target_seconds)
+        return dataclasses.asdict(plan)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, seq, flight = await self._queue.get()
+            if seq != flight.seq or not flight.jobs:
+                continue  # cancelled, or queued again at a better priority
+            self._set_queued(self._queued - 1)
+            flight.started = time.time()
+            leader = flight.jobs[0]
+            for job in flight.jobs:
+                job.state, job.started = "running", flight.started
+                self._persist(job)
+            result, error = None, None
+            try:
+                result = await loop.run_in_executor(self._executor, self._run_flight, flight, leader.pipeline, leader.params)
+                state = "done"
+            except LLMCallCancelled:
+                state = "cancelled"
+            except Exception as e:
+                state, error = "failed", f"{type(e).__name__}: {e}"
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            finished, jobs = time.time(), list(flight.jobs)
+            for job in jobs:
+                flight.detach(job)
+                job.state, job.result, job.error, job.finished = state, result, error, finished
+                self._persist(job)
+            shared = f", shared by {len(jobs)} jobs" if len(jobs) > 1 else ""
+            print(f"[Runtime Log] -- Job {leader.id} ({leader.pipeline}) {state} in {finished - flight.started:.1f}s{shared}.")
+
+    async def handle(self, method, path, body):
+        """Routes one request. Returns (http status, JSON-able payload)."""
+        parts = [part for part in path.split("?")[0].split("/") if part]
+        if parts == ["health"]:
+            return 200, {"status": "ok", "queued": self._queued, "jobs": len(self.jobs),
+                         "coalescing": {"pipeline": {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self._flights)},
+                                        "llm": LLM_FLIGHT.stats()}}
+        if parts == ["metrics"]:
+            return 200, TRACER.prometheus_text()
+        if parts == ["jobs"] and method == "GET":  # the jobs of this run; earlier ones are reachable by id
+            return 200, [job.status() for job in sorted(self.jobs.values(), key=lambda job: job.submitted)]
+        if parts == ["jobs"] and method == "POST":
+            try:
+                request = json.loads(body or b"{}")
+                if request.get("pipeline") not in PIPELINES:
+                    return 400, {"error": f"unknown pipeline: {request.get('pipeline')}"}
+                job = self.submit(request["pipeline"], request.get("params", {}), int(request.get("priority", 0)))
+            except OverflowError as e:
+                return 429, {"error": str(e)}
+            except (ValueError, TypeError, KeyError) as e:
+                return 400, {"error": f"bad request: {e}"}
+            return 202, job.status()
+        if parts == ["plan"] and method == "POST":
+            try:
+                request = json.loads(body or b"{}")
+                if request.get("pipeline") not in PIPELINES:
+                    return 400, {"error": f"unknown pipeline: {request.get('pipeline')}"}
+                target = request.get("target_seconds")
+                plan = await asyncio.get_running_loop().run_in_executor(
+                    None, self.plan, request["pipeline"], request.get("params", {}), None if target is None else float(target))
+            except (ValueError, TypeError, KeyError) as e:
+                return 400, {"error": f"bad request: {e}"}
+            return 200, plan
+        if len(parts) in (2, 3) and parts[0] == "jobs":
+            job = self.get_job(parts[1])
+            if job is None:
+                return 404, {"error": "no such job"}
+            if len(parts) == 3 and parts[2] == "result" and method == "GET":
+                if job.state != "done":
+                    return 409, {"error": f"job is {job.state}", "state": job.state}
+                partials, result = self.job_result(job)
+                return 200, {"id": job.id, "result": result, "partials": partials}
+            if len(parts) == 2 and method == "GET":
+                return 200, job.status()
+            if len(parts) == 2 and method == "DELETE":
+                self.cancel(job)
+                return 200, job.status()
+            return 405, {"error": "method not allowed"}
+        return 404, {"error": "not found"}
+
+    async def _serve_connection(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = headers.get("content-length", "0")
+            length = int(length) if length.isdigit() else -1
+            if len(request_line) < 2 or length < 0:
+                status, payload = 400, {"error": "bad request"}
+            elif length > self.max_body:
+                status, payload = 413, {"error": f"request body over {self.max_body} bytes"}  # not read
+            else:
+                body = await reader.readexactly(length)
+                status, payload = await self.handle(request_line[0].upper(), request_line[1], body)
+        except Exception as e:
+            status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+        if isinstance(payload, str):
+            data, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            data, content_type = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8"), "application/json"
+        writer.write(f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\nContent-Type: {content_type}; charset=utf-8\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1") + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        self._queue = asyncio.PriorityQueue()
+        self._restore()
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        server = await asyncio.start_server(self._serve_connection, host, port)
+        print(f"[Runtime Log] -- Analysis server listening on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the TeleLLMgram analysis server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1, help="Pipelines running at the same time.")
+    parser.add_argument("--max-queue", type=int, default=64)
+    parser.add_argument("--llm-cache", default=llm_cache_file, help="JSON-lines file of cached LLM responses.")
+    parser.add_argument("--trace", default=None, help="JSON-lines file that receives one record per finished span.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    TRACER.trace_file = args.trace
+    enable_llm_cache(args.llm_cache)
+    asyncio.run(AnalysisServer(args.workers, args.max_queue).serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
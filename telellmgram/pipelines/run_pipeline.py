@@ -0,0 +1,104 @@
+"""Command line entry point for running a single pipeline with tracing, metrics and optional profiling.
+
+Example:
+    python -m telellmgram.pipelines.run_pipeline topic --prompt "..." --media 1213225656 2422976810 \
+        --trace logs/trace.jsonl --metrics logs/metrics.prom --profile cprofile
+"""
+
+import argparse
+from telellmgram.utils.trace_utils import TRACER, profiled
+from telellmgram.pipelines import social_pipelines as sp
+from telellmgram.utils.pipeline_utils import SPAM_THRESHOLD, RunControl
+from telellmgram.utils.batch_utils import BatchMapper, LocalBatchProcessor, OpenAIBatchBackend
+from telellmgram.utils.queue_utils import WorkQueue, WorkQueueMapper
+
+
+def build_pipeline(args):
+    media = args.media[0] if args.media else None
+    spam = None if args.spam_threshold > 1 else args.spam_threshold
+    if args.pipeline == "specific":
+        return sp.SpecificMediaAnalysis(args.prompt, media, args.start_date, args.end_date, spam_threshold=spam)
+    if args.pipeline == "topic":
+        return sp.TopicOriented(args.prompt, args.media, start_date=args.start_date, end_date=args.end_date, retrieval=args.retrieval,
+                                parallel=args.parallel, max_workers=args.workers, spam_threshold=spam)
+    if args.pipeline == "time":
+        return sp.TimeBasedOriented(args.prompt, media, args.start_date, args.end_date, spam_threshold=spam)
+    if args.pipeline == "trend":
+        return sp.TrendDetection(media, args.start_date, args.end_date, mode=args.trend_mode, spam_threshold=spam)
+    if args.pipeline == "person":
+        return sp.IndividualPersonAnalysis(args.prompt, media, args.user_id, spam_threshold=spam)
+    if args.pipeline == "stats":
+        return sp.StatisticalInformation(media)
+    if args.pipeline == "report":
+        return sp.Reporting(media, args.start_date, args.end_date, topics=args.topics, trend_mode=args.trend_mode, spam_threshold=spam)
+    raise ValueError(f"Unknown pipeline: {args.pipeline}")
+
+
+def build_control(args):
+    if args.queue is not None:
+        return RunControl(batch=WorkQueueMapper(WorkQueue(args.queue)))
+    if args.batch is None:
+        return RunControl()
+    backend = OpenAIBatchBackend() if args.batch == "openai" else LocalBatchProcessor()
+    return RunControl(batch=BatchMapper(backend, poll_seconds=args.poll_seconds))
+
+
+def plan_pipeline(args):
+    if args.pipeline == "stats":
+        return "stats: no LLM calls."
+    return build_pipeline(args).plan(args.target_seconds).summary()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run a TeleLLMgram pipeline.")
+    parser.add_argument("pipeline", choices=["specific", "topic", "time", "trend", "person", "stats", "report"])
+    parser.add_argument("--prompt", default="")
+    parser.add_argument("--media", type=int, nargs="+", help="Media id(s) as written in metadata.csv.")
+    parser.add_argument("--start-date", default=None, help="dd/mm/yy")
+    parser.add_argument("--end-date", default=None, help="dd/mm/yy")
+    parser.add_argument("--user-id", default=None)
+    parser.add_argument("--retrieval", choices=["semantic", "keyword"], default="semantic")
+    parser.add_argument("--trend-mode", choices=["burst", "llm", "live"], default="burst")
+    parser.add_argument("--topics", nargs="*", default=None, help="report: topics analysed in their own sections.")
+    parser.add_argument("--spam-threshold", type=float, default=SPAM_THRESHOLD,
+                        help="Leave out messages with a spam score at or above it; above 1 keeps every message.")
+    parser.add_argument("--parallel", action="store_true", help="topic: load, retrieve and analyse the media concurrently.")
+    parser.add_argument("--workers", type=int, default=4, help="topic --parallel: processes loading the media tables.")
+    parser.add_argument("--plan", action="store_true",
+                        help="Only estimate the LLM calls, prompt tokens and wall time of the run, without calling the LLM.")
+    parser.add_argument("--target-seconds", type=float, default=None,
+                        help="--plan: suggest how to narrow the run when it is estimated to take longer than this.")
+    parser.add_argument("--batch", choices=["openai", "local"], default=None,
+                        help="Send the map prompts as one batch job (OpenAI batch API, or processed locally in the background).")
+    parser.add_argument("--poll-seconds", type=float, default=60, help="--batch: seconds between job status checks.")
+    parser.add_argument("--queue", default=None,
+                        help="Work queue directory: run the map prompts on its workers (see utils/queue_utils.py).")
+    parser.add_argument("--trace", default=None, help="JSON-lines file that receives one record per finished span.")
+    parser.add_argument("--metrics", default=None, help="File to write the Prometheus text exposition to after the run.")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve /metrics on this port while running.")
+    parser.add_argument("--profile", choices=["cprofile", "sampling"], default=None)
+    parser.add_argument("--profile-output", default="pipeline.prof",
+                        help="pstats dump for cprofile, collapsed stacks for sampling.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    TRACER.trace_file = args.trace
+    if args.metrics_port:
+        TRACER.serve_metrics(args.metrics_port)
+    with profiled(args.profile, args.profile_output):
+        with TRACER.span("pipeline", pipeline=args.pipeline, media=args.media):
+            if args.plan:
+                output = plan_pipeline(args)
+            else:
+                output = build_pipeline(args).run(build_control(args)) if args.pipeline != "stats" else build_pipeline(args)
+    if args.metrics:
+        TRACER.write_prometheus(args.metrics)
+    if isinstance(output, str):
+        print(output)
+    return output
+
+
+if __name__ == "__main__":
+    main()
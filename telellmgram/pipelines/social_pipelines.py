@@ -1,22 +1,32 @@
 """Code for working with social and political pipelines"""
 
 import os
-import time
 import calendar
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-from random import sample
 from os.path import dirname, abspath
 from telellmgram.media.media_db import metadata_file
-from telellmgram.utils.text_utils import count_persian_letters
-from telellmgram.utils.llm_utils import call_llm
-from telellmgram.utils.pipeline_utils import extract_users_from_groups
+from telellmgram.media.activity_cube import load_activity_cube, activity_cube_file
+from telellmgram.media.trend_monitor import load_trend_monitor
+from telellmgram.media.posting_index import load_posting_index
+from telellmgram.media.reaction_matrix import load_reaction_matrix
+from telellmgram.media.message_arena import get_message_arena, file_version
+from telellmgram.utils.llm_utils import call_llm, LLM_CONFIG, LLM_RATE_LIMITER
+from telellmgram.utils.pipeline_utils import extract_users_from_groups, valid_text_mask, build_chunks, build_thread_chunks, read_messages_table, table_memory, NO_CONTROL, RunControl, \
+    MediaTableCache, spam_mask, SPAM_THRESHOLD, RunPlan, estimate_tokens, MAX_RESPONSE_TOKENS
+from telellmgram.utils.index_utils import get_media_index
+from telellmgram.utils.selection_utils import select_messages
+from telellmgram.utils.burst_utils import BurstDetector
+from telellmgram.utils.thread_utils import ThreadIndex
+from telellmgram.utils.dag_utils import AnalysisGraph, NodeCache
+from telellmgram.utils.trace_utils import TRACER
+from telellmgram.utils.chart_utils import get_chart_service
 from whoosh.fields import Schema, TEXT, ID
 from whoosh.qparser import MultifieldParser
 from whoosh.filedb.filestore import RamStorage
-import matplotlib.pyplot as plt
-import seaborn as sns
 
 
 dir_root = dirname(dirname(__file__))
@@ -24,193 +34,517 @@ meta_data = pd.read_csv(metadata_file)
 new_line_token = '\n'
 
 def filter_dataframe_by_date(table, start_date, end_date):
-    df_copy = table.copy()
-    df_copy['date'] = pd.to_datetime(df_copy['date'], format="%d/%m/%y", errors="coerce")
-    def parse_date(date_str):
-        for fmt in ("%d/%m/%Y", "%d/%m/%y"):
-            try:
-                return pd.to_datetime(date_str, format=fmt)
-            except (ValueError, TypeError):
-                continue
-        try:
-            day, month, year = map(int, date_str.split("/"))
-            last_day = calendar.monthrange(year, month)[1]
-            return pd.to_datetime(f"{last_day}/{month}/{year}", dayfirst=True)
-        except Exception:
-            return pd.NaT
-    start_date_parsed = parse_date(start_date)
-    end_date_parsed = parse_date(end_date)
+    with TRACER.span("filter", rows_in=len(table), start_date=start_date, end_date=end_date) as span:
+        filtered_df = _filter_dataframe_by_date(table, start_date, end_date)
+        span.add(rows_out=len(filtered_df))
+    return filtered_df
+
+
+def _parse_filter_dates(start_date, end_date):
+    start_date_parsed = _parse_filter_date(start_date)
+    end_date_parsed = _parse_filter_date(end_date)
     if pd.isna(start_date_parsed):
         raise ValueError(f"Invalid start_date: {start_date}")
     if pd.isna(end_date_parsed):
         raise ValueError(f"Invalid end_date: {end_date}")
+    return start_date_parsed, end_date_parsed
+
+
+def _timestamp_range(start_date, end_date):
+    """[start, end) unix seconds of a date filter (the end date is inclusive)."""
+    start_date_parsed, end_date_parsed = _parse_filter_dates(start_date, end_date)
+    start_ts = (start_date_parsed - pd.Timestamp("1970-01-01")) // pd.Timedelta(seconds=1)
+    end_ts = (end_date_parsed + pd.Timedelta(days=1) - pd.Timestamp("1970-01-01")) // pd.Timedelta(seconds=1)
+    return start_ts, end_ts
+
+
+def _filter_dataframe_by_date(table, start_date, end_date):
+    start_date_parsed, end_date_parsed = _parse_filter_dates(start_date, end_date)
+    if 'timestamp' in table.columns:
+        # Precomputed send time: compare integers instead of parsing the date strings.
+        start_ts, end_ts = _timestamp_range(start_date, end_date)
+        return table[(table['timestamp'] >= start_ts) & (table['timestamp'] < end_ts)]
+    df_copy = table.copy()
+    df_copy['date'] = pd.to_datetime(df_copy['date'], format="%d/%m/%y", errors="coerce")
     filtered_df = df_copy[(df_copy['date'] >= start_date_parsed) & (df_copy['date'] <= end_date_parsed)]
     filtered_df['date'] = filtered_df['date'].dt.strftime('%d/%m/%y')
     return filtered_df
 
 
-def get_media_table_from_code(code):
+def _parse_filter_date(date_str):
+    for fmt in ("%d/%m/%Y", "%d/%m/%y"):
+        try:
+            return pd.to_datetime(date_str, format=fmt)
+        except (ValueError, TypeError):
+            continue
+    try:
+        day, month, year = map(int, date_str.split("/"))
+        last_day = calendar.monthrange(year, month)[1]
+        return pd.to_datetime(f"{last_day}/{month}/{year}", dayfirst=True)
+    except Exception:
+        return pd.NaT
+
+
+def get_media_table_from_code(code, columns=None):
+    """Messages table of a medium with compact dtypes, only `columns` of it when given (see `read_messages_table`).
+    When the memory-mapped message arena holds these columns of the current csv, they are taken from it instead of
+    parsing the csv, which in worker processes means reading the page cache shared by all of them.
+    """
+    messages_file = meta_data[meta_data['id']==code]['messages'].values[0]
+    with TRACER.span("load", media=code) as span:
+        arena = get_message_arena()
+        if columns is not None and arena.covers(code, columns, file_version(messages_file)):
+            table = arena.table(code, columns)
+            span.set(source="arena")
+        else:
+            table = read_messages_table(messages_file, columns)
+            span.add(bytes_read=os.path.getsize(messages_file))
+        span.add(rows_out=len(table))
+        span.set(memory_bytes=table_memory(table))
+    return table
+
+
+def get_filtered_media_table(code, start_date, end_date, cache=None, columns=None):
+    """Date-filtered messages table of a medium, served from a `MediaTableCache` (with all columns) when one is given.
+    From the message arena, the dates are compared on its memory-mapped timestamps and only the messages in the range
+    are copied into the table.
+    """
+    if cache is not None:
+        return cache.filtered(code, start_date, end_date)
     messages_file = meta_data[meta_data['id']==code]['messages'].values[0]
-    return pd.read_csv(messages_file)
+    arena = get_message_arena()
+    if columns is not None and arena.covers(code, columns, file_version(messages_file)):
+        with TRACER.span("load", media=code, source="arena", start_date=start_date, end_date=end_date) as span:
+            start_ts, end_ts = _timestamp_range(start_date, end_date)
+            timestamps = arena.column('timestamp', code)
+            table = arena.table(code, columns, rows=(timestamps >= start_ts) & (timestamps < end_ts))
+            span.add(rows_in=len(timestamps), rows_out=len(table))
+            span.set(memory_bytes=table_memory(table))
+        return table
+    return filter_dataframe_by_date(get_media_table_from_code(code, columns), start_date, end_date)
 
 
 def get_media_name_from_code(code):
     return meta_data[meta_data['id']==code]['name'].values[0]
 
 
+def new_media_cache(max_entries=12):
+    """Warm cache of tables, date-filtered views and search indexes for long running processes (GUI, server)."""
+    def load_index(code, table):
+        with TRACER.span("index", media=code):
+            return get_media_index(code, table, version=_data_version(code))
+    return MediaTableCache(get_media_table_from_code, filter_dataframe_by_date, load_index, max_entries=max_entries)
+
+
+def get_posting_index(codes, cache=None):
+    """Hashtag / mention / domain postings, with the media of `codes` missing from them added once and saved."""
+    with TRACER.span("load", media=len(codes)):
+        postings = load_posting_index()
+        missing = [code for code in codes if code not in postings]
+        for code in missing:
+            postings.add_messages(code, get_media_table_from_code(code) if cache is None else cache.table(code))
+        if missing:
+            postings.save()
+    return postings
+
+
+def get_reaction_matrix(codes, cache=None):
+    """Message x emoji reaction counts, with the media of `codes` missing from them added once and saved."""
+    with TRACER.span("load", media=len(codes)):
+        reactions = load_reaction_matrix()
+        missing = [code for code in codes if code not in reactions]
+        for code in missing:
+            reactions.add_messages(code, get_media_table_from_code(code) if cache is None else cache.table(code))
+        if missing:
+            reactions.save()
+    return reactions
+
+
+def keyword_keys(keywords):
+    """Posting keys a search keyword may match: the word as a hashtag, or the keyword itself if it is a #tag or @mention."""
+    keys = []
+    for keyword in keywords:
+        keyword = keyword.strip().lower()
+        if keyword:
+            keys.append(keyword if keyword[0] in "#@" else "#" + keyword.replace(" ", "_"))
+    return keys
+
+
 class SpecificMediaAnalysis:
-    def __init__(self, prompt, media_idx, start_date=None, end_date=None):
+    MAP_PAUSE = 25  # seconds between map calls when no shared rate limiter paces them
+    COLUMNS = ['message_id', 'reply_to_message_id', 'cleaned_text', 'reactions', 'persian_letters', 'est_tokens', 'timestamp', 'spam_score']
+
+    def __init__(self, prompt, media_idx, start_date=None, end_date=None, cache=None, spam_threshold=SPAM_THRESHOLD):
         self.prompt = prompt
+        self.media_idx = media_idx
+        self.spam_threshold = spam_threshold
         self.messages_file = meta_data[meta_data['id']==media_idx]['messages'].values[0]
-        self.media_content = pd.read_csv(self.messages_file)
         self.media_type = meta_data[meta_data['id']==media_idx]['type'].values[0]
         
         if start_date is None:
             start_date = '01/01/00'   # 01/01/2000
         if end_date is None:
             end_date = '01/01/30'
-        self.media_content = filter_dataframe_by_date(self.media_content, start_date, end_date)        
+        self.media_content = get_filtered_media_table(media_idx, start_date, end_date, cache, self.COLUMNS)
+        self.reactions = get_reaction_matrix([media_idx], cache)
 
         self.prompt_header = f"I want you to perform a telegram analysis based on an input prompt. Below is first the input prompt and then the "\
                              f"messages sent to that media. The media is infact a telegram {self.media_type}. The messages might be a chunk of all messages ."\
                              f"I truncated to prevent a long input."
         self.prompt_channel_format = f"Each row is a message sent to this channel. The format of input in each row is like this:\n"\
                                      f"Message : message_id--message_text--reactions_to_message\n"
-        self.prompt_group_format = f"Each row is a message sent to this group. The format of input in each row is like this:\n"\
-                                   f"Message : message_id--message_text--reactions_to_message\n"
+        self.prompt_group_format = f"Each row is a message sent to this group. Messages are grouped into conversation threads: every reply "\
+                                   f"comes right after the message it answers, indented one level deeper. The format of input in each row is like this:\n"\
+                                   f"Message : message_id--message_text--reactions_to_message\n"\
+                                   f"Reply to replied_message_id : message_id--message_text--reactions_to_message\n"
         self.prompt_footer = f"**Please perform the request analysis in maximum 500 words in one Persian language paragraph**.\n"
 
 
-    def run(self):
+    def run(self, control=NO_CONTROL):
         # Generate chunks
         print("[Runtime Log] -- Request anlysis started on pipeline 1.")
         print("[Runtime Log] -- Generating chunks ...")
-        chunks = []
-        chunk = self.prompt_header
-        chunk = chunk + self.prompt_channel_format if self.media_type == 'channel' else self.prompt_group_format
-        chunk = chunk + f"\n\n**User prompt : {self.prompt} **\n\nMessages:\n" 
-        for i in tqdm(range(len(self.media_content))):
-            row = self.media_content.iloc[i]
-            if not isinstance(row['cleaned_text'], str):
-                continue
-            if count_persian_letters(row['cleaned_text']) < 20:
-                continue
-            chunk = chunk + self._update_chunk_for_prompt(row) + '\n'
-            if len(chunk) >= 200_000:
-                chunks.append(chunk + f'\n\n{self.prompt_footer}')
-                chunk = self.prompt_header
-                chunk = chunk + self.prompt_channel_format if self.media_type == 'channel' else self.prompt_group_format
-                chunk = chunk + f"\n\n**User prompt : {self.prompt} **\n\nMessages:\n" 
+        chunks, _ = self._build_chunks(control)
         print(f"[Runtime Log] -- Number of chunks : {len(chunks)}")
 
         # Generate Response
-        ## Reduce the number of the chunks to decrease llms api calling (just for development)
-        develop_mode = True
-        selected_chunks = sample(chunks, 5) if len(chunks) > 5 else chunks
-        selected_chunks = selected_chunks if develop_mode else chunks
         print(f"[Runtime Log] -- Calling LLM Api. Please wait.")
-        responses = []
+        responses = [] if control.batch is None else control.batch.map(chunks, control)
+        os.makedirs(os.path.join(dir_root, 'logs'), exist_ok=True)
         with open(os.path.join(dir_root, 'logs', '.pl1_cached.txt'), 'a') as f, open(os.path.join(dir_root, 'logs', '.pl1_responses.txt'), 'w') as g:
-            for chunk in tqdm(selected_chunks):
-                response = call_llm(chunk)
-                time.sleep(25)
-                responses.append(response)
+            for i, chunk in enumerate(tqdm(chunks)):
+                if control.batch is None:
+                    control.progress("llm_map", i, len(chunks))
+                    with TRACER.span("llm_map"):
+                        response = call_llm(chunk, cancel_event=control.cancel_event, limiter=control.limiter, raise_errors=control.raise_llm_errors)
+                    control.partial(i, response)
+                    control.sleep(self.MAP_PAUSE)
+                    responses.append(response)
+                response = responses[i]
                 f.write(f"[INPUT]\n{chunk}\n[OUTPUT]\n{response}\n[END]\n")
                 g.write(f"{response}\n")
         
         ## Generate final response
         print(f"[Runtime Log] -- Generating Final Response.")
-        final_prompt = f"I want to perform an analysis on a telegram {self.media_content}. Below is first the required analysis and then the partial analysis.\n\n"\
+        final_prompt = self._build_final_prompt(responses)
+        control.progress("reduce", 0, 1)
+        with TRACER.span("reduce", partials=len(responses)):
+            final_output = call_llm(final_prompt, on_token=control.on_token, cancel_event=control.cancel_event,
+                                    limiter=control.limiter, raise_errors=control.raise_llm_errors)
+        with open(os.path.join(dir_root, 'logs', '.pl1_cached.txt'), 'a') as f:
+            f.write(f"[INPUT]\n{final_prompt}\n[OUTPUT]\n{final_output}\n[END]\n")
+
+        return final_output
+
+    def plan(self, target_seconds=None, limiter=None):
+        """Estimated cost of `run()` (a RunPlan): loads, filters and chunks like it, without calling the LLM.
+        With `target_seconds`, suggests how many chunks, or from which start date, a run fits in it.
+        """
+        chunks, candidates = self._build_chunks(NO_CONTROL)
+        plan = RunPlan("specific", messages=self._n_sent, chunks=len(chunks))
+        plan.add_calls(chunks, self.MAP_PAUSE, limiter, map_calls=True)
+        plan.add_calls([estimate_tokens(self._build_final_prompt([])) + len(chunks) * MAX_RESPONSE_TOKENS], limiter=limiter)
+        return plan.suggest(target_seconds, candidates['timestamp'].to_numpy(), self._format_rows_for_prompt(candidates).str.len().to_numpy())
+
+    def _build_chunks(self, control):
+        """Map prompts of the run, and the candidate messages (text and spam filtered) they were selected from."""
+        ## Reduce the number of messages to decrease llms api calling (just for development). Instead of sampling whole chunks
+        ## at random, a diverse and engagement-weighted subset of messages that fits into `max_chunks` chunks is selected.
+        develop_mode = True
+        max_chunks = 5
+        content = self.media_content
+        chunk_prefix = self.prompt_header
+        chunk_prefix = chunk_prefix + (self.prompt_channel_format if self.media_type == 'channel' else self.prompt_group_format)
+        chunk_prefix = chunk_prefix + f"\n\n**User prompt : {self.prompt} **\n\nMessages:\n"
+        content = content[valid_text_mask(content, 20)]
+        content = candidates = content[~spam_mask(content, self.spam_threshold)]
+        if develop_mode:
+            control.progress("select", 0, 1)
+            with TRACER.span("select", rows_in=len(content)) as span:
+                costs = self._format_rows_for_prompt(content).str.len()
+                selected_rows = select_messages(content['cleaned_text'].tolist(), max_chunks * (200_000 - len(chunk_prefix)),
+                                                costs=costs.to_numpy(), engagement=self.reactions.engagement_of(self.media_idx, content.index, relative=True))
+                content = content.iloc[selected_rows]
+                span.add(rows_out=len(content))
+            print(f"[Runtime Log] -- Selected {len(content)} diverse messages out of {len(self.media_content)}.")
+        if self.media_type == 'group':
+            # replies are sent with the messages they answer, even short ones the text filter dropped
+            threads = ThreadIndex(self.media_content)
+            content = self.media_content.iloc[threads.with_ancestors(self.media_content.index.get_indexer(content.index))]
+
+        with TRACER.span("chunk", rows_in=len(content)) as span:
+            if self.media_type == 'group':
+                threads = ThreadIndex(content)
+                order = threads.thread_order()
+                lines = self._format_thread_rows_for_prompt(content.iloc[order], threads.depth[order])
+                chunks = build_thread_chunks(lines, threads.root[order], chunk_prefix, f'\n\n{self.prompt_footer}', limit=200_000)
+            else:
+                lines = self._format_rows_for_prompt(content)
+                chunks = build_chunks(lines, chunk_prefix, f'\n\n{self.prompt_footer}', limit=200_000)
+            span.set(chunks=len(chunks))
+        self._n_sent = len(content)
+        return chunks, candidates
+
+    def _build_final_prompt(self, responses):
+        final_prompt = f"I want to perform an analysis on a telegram {self.media_type}. Below is first the required analysis and then the partial analysis.\n\n"\
         f"** User required analysis : {self.prompt} **\n\n And below are the partial analysis which have benn already performed on various data of this media.\n\n"\
         f"Partial analysis:\n"
         for i, response in enumerate(responses):
             final_prompt += f"{i+1}) {response}\n\n"
-        final_prompt = final_prompt + "**Please conclude these partial analysis into a final and complete one and write a paragraph of maximum 800 words in Persian.**"        
-        final_output = call_llm(final_prompt)
-        with open(os.path.join(dir_root, 'logs', '.pl1_cached.txt'), 'a') as f:
-            f.write(f"[INPUT]\n{final_prompt}\n[OUTPUT]\n{final_output}\n[END]\n")
+        return final_prompt + "**Please conclude these partial analysis into a final and complete one and write a paragraph of maximum 800 words in Persian.**"
 
-        return final_output
-    
+    def _format_rows_for_prompt(self, table):
+        # Same row format for channels and groups: `Message : message_id--message_text--reactions_to_message`
+        return 'Message : ' + table['message_id'].map(str) + '--' + table['cleaned_text'].str.replace(new_line_token, '') \
+               + '--' + table['reactions'].map(str) + '\n'
 
-    def _update_chunk_for_prompt(self, row_seris):
-        if self.media_type == 'channel':
-            return f'Message : {row_seris["message_id"]}--{row_seris["cleaned_text"].replace(new_line_token, "")}--{row_seris["reactions"]}'
-        else:
-            return f'Message : {row_seris["message_id"]}--{row_seris["cleaned_text"].replace(new_line_token, "")}--{row_seris["reactions"]}'
+    def _format_thread_rows_for_prompt(self, table, depths):
+        # Rows in thread order; a reply is indented by its depth: `Reply to replied_message_id : message_id--message_text--reactions`
+        indents = pd.Series(np.minimum(depths, 8), index=table.index).map(lambda depth: '  ' * depth)
+        replied = pd.to_numeric(table['reply_to_message_id'], errors="coerce").map(lambda v: '' if pd.isna(v) else str(int(v)))
+        heads = ('Reply to ' + replied + ' : ').where(pd.Series(depths > 0, index=table.index), 'Message : ')
+        return indents + heads + table['message_id'].map(str) + '--' + table['cleaned_text'].fillna('').str.replace(new_line_token, '') \
+               + '--' + table['reactions'].map(str) + '\n'
 
 
 class TopicOriented:
-    def __init__(self, prompt, media_codes: list, keywords: list = None, start_date = None, end_date = None):
+    """Analysis of a topic across several media: retrieve the relevant messages of each medium, analyse each medium
+    with one LLM call (map) and conclude them (reduce).
+    With `parallel=True` nothing is loaded up front. `run()` fans loading and retrieval out over `max_workers`
+    processes, so at most that many tables are in memory, or over threads on the `cache` when one is given.
+    Each medium is analysed as soon as its messages are retrieved, concurrently under the shared LLM_RATE_LIMITER.
+    Every `reduce_fanin` partial results are merged into one while the rest are still running, which keeps the
+    final reduce prompt small.
+    """
+    MAP_PAUSE = 30
+    KEYWORDS_PAUSE = 20
+    COLUMNS = ['cleaned_text', 'token_count', 'est_tokens', 'engagement', 'timestamp', 'spam_score']
+
+    def __init__(self, prompt, media_codes: list, keywords: list = None, start_date = None, end_date = None, retrieval='semantic', n_probe=8,
+                 cache=None, parallel=False, max_workers=4, reduce_fanin=8, spam_threshold=SPAM_THRESHOLD):
         self.prompt = prompt
         self.media_codes = media_codes
         self.keywords = keywords
+        self.retrieval = retrieval  # 'semantic' (local vector index) or 'keyword' (exact word overlap)
+        self.n_probe = n_probe
+        self.cache = cache
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self.reduce_fanin = reduce_fanin
+        self.spam_threshold = spam_threshold
         
         if start_date is None:
             start_date = '01/01/00'   # 01/01/2000
         if end_date is None:
             end_date = '01/01/30'
+        self.start_date, self.end_date = start_date, end_date
+        self.postings = get_posting_index(media_codes, cache)
 
         self.media_contents = {}
-        for code in media_codes:
-            self.media_contents[code] = (get_media_name_from_code(code), filter_dataframe_by_date(get_media_table_from_code(code), start_date=start_date, end_date=end_date))
+        self.media_indexes = {}
+        for code in ([] if parallel else media_codes):
+            if cache is not None:
+                if self.retrieval == 'semantic':
+                    self.media_indexes[code] = cache.index(code)
+                self.media_contents[code] = (get_media_name_from_code(code), cache.filtered(code, start_date, end_date))
+                continue
+            if self.retrieval == 'semantic':
+                with TRACER.span("index", media=code):
+                    # the whole medium is loaded only to (re)build its index
+                    self.media_indexes[code] = get_media_index(code, lambda code=code: get_media_table_from_code(code, ['cleaned_text']),
+                                                               version=_data_version(code))
+            self.media_contents[code] = (get_media_name_from_code(code), get_filtered_media_table(code, start_date, end_date, columns=self.COLUMNS))
 
 
-    def run(self):
+    def run(self, control=NO_CONTROL):
         # Prepare keywords
         print("[Runtime Log] -- Requested anlysis started on pipeline 2.")
         if self.keywords is None:
             print("[Runtime Log] -- Extracting keywords for searching documents.")         
-            self.keywords = self._build_keywords_from_prompt(self.prompt)
+            control.progress("keywords", 0, 1)
+            self.keywords = self._build_keywords_from_prompt(self.prompt, control)
+        if self.parallel and control.batch is None:
+            return self._run_parallel(control)
 
         # Retrive documents
         print("[Runtime Log] -- Retriving relavant documents")
         information_retrived = []
-        for _, (name, table) in tqdm(self.media_contents.items()):
-            queris = self._retrive_information_from_table(self.keywords, table, n=200)
-            information_retrived.append((name, queris))
+        media_codes = list(dict.fromkeys(self.media_codes))
+        for i, code in enumerate(tqdm(media_codes)):
+            control.progress("retrieve", i, len(media_codes))
+            if code in self.media_contents:
+                information_retrived.append(self._retrieve(code, n=200))
+            else:  # parallel pipeline sending its map prompts as a batch: nothing was loaded up front
+                information_retrived.append(_retrieve_topic_messages(self.prompt, code, self.keywords, self.start_date, self.end_date,
+                                                                     self.retrieval, self.n_probe, self.cache, self.spam_threshold))
 
         # Building prompts
-        prompts = []
-        for name, data in information_retrived:
-            prompt = f"I want you to perform an anlysis on a telegram media called: {name} based on a user input prompt and some selected content/messages sent to this media.\n\n"\
-            f"**User prompt: {self.prompt}**\n\nMessages:\n"
-            for i, message in enumerate(data[len(data)-1:0:-1]):
-                prompt = prompt + f'{i+1}) {message}\n'
-                if len(prompt) > 200_000:
-                    break
-            prompts.append(prompt + '\n**Please perform the requested analysis in one Persian paragraph in maximum 1000 words.**')
+        with TRACER.span("chunk") as span:
+            prompts = [self._build_media_prompt(name, data) for name, data in information_retrived]
+            span.set(chunks=len(prompts))
         
         # Calling llm
-        responses = []
         print("[Runtime Log] -- Calling LLM Api ...")
-        for prompt in tqdm(prompts):
-            response = call_llm(prompt)
+        responses = [] if control.batch is None else control.batch.map(prompts, control)
+        for i, prompt in enumerate(tqdm(prompts if control.batch is None else [])):
+            control.progress("llm_map", i, len(prompts))
+            with TRACER.span("llm_map"):
+                response = call_llm(prompt, cancel_event=control.cancel_event, limiter=control.limiter, raise_errors=control.raise_llm_errors)
+            control.partial(i, response)
             responses.append(response)
-            time.sleep(30)
+            control.sleep(self.MAP_PAUSE)
 
         # Generate final output
         print("[Runtime Log] -- Generating final output ...")
+        control.progress("reduce", 0, 1)
+        with TRACER.span("reduce", partials=len(responses)):
+            final_output = call_llm(self._build_reduce_prompt(responses), on_token=control.on_token, cancel_event=control.cancel_event,
+                                    limiter=control.limiter, raise_errors=control.raise_llm_errors)
+        return final_output
+
+
+    def plan(self, target_seconds=None, limiter=None):
+        """Estimated cost of `run()` (a RunPlan) without calling the LLM: retrieves the messages of every medium like it
+        and counts one map call per medium plus the reduce (and, in parallel, the merge) calls. Without `keywords` the
+        keyword call is counted and the words of the prompt stand in for its keywords during retrieval.
+        """
+        plan = RunPlan("topic")
+        keywords = self.keywords
+        if keywords is None:
+            plan.add_calls([self._keywords_prompt(self.prompt)], 0 if self.parallel else self.KEYWORDS_PAUSE, limiter)
+            keywords = self.prompt.split()
+        if self.parallel:
+            limiter = limiter or LLM_RATE_LIMITER
+            retrieved = [_retrieve_topic_messages(self.prompt, code, keywords, self.start_date, self.end_date, self.retrieval,
+                                                  self.n_probe, self.cache, self.spam_threshold) for code in self.media_codes]
+        else:
+            retrieved = [self._retrieve(code, n=200, keywords=keywords) for code in self.media_contents]
+        prompts = [self._build_media_prompt(name, data) for name, data in retrieved]
+        plan.messages, plan.chunks = sum(len(data) for _, data in retrieved), len(prompts)
+        plan.add_calls(prompts, 0 if self.parallel else self.MAP_PAUSE, limiter, map_calls=True)
+        header = estimate_tokens(self._build_reduce_prompt([], final=False))
+        partials = len(prompts)
+        if self.parallel:
+            while partials > self.reduce_fanin:
+                plan.add_calls([header + self.reduce_fanin * MAX_RESPONSE_TOKENS], limiter=limiter)
+                partials -= self.reduce_fanin - 1
+        plan.add_calls([header + partials * MAX_RESPONSE_TOKENS], limiter=limiter)
+        return plan.suggest(target_seconds)
+
+
+    def _run_parallel(self, control):
+        print(f"[Runtime Log] -- Retriving and analysing {len(self.media_codes)} media in parallel.")
+        if self.cache is None:
+            # spawn: forking a process that runs a Qt event loop is unsafe
+            retrieval_pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            retrieval_pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        llm_pool = ThreadPoolExecutor(max_workers=LLM_CONFIG.max_concurrent_requests)
+        llm = lambda prompt: call_llm(prompt, cancel_event=control.cancel_event, limiter=LLM_RATE_LIMITER, raise_errors=control.raise_llm_errors)
+        pending = {}
+        for code in self.media_codes:
+            future = retrieval_pool.submit(_retrieve_topic_messages, self.prompt, code, self.keywords, self.start_date, self.end_date,
+                                           self.retrieval, self.n_probe, self.cache, self.spam_threshold)
+            pending[future] = "retrieve"
+        retrieved, n_partials, partials = 0, 0, []
+        try:
+            with TRACER.span("parallel_map", media=len(self.media_codes)):
+                while pending:
+                    done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                    control.check()
+                    for future in done:
+                        kind = pending.pop(future)
+                        if kind == "retrieve":
+                            name, data = future.result()
+                            retrieved += 1
+                            control.progress("retrieve", retrieved, len(self.media_codes))
+                            pending[llm_pool.submit(llm, self._build_media_prompt(name, data))] = "map"
+                        elif kind == "map":
+                            control.partial(n_partials, future.result())
+                            n_partials += 1
+                            partials.append(future.result())
+                            control.progress("llm_map", n_partials, len(self.media_codes))
+                        else:
+                            partials.append(future.result())
+                    # Merge groups of partials while others are still running; the last group goes to the final reduce.
+                    while len(partials) >= self.reduce_fanin and (pending or len(partials) > self.reduce_fanin):
+                        group, partials = partials[:self.reduce_fanin], partials[self.reduce_fanin:]
+                        pending[llm_pool.submit(llm, self._build_reduce_prompt(group, final=False))] = "merge"
+        finally:
+            retrieval_pool.shutdown(wait=False, cancel_futures=True)
+            llm_pool.shutdown(wait=False, cancel_futures=True)
+
+        print("[Runtime Log] -- Generating final output ...")
+        control.progress("reduce", 0, 1)
+        with TRACER.span("reduce", partials=len(partials)):
+            return call_llm(self._build_reduce_prompt(partials), on_token=control.on_token, cancel_event=control.cancel_event,
+                            limiter=LLM_RATE_LIMITER, raise_errors=control.raise_llm_errors)
+
+
+    def _retrieve(self, code, n=200, keywords=None):
+        keywords = self.keywords if keywords is None else keywords
+        name, table = self.media_contents[code]
+        table = table[~spam_mask(table, self.spam_threshold)]
+        with TRACER.span("retrieve", media=code, method=self.retrieval, rows_in=len(table)) as span:
+            seeds = self._retrive_information_from_postings(keywords, code, table, n=n // 2)
+            if self.retrieval == 'semantic':
+                queris = self._retrive_information_from_index(keywords, self.media_indexes[code], table, n=n)
+            else:
+                queris = self._retrive_information_from_table(keywords, table, n=n)
+            queris = list(dict.fromkeys(seeds + queris))[:n]
+            span.add(rows_out=len(queris))
+            span.set(seeded=len(seeds))
+        return name, queris
+
+
+    def _build_media_prompt(self, name, data):
+        prompt = f"I want you to perform an anlysis on a telegram media called: {name} based on a user input prompt and some selected content/messages sent to this media.\n\n"\
+        f"**User prompt: {self.prompt}**\n\nMessages:\n"
+        for i, message in enumerate(data[::-1]):
+            prompt = prompt + f'{i+1}) {message}\n'
+            if len(prompt) > 200_000:
+                break
+        return prompt + '\n**Please perform the requested analysis in one Persian paragraph in maximum 1000 words.**'
+
+
+    def _build_reduce_prompt(self, responses, final=True):
         final_prompt = f"I want you to conclude a requested analysis based on a user prompt. Below is first the user prompt (requested analysis) and then the partial analysis . Each "\
         f"partial analysis is the result of the analysis of the same prompt, but for a specifc media. I want you to conclude all these analysis and produce the final response to the prompt "\
         f"based on these partial analysis.\n\n**User prompt: {self.prompt}**\n\nPartial anlysis:\n"
         for i, response in enumerate(responses):
             final_prompt += f'{i+1}) {response}\n'
-        final_prompt += "\nPlease write a paragraph in Persian language with maximum 1500 words."
-        final_output = call_llm(final_prompt)
-        return final_output
+        if final:
+            return final_prompt + "\nPlease write a paragraph in Persian language with maximum 1500 words."
+        return final_prompt + "\nThese are only some of the media. Please merge them into one partial analysis in Persian with maximum 1000 words, "\
+                              "keeping the points specific to each media."
     
 
 
-    def _build_keywords_from_prompt(self, prompt):
-        prompt = f"I want to perform an analysis on telegram media. Please tell me the 5 best keywords to match the user prompt for keyword search inside the documents.\n\n**User prompt : {prompt}**\n\n"\
+    def _keywords_prompt(self, prompt):
+        return f"I want to perform an analysis on telegram media. Please tell me the 5 best keywords to match the user prompt for keyword search inside the documents.\n\n**User prompt : {prompt}**\n\n"\
         f"The output format must be like:\nkw_1,kw_2,kw_3,kw_4,kw_5\n\nDo not output any extra text. Just 5 Persian keywords for this prompt to search for."
-        keywords = call_llm(prompt)
+
+    def _build_keywords_from_prompt(self, prompt, control=NO_CONTROL):
+        prompt = self._keywords_prompt(prompt)
+        with TRACER.span("keywords"):
+            keywords = call_llm(prompt, cancel_event=control.cancel_event,
+                                limiter=LLM_RATE_LIMITER if self.parallel else control.limiter, raise_errors=control.raise_llm_errors)
         keywords = keywords.split(",")
-        time.sleep(20)
+        if not self.parallel:
+            control.sleep(self.KEYWORDS_PAUSE)
         return keywords
 
 
+    def _retrive_information_from_postings(self, keywords, code, table, n=100):
+        # Messages carrying a keyword as hashtag (or a #tag / @mention keyword), most engaging first, without reading any text.
+        rows = self.postings.rows_of(keyword_keys(keywords), code)
+        rows = rows[np.isin(rows, table.index.to_numpy())]
+        if not len(rows):
+            return []
+        seeds = table.loc[rows]
+        seeds = seeds[seeds["token_count"] > 0].sort_values("engagement", ascending=False, kind="stable").head(n)
+        return seeds["cleaned_text"].tolist()
+
     def _retrive_information_from_table(self, keywords, table, n=100):
         keyword_set = set([kw.lower() for kw in keywords])
         def score_text(text):
@@ -220,52 +554,93 @@ class TopicOriented:
             overlap = keyword_set.intersection(words)
             return min(len(overlap), 5)  # cap at 5
         
-        df = table.copy()
-        df["score"] = df["cleaned_text"].apply(score_text)
-        top_df = df[df["score"] > 0].sort_values("score", ascending=False).head(n)
-        return top_df["cleaned_text"].tolist()
+        scores = table["cleaned_text"].map(score_text)
+        top_rows = scores[scores > 0].sort_values(ascending=False).head(n).index
+        return table.loc[top_rows, "cleaned_text"].tolist()
+
+
+    def _retrive_information_from_index(self, keywords, index, table, n=100):
+        # Rows of the date-filtered table keep their original offsets as index, which are the index row ids.
+        has_text = (table["token_count"] > 0).to_numpy()
+        row_mask = np.zeros(len(index), dtype=bool)
+        row_mask[table.index.to_numpy()[has_text]] = True
+        queries = [kw.strip() for kw in keywords if kw.strip()] + [self.prompt]
+        rows, scores = index.search(queries, k=n, n_probe=self.n_probe, row_mask=row_mask)
+        best = {}
+        for row, score in zip(rows.ravel(), scores.ravel()):
+            if row >= 0 and score > best.get(row, -np.inf):
+                best[row] = score
+        top_rows = sorted(best, key=best.get, reverse=True)[:n]
+        return table.loc[top_rows, "cleaned_text"].tolist()
+
+
+def _retrieve_topic_messages(prompt, code, keywords, start_date, end_date, retrieval, n_probe, cache=None, spam_threshold=SPAM_THRESHOLD, n=200):
+    """Loads one medium and retrieves its messages for a topic. Runs in the worker processes of a parallel TopicOriented."""
+    pipeline = TopicOriented(prompt, [code], keywords, start_date, end_date, retrieval, n_probe, cache=cache, spam_threshold=spam_threshold)
+    return pipeline._retrieve(code, n)
 
 
 class TimeBasedOriented:
-    def __init__(self, prompt, media_idx, start_date, end_date, from_trend=False):
+    MAP_PAUSE = 60
+    COLUMNS = ['cleaned_text', 'persian_letters', 'est_tokens', 'timestamp', 'spam_score']
+
+    def __init__(self, prompt, media_idx, start_date, end_date, from_trend=False, cache=None, spam_threshold=SPAM_THRESHOLD):
         self.prompt = prompt 
-        self.media_content = get_media_table_from_code(media_idx)
-        self.media_content = filter_dataframe_by_date(self.media_content, start_date, end_date)
+        self.media_content = get_filtered_media_table(media_idx, start_date, end_date, cache, self.COLUMNS)
         self.from_trend = from_trend
+        self.spam_threshold = spam_threshold
 
-    def run(self):
+    def run(self, control=NO_CONTROL):
         if not self.from_trend:
             print("[Runtime Log] -- Requested anlysis started on pipeline 3.")
 
         # Generating prompts
         print("[Runtime Log] -- Retriving data...")
-        prompt_header = "I want you to perform an analysis on a telegram media based on a user input prompt (requested analysis) and the content/messages sent to "\
-        f"that media. The main goal is to determine what were the topics people usually talked about in telegram during a time period. Below is first the user prompt "\
-        f"and then the messages sent to the target media.\n\n**User prompt: {self.prompt}**\n\nMessages:\n"
-        prompts = []
-        prompt = prompt_header
-        for j, i in enumerate(range(len(self.media_content))):
-            text = self.media_content.iloc[i]['cleaned_text']
-            if not isinstance(text, str):
-                continue
-            if count_persian_letters(text) < 10:
-                continue
-            
-            prompt += f"{i+1}){text}\n"
-            if len(prompt) > 200_000:
-                prompts.append(prompt + "\n\n**Now please do the analysis the user want in one Persian paragraph with maximum 500 words**")
-                prompt = prompt_header
+        prompts, _, _ = self._build_prompts()
 
-            
         # Call llm
         print(f"[Runtime Log] -- Calling LLM Api ...")
-        responses = []
-        for prompt in tqdm(prompts):
-            response = call_llm(prompt)
+        responses = [] if control.batch is None else control.batch.map(prompts, control)
+        for i, prompt in enumerate(tqdm(prompts if control.batch is None else [])):
+            control.progress("llm_map", i, len(prompts))
+            with TRACER.span("llm_map"):
+                response = call_llm(prompt, cancel_event=control.cancel_event, limiter=control.limiter, raise_errors=control.raise_llm_errors)
+            control.partial(i, response)
             responses.append(response)
-            time.sleep(60)
+            control.sleep(self.MAP_PAUSE)
         
         # Generate final response
+        final_prompt = self._build_final_prompt(responses)
+        control.progress("reduce", 0, 1)
+        with TRACER.span("reduce", partials=len(responses)):
+            final_output = call_llm(final_prompt, on_token=control.on_token, cancel_event=control.cancel_event,
+                                    limiter=control.limiter, raise_errors=control.raise_llm_errors)
+        return final_output
+
+    def plan(self, target_seconds=None, limiter=None):
+        """Estimated cost of `run()` (a RunPlan): the same chunks, without calling the LLM."""
+        prompts, positions, lines = self._build_prompts()
+        plan = RunPlan("time", messages=len(positions), chunks=len(prompts))
+        plan.add_calls(prompts, self.MAP_PAUSE, limiter, map_calls=True)
+        plan.add_calls([estimate_tokens(self._build_final_prompt([])) + len(prompts) * MAX_RESPONSE_TOKENS], limiter=limiter)
+        return plan.suggest(target_seconds, self.media_content['timestamp'].to_numpy()[positions], lines.str.len().to_numpy())
+
+    def _build_prompts(self):
+        """Map prompts, and the positions and prompt lines of the messages they hold."""
+        prompt_header = "I want you to perform an analysis on a telegram media based on a user input prompt (requested analysis) and the content/messages sent to "\
+        f"that media. The main goal is to determine what were the topics people usually talked about in telegram during a time period. Below is first the user prompt "\
+        f"and then the messages sent to the target media.\n\n**User prompt: {self.prompt}**\n\nMessages:\n"
+        with TRACER.span("chunk", rows_in=len(self.media_content)) as span:
+            # Messages are numbered by their position in the date-filtered table, skipped rows included.
+            positions = np.flatnonzero(valid_text_mask(self.media_content, 10) & ~spam_mask(self.media_content, self.spam_threshold))
+            texts = self.media_content['cleaned_text'].iloc[positions].reset_index(drop=True)
+            lines = pd.Series(positions + 1).astype(str) + ")" + texts + "\n"
+            prompts = build_chunks(lines, prompt_header, "\n\n**Now please do the analysis the user want in one Persian paragraph with maximum 500 words**",
+                                   limit=200_000, inclusive=False, keep_last=False)
+            span.set(chunks=len(prompts))
+        return prompts, positions, lines
+
+    def _build_final_prompt(self, responses):
         final_prompt = "I want you to perform an analysis on a telegram media based on a user prompt and partial result. The partial results are the same analysis but on a "\
         f"smaller part of the whole data. I want you to conclude these partial results and tell what were the messages usually about in the target media. Below is first the "\
         f"user prompt and then the partial anlalysis:\n\n**User prompt: {self.prompt}**\n\n"
@@ -275,23 +650,138 @@ class TimeBasedOriented:
             final_prompt += "\n**Please perform the requested analysis in one Persian paragraph with maximum 300 words.**"
         else:
             final_prompt += "\n**Please detect the trend and hot topics based on the contents and finally list them. Your output must be in Persian language**"
-        final_output = call_llm(final_prompt)
-        return final_output
+        return final_prompt
 
 
 class TrendDetection:
-    def __init__(self, media_idx, start_date, end_date):
-        self.inner_tbo = TimeBasedOriented("لطفا ترند ها و موضوعات داغ رسانه {} را از درون محتوای آن استخراج کن و آنها را لیست کن . ", media_idx, start_date, end_date, from_trend=True)
-    def run(self):
+    """Trends and hot topics of a media in a date range.
+    mode='burst' (default) finds the bursting terms and hashtags statistically and only sends those, with a few
+    representative messages each, to the LLM: one call instead of one per 200k characters of messages.
+    mode='llm' lets the LLM read every message of the range (TimeBasedOriented).
+    mode='live' answers "what is hot now" from the streaming trend monitor, ignoring the dates; a media missing from
+    the monitor is added to it once.
+    Messages scored at or above `spam_threshold` are left out of the burst statistics and of the LLM's messages.
+    """
+    COLUMNS = ['cleaned_text', 'hashtags', 'est_tokens', 'engagement', 'timestamp', 'spam_score']
+
+    def __init__(self, media_idx, start_date, end_date, cache=None, mode='burst', top_terms=25, messages_per_term=5,
+                 spam_threshold=SPAM_THRESHOLD):
+        self.mode = mode
+        self.spam_threshold = spam_threshold
+        self.top_terms = top_terms
+        self.messages_per_term = messages_per_term
+        self.media_idx = media_idx
+        if mode == 'live':
+            self.media_name = get_media_name_from_code(media_idx)
+            with TRACER.span("load", media=media_idx):
+                self.monitor = load_trend_monitor()
+                if media_idx not in self.monitor:
+                    self.monitor.add_messages(media_idx, get_media_table_from_code(media_idx) if cache is None else cache.table(media_idx))
+                    self.monitor.save()
+        elif mode == 'llm':
+            self.inner_tbo = TimeBasedOriented("لطفا ترند ها و موضوعات داغ رسانه {} را از درون محتوای آن استخراج کن و آنها را لیست کن . ", media_idx, start_date, end_date,
+                                               from_trend=True, cache=cache, spam_threshold=spam_threshold)
+        else:
+            self.media_name = get_media_name_from_code(media_idx)
+            self.media_content = get_filtered_media_table(media_idx, start_date, end_date, cache, self.COLUMNS)
+            self.start_date, self.end_date = _parse_filter_date(start_date), _parse_filter_date(end_date)
+            self.postings = get_posting_index([media_idx], cache)
+
+    def run(self, control=NO_CONTROL):
         print("[Runtime Log] -- Requested anlysis started on pipeline 4.")
-        return self.inner_tbo.run()
+        if self.mode == 'llm':
+            return self.inner_tbo.run(control)
+        if self.mode == 'live':
+            return self._run_live(control)
+
+        control.progress("bursts", 0, 1)
+        prompt, n_bursts = self._build_burst_prompt()
+        if prompt is None:
+            return "در این بازه زمانی موضوع داغی یافت نشد."
+        control.progress("reduce", 0, 1)
+        with TRACER.span("reduce", partials=n_bursts):
+            return call_llm(prompt, on_token=control.on_token, cancel_event=control.cancel_event,
+                            limiter=control.limiter, raise_errors=control.raise_llm_errors)
+
+    def plan(self, target_seconds=None, limiter=None):
+        """Estimated cost of `run()` (a RunPlan) without calling the LLM; mode='llm' plans the inner TimeBasedOriented."""
+        if self.mode == 'llm':
+            plan = self.inner_tbo.plan(target_seconds, limiter)
+            plan.pipeline = "trend"
+            return plan
+        prompt, n_terms = self._build_live_prompt() if self.mode == 'live' else self._build_burst_prompt()
+        plan = RunPlan("trend", messages=n_terms)
+        if prompt is not None:
+            plan.add_calls([prompt], limiter=limiter)
+        return plan.suggest(target_seconds)
+
+    def _build_burst_prompt(self):
+        """The one prompt of the burst mode and the number of bursting terms in it, (None, 0) without bursts."""
+        content = self.media_content[~spam_mask(self.media_content, self.spam_threshold)]
+        with TRACER.span("bursts", rows_in=len(content)) as span:
+            detector = BurstDetector().fit(content)
+            bursts = detector.top_bursts(k=self.top_terms)
+            examples = detector.representative_messages(bursts, per_term=self.messages_per_term)
+            span.add(rows_out=sum(len(texts) for texts in examples.values()))
+        print(f"[Runtime Log] -- {len(bursts)} bursting terms found (window of {detector.window // 3600} hours).")
+        if len(bursts) == 0:
+            return None, 0
+
+        prompt = f"I want you to detect the trends and hot topics of a telegram media called {self.media_name}. Below are the terms and hashtags whose "\
+        f"usage burst in a time window compared to the windows before it, strongest burst first, each with some of the most engaging messages "\
+        f"that contain it in that window.\n\n"
+        for i, row in enumerate(bursts.itertuples()):
+            prompt += f"{i+1}) {row.term} -- {row.window_start:%d/%m/%Y %H:%M} to {row.window_end:%d/%m/%Y %H:%M} -- "\
+                      f"{row.count} of {row.messages} messages (z={row.z:.1f})\n"
+            for text in examples[row.term]:
+                prompt += f"   - {str(text).replace(new_line_token, ' ')[:1000]}\n"
+        hashtags = self.postings.top_keys(self.media_idx, self.start_date, self.end_date, kind="hashtag", k=10)
+        if len(hashtags):
+            prompt += "\nMost used hashtags of this media in the same period, with the number of other media that used them too:\n"
+            for row in hashtags.itertuples():
+                spread = self.postings.postings(row.key, start_date=self.start_date, end_date=self.end_date)["media"].nunique()
+                prompt += f"- {row.key} -- {row.messages} messages, {spread - 1} other media\n"
+        prompt += "\n**Please group these bursts into trends and hot topics, explain each one briefly and finally list them. Your output must be in Persian language**"
+        return prompt, len(bursts)
+
+    def _run_live(self, control):
+        control.progress("bursts", 0, 1)
+        prompt, n_emerging = self._build_live_prompt()
+        if prompt is None:
+            return "در حال حاضر موضوع داغی یافت نشد."
+        control.progress("reduce", 0, 1)
+        with TRACER.span("reduce", partials=n_emerging):
+            return call_llm(prompt, on_token=control.on_token, cancel_event=control.cancel_event,
+                            limiter=control.limiter, raise_errors=control.raise_llm_errors)
+
+    def _build_live_prompt(self):
+        with TRACER.span("bursts") as span:
+            emerging = self.monitor.emerging(self.media_idx, k=self.top_terms)
+            span.add(rows_out=len(emerging))
+        print(f"[Runtime Log] -- {len(emerging)} emerging terms in the live window.")
+        if len(emerging) == 0:
+            return None, 0
+
+        window = self.monitor.windows[int(self.media_idx)]
+        prompt = f"I want you to detect what is hot right now in a telegram media called {self.media_name}. Below are the terms, hashtags and "\
+        f"links used far more in its latest messages (since {window.window_start:%d/%m/%Y %H:%M}) than before, strongest first, with how "\
+        f"often they were seen recently and how often they would be expected.\n\n"
+        for i, row in enumerate(emerging.itertuples()):
+            prompt += f"{i+1}) {row.term} -- {row.recent} times, expected {row.expected:.1f} (z={row.z:.1f})\n"
+        prompt += "\n**Please group these terms into the current hot topics, explain each one briefly and finally list them. Your output must be in Persian language**"
+        return prompt, len(emerging)
 
 
 class IndividualPersonAnalysis:
-    def __init__(self, prompt, media_idx, user_id):
+    COLUMNS = ['sender_id', 'cleaned_text', 'token_count', 'est_tokens', 'engagement', 'spam_score']
+
+    def __init__(self, prompt, media_idx, user_id, cache=None, spam_threshold=SPAM_THRESHOLD):
         self.prompt = prompt
+        self.spam_threshold = spam_threshold
         self.user_id = user_id
         self.media_idx = media_idx
+        self.cache = cache
+        self.user_engagement = None
         #dir_root = dirname(dirname(abspath(__file__)))
         #users_file = os.path.join(dir_root, "media", "users.pkl")
         #if not os.path.exists(users_file):
@@ -302,95 +792,223 @@ class IndividualPersonAnalysis:
         #    self.users = pickle.load(f)
 
     def extract_user_messages(self, media_idx, user_id):
-        table = get_media_table_from_code(media_idx)
-        rows = table[table["sender_id"] == user_id]['cleaned_text']
-        return rows.tolist()
+        table = get_media_table_from_code(media_idx, self.COLUMNS) if self.cache is None else self.cache.table(media_idx)
+        rows = table[table["sender_id"] == user_id]
+        rows = rows[rows['token_count'] > 0]
+        rows = rows[~spam_mask(rows, self.spam_threshold)]
+        self.user_engagement = rows['engagement'].to_numpy()
+        return rows['cleaned_text'].tolist()
     
-    def run(self):
+    def run(self, control=NO_CONTROL):
         print("[Runtime Log] -- Extracting user meesages ... ")
+        control.progress("select", 0, 1)
+        prompt, _ = self._build_prompt()
+
+        print("[Runtime Log] -- Calling LLM Api ...")
+        control.progress("reduce", 0, 1)
+        with TRACER.span("reduce"):
+            final_output = call_llm(prompt, on_token=control.on_token, cancel_event=control.cancel_event,
+                                    limiter=control.limiter, raise_errors=control.raise_llm_errors)
+        return final_output
+
+    def plan(self, target_seconds=None, limiter=None):
+        """Estimated cost of `run()` (a RunPlan): one call with the selected messages of the user."""
+        prompt, n_messages = self._build_prompt()
+        return RunPlan("individual", messages=n_messages).add_calls([prompt], limiter=limiter).suggest(target_seconds)
+
+    def _build_prompt(self):
         user_messages = self.extract_user_messages(self.media_idx, self.user_id)
         print(f"[Runtime Log] -- Total number of the user messages: {len(user_messages)}")
         prompt = f"I want you to analyse person by the messages he/she has sent to a telegram group based on a user input prompt. Below is "\
         f"first the user prompt and then the messages this user has sent to the group.\n\n**User prompt: {self.prompt}**\n\nMessages of this person:\n"
 
-        user_messages = sample(user_messages, min(1000, len(user_messages)))
+        with TRACER.span("select", rows_in=len(user_messages)) as span:
+            selected_rows = select_messages(user_messages, 1000, engagement=self.user_engagement)
+            user_messages = [user_messages[i] for i in selected_rows]
+            span.add(rows_out=len(user_messages))
         for i, m in enumerate(user_messages):
             prompt += f"{i+1}){m}\n"
         prompt += "\n**Please perform the required analysis on this user in one Persian Paragraph with maximum 500 words**"
-
-        print("[Runtime Log] -- Calling LLM Api ...")
-        final_output = call_llm(prompt)
-        return final_output
+        return prompt, len(user_messages)
 
 
 class StatisticalInformation:
-    def __init__(self, media_idx):
+    """Charts of one media, a list of media (`media_idx` may be a list) or, with `media_idx=None`, of the whole corpus.
+    All statistics come from the pre-aggregated activity cube; media missing from it are added once and saved.
+    """
+    def __init__(self, media_idx, start_date=None, end_date=None):
         self.media_idx = media_idx
-        self.media_name = get_media_name_from_code(media_idx)
-        self.media_content = get_media_table_from_code(media_idx)
-        self.build_time_histogram()
-        self.plot_date_charts()
+        self.media_ids = None if media_idx is None else [int(code) for code in np.atleast_1d(media_idx)]
+        self.media_name = "All media" if media_idx is None else " / ".join(get_media_name_from_code(code) for code in self.media_ids)
+        self.start_date = None if start_date is None else _parse_filter_date(start_date)
+        self.end_date = None if end_date is None else _parse_filter_date(end_date)
+        with TRACER.span("load", media=media_idx) as span:
+            self.cube = load_activity_cube()
+            missing = [code for code in (self.media_ids or []) if code not in self.cube]
+            for code in missing:
+                self.cube.add_messages(code, get_media_table_from_code(code))
+            if missing:
+                self.cube.save()
+            span.add(bytes_read=os.path.getsize(activity_cube_file))
+        with TRACER.span("render", media=media_idx):
+            self.charts = {}
+            self.build_time_histogram()
+            self.plot_date_charts()
+
+    def _request_chart(self, chart_type, data):
+        return get_chart_service().request(self.media_ids, chart_type, self.start_date, self.end_date,
+                                           self.cube.data_version(self.media_ids), data)
 
     def build_time_histogram(self, bins=24):
-        output_path = os.path.join(dir_root, 'application', 'resources', 'time_distro.png')
-        times = pd.to_datetime(self.media_content["time"], format="%H:%M:%S", errors="coerce").dt.hour
-        times = times.dropna()
-        sns.set_theme(style="darkgrid")
-        plt.figure(figsize=(10, 6))
-        sns.histplot(times, bins=24, kde=False, color=sns.color_palette("magma", 24)[10])
-        plt.title("Distribution of Times (by Hour)", fontsize=18, weight='bold', color="#333333")
-        plt.xlabel("Hour of Day (0–23)", fontsize=14)
-        plt.ylabel("Frequency", fontsize=14)
-        plt.xticks(range(24))
-        plt.yticks(fontsize=12)
-        plt.tight_layout()
-        plt.savefig(output_path, dpi=300)
-        plt.close()
-        print(f"✅ Histogram saved as {output_path}")
-
-    def plot_date_charts(self, output_prefix="date_charts"):
-        df = self.media_content
-        if "date" not in df.columns:
-            raise ValueError("The dataframe must contain a 'date' column.")
-        dates = pd.to_datetime(df["date"], format="%d/%m/%y", errors="coerce")
-        df = df.assign(year=dates.dt.year, month=dates.dt.month, month_year=dates.dt.to_period("M"))
-        sns.set_theme(style="whitegrid")
-        plt.figure(figsize=(6, 6))
-        df["year"].value_counts().sort_index().plot.pie(autopct="%1.1f%%", colors=sns.color_palette("tab20"))
-        plt.title("Distribution of Years")
-        plt.ylabel("")
-        plt.tight_layout()
-        plt.savefig(os.path.join(dir_root, "application", "resources", f"{output_prefix}_years_pie.png"), dpi=300)
-        plt.close()
-        plt.figure(figsize=(6, 6))
-        df["month"].value_counts().sort_index().reindex(range(1, 13), fill_value=0).plot.pie(
-            autopct="%1.1f%%", labels=["Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"],
-            colors=sns.color_palette("tab20c"))
-        plt.title("Distribution of Months")
-        plt.ylabel("")
-        plt.tight_layout()
-        plt.savefig(os.path.join(dir_root, "application", "resources", f"{output_prefix}_months_pie.png"), dpi=300)
-        plt.close()
-        plt.figure(figsize=(12, 6))
-        df["month_year"].value_counts().sort_index().plot(kind="bar", color=sns.color_palette("viridis", len(df["month_year"].unique())))
-        plt.title("Histogram of Records per Month-Year")
-        plt.xlabel("Month-Year")
-        plt.ylabel("Count")
-        plt.xticks(rotation=45, ha="right")
-        plt.tight_layout()
-        plt.savefig(os.path.join(dir_root, "application", "resources", f"{output_prefix}_month_year_hist.png"), dpi=300)
-        plt.close()
-        plt.figure(figsize=(12, 6))
-        df.groupby("month_year").size().sort_index().plot(kind="line", marker="o", color="purple")
-        plt.title("Records per Month Over Time")
-        plt.xlabel("Month-Year")
-        plt.ylabel("Count")
-        plt.xticks(rotation=45, ha="right")
-        plt.tight_layout()
-        plt.savefig(os.path.join(dir_root, "application", "resources", f"{output_prefix}_time_series.png"), dpi=300)
-        plt.close()
-        print(f"✅ Charts saved with prefix '{output_prefix}'")
+        hours = lambda: pd.Series(self.cube.hour_histogram(self.media_ids, self.start_date, self.end_date))
+        self.charts["hours"] = self._request_chart("hours", hours)
+
+    def plot_date_charts(self):
+        daily = self.cube.daily_counts(self.media_ids, self.start_date, self.end_date)
+        daily = daily[daily > 0]
+        self.charts["years_pie"] = self._request_chart("years_pie", lambda: daily.groupby(daily.index.year).sum())
+        self.charts["months_pie"] = self._request_chart("months_pie", lambda: daily.groupby(daily.index.month).sum())
+        month_years = lambda: daily.groupby(daily.index.to_period("M")).sum()
+        self.charts["month_year_hist"] = self._request_chart("month_year_hist", month_years)
+        self.charts["time_series"] = self._request_chart("time_series", month_years)
+        print(f"[Runtime Log] -- Rendering {len(self.charts)} charts in background.")
+
+    def chart_paths(self, timeout=None):
+        """Waits for the charts and returns {chart type: png path}."""
+        return {chart_type: future.result(timeout) for chart_type, future in self.charts.items()}
+
+
+REPORT_CACHE = None
+
+
+def get_report_cache():
+    """Node outputs of the reports, kept in `logs/report_cache` across runs."""
+    global REPORT_CACHE
+    if REPORT_CACHE is None:
+        REPORT_CACHE = NodeCache(os.path.join(dir_root, "logs", "report_cache"))
+    return REPORT_CACHE
+
+
+def _data_version(code):
+    return file_version(meta_data[meta_data['id']==code]['messages'].values[0])
 
 
 class Reporting:
-    pass
+    """Automatic report of a media over a date range: summary, key points, trends, topic analyses and charts.
+    The analyses are the nodes of an AnalysisGraph. They share one warm dataset (`cache`), run concurrently with
+    their LLM calls paced by LLM_RATE_LIMITER, and their outputs are cached by parameters and data version, so
+    re-running a report with e.g. other `topics` only recomputes the topic analyses, the key points and the document.
+    """
+    SUMMARY_PROMPT = "Summarize what this media published and discussed: the main subjects, the tone and the most engaging content."
+    TOPIC_PROMPT = "Analyse how this media covered the topic: {}"
+
+    def __init__(self, media_idx, start_date=None, end_date=None, topics=None, trend_mode='burst', cache=None, max_workers=4,
+                 node_cache=None, spam_threshold=SPAM_THRESHOLD):
+        self.media_idx = int(media_idx)
+        self.media_name = get_media_name_from_code(self.media_idx)
+        self.start_date = start_date or '01/01/00'
+        self.end_date = end_date or '01/01/30'
+        self.topics = [topic.strip() for topic in (topics or []) if topic.strip()]
+        self.trend_mode = trend_mode
+        self.spam_threshold = spam_threshold
+        self.cache = cache if cache is not None else new_media_cache()
+        self.outputs = {}
+        self.graph = self._build_graph(node_cache if node_cache is not None else get_report_cache(), max_workers)
+
+    def _build_graph(self, node_cache, max_workers):
+        code, start, end, spam = self.media_idx, self.start_date, self.end_date, self.spam_threshold
+        base = {"media": code, "start_date": start, "end_date": end, "data": _data_version(code)}
+        analysis = {**base, "spam_threshold": spam}
+        graph = AnalysisGraph(node_cache, max_workers=max_workers)
+        graph.add("dataset", self._load_dataset, cached=False)
+        graph.add("charts", lambda inputs, control: StatisticalInformation(code, start, end).chart_paths(), params=base)
+        graph.add("summary", lambda inputs, control: self._analysis("summary").run(control),
+                  deps=["dataset"], params={**analysis, "prompt": self.SUMMARY_PROMPT})
+        graph.add("trends", lambda inputs, control: self._analysis("trends").run(control),
+                  deps=["dataset"], params={**analysis, "mode": self.trend_mode})
+        for topic in self.topics:
+            graph.add(f"topic:{topic}", lambda inputs, control, topic=topic: self._analysis(f"topic:{topic}").run(control),
+                      deps=["dataset"], params={**analysis, "prompt": self.TOPIC_PROMPT.format(topic)})
+        analyses = self._analysis_names()
+        graph.add("key_points", self._key_points, deps=analyses)
+        graph.add("report", self._render, deps=analyses + ["key_points", "charts"], params={"topics": self.topics})
+        return graph
+
+    def _analysis_names(self):
+        return ["summary", "trends"] + [f"topic:{topic}" for topic in self.topics]
+
+    def _analysis(self, name):
+        """The pipeline computing an analysis node."""
+        code, start, end, spam = self.media_idx, self.start_date, self.end_date, self.spam_threshold
+        if name == "summary":
+            return SpecificMediaAnalysis(self.SUMMARY_PROMPT, code, start, end, self.cache, spam)
+        if name == "trends":
+            return TrendDetection(code, start, end, self.cache, mode=self.trend_mode, spam_threshold=spam)
+        topic = name.split(":", 1)[1]
+        return TopicOriented(self.TOPIC_PROMPT.format(topic), [code], [topic], start, end, cache=self.cache, spam_threshold=spam)
+
+    def plan(self, target_seconds=None, limiter=None):
+        """Estimated cost of `run()` (a RunPlan) without calling the LLM: the plans of the analyses the node cache does
+        not hold (a cached analysis or key points node counts as one cache hit) plus the key points call. The analyses
+        run `max_workers` at a time under one shared limiter (default LLM_RATE_LIMITER, as in `run()`).
+        """
+        limiter = limiter or LLM_RATE_LIMITER
+        plan, branches = RunPlan("report"), []
+        for name in self._analysis_names():
+            if self.graph.is_cached(name):
+                plan.llm_calls, plan.cache_hits = plan.llm_calls + 1, plan.cache_hits + 1
+                continue
+            branch = self._analysis(name).plan(limiter=limiter)
+            for attribute in ("messages", "chunks", "llm_calls", "cache_hits", "prompt_tokens"):
+                setattr(plan, attribute, getattr(plan, attribute) + getattr(branch, attribute))
+            branches.append(branch)
+        if branches:
+            uncached_calls = sum(branch.llm_calls - branch.cache_hits for branch in branches)
+            seconds = [branch.est_seconds for branch in branches]
+            plan.est_seconds = max(max(seconds), sum(seconds) / self.graph.max_workers, uncached_calls * limiter.interval)
+            plan.map_seconds = plan.est_seconds
+        if self.graph.is_cached("key_points"):
+            plan.llm_calls, plan.cache_hits = plan.llm_calls + 1, plan.cache_hits + 1
+        else:
+            n_analyses = len(self._analysis_names())
+            plan.add_calls([estimate_tokens(self._key_points_prompt({})) + n_analyses * MAX_RESPONSE_TOKENS], limiter=limiter)
+        return plan.suggest(target_seconds)
+
+    def run(self, control=NO_CONTROL):
+        print(f"[Runtime Log] -- Building the report of {self.media_name} ({len(self.graph.nodes)} analyses).")
+        # A failed LLM call fails its node instead of being cached as the analysis
+        node_control = RunControl(cancel_event=control.cancel_event, limiter=LLM_RATE_LIMITER, raise_llm_errors=True)
+        with TRACER.span("report", media=self.media_idx):
+            self.outputs = self.graph.run(control, node_control=node_control)
+        computed = [name for name, status in self.graph.status.items() if status == "computed"]
+        print(f"[Runtime Log] -- Report ready; recomputed: {', '.join(computed) or 'nothing'}.")
+        return self.outputs["report"]
+
+    def _load_dataset(self, inputs, control):
+        # Loaded once into the shared cache, so the analyses running next to each other never load it twice.
+        table = self.cache.filtered(self.media_idx, self.start_date, self.end_date)
+        if self.topics:
+            self.cache.index(self.media_idx)
+        return len(table)
+
+    def _key_points_prompt(self, inputs):
+        prompt = f"Below are several analyses of a telegram media called {self.media_name}. I want you to extract the key points of all of them.\n\n"
+        for name, text in inputs.items():
+            prompt += f"**{name}**\n{text}\n\n"
+        return prompt + "**Please list the 5 to 10 most important key points as short bullet points in Persian language.**"
+
+    def _key_points(self, inputs, control):
+        prompt = self._key_points_prompt(inputs)
+        with TRACER.span("reduce", partials=len(inputs)):
+            return call_llm(prompt, cancel_event=control.cancel_event, limiter=control.limiter, raise_errors=control.raise_llm_errors)
+
+    def _render(self, inputs, control):
+        lines = [f"# {self.media_name}", f"{self.start_date} - {self.end_date}", "", "## Summary", inputs["summary"], "",
+                 "## Key points", inputs["key_points"], "", "## Trends", inputs["trends"], ""]
+        if self.topics:
+            lines.append("## Topics")
+            for topic in self.topics:
+                lines += [f"### {topic}", inputs[f"topic:{topic}"], ""]
+        lines.append("## Charts")
+        lines += [f"![{chart_type}]({path})" for chart_type, path in inputs["charts"].items()]
+        return "\n".join(lines) + "\n"
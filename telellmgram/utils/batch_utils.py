@@ -0,0 +1,263 @@
+"""Batch execution of the map stage: the map prompts of a run are written as one JSONL request file, submitted as a
+batch job (OpenAI batch API, or the local stand-in processor), polled, and the JSONL results are merged back by chunk id.
+Jobs are kept in `logs/batches/<job id>/`, named by a hash of the model and prompts, so a run restarted with the same
+chunks picks up its job where it was instead of submitting it again.
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+from os.path import dirname
+import openai
+from openai import api_requestor
+from telellmgram.utils import llm_utils
+from telellmgram.utils.llm_utils import LLM_CONFIG, LLM_ERROR_PREFIX, LLM_RATE_LIMITER, LLMResponseCache, call_llm
+from telellmgram.utils.trace_utils import TRACER, traced_sleep
+
+dir_root = dirname(dirname(__file__))
+dir_batches = os.path.join(dir_root, "logs", "batches")
+BATCH_ENDPOINT = "/v1/chat/completions"
+FINISHED_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+def batch_request(custom_id, prompt_text, model_name):
+    """One line of a request file: the same chat completion `call_llm` sends."""
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT,
+            "body": {"model": model_name, "messages": [{"role": "user", "content": prompt_text}], "temperature": 0.2, "max_tokens": 1000}}
+
+
+def batch_result(custom_id, text=None, error=None):
+    """One line of a result file, as the batch API writes them."""
+    if error is not None:
+        return {"id": uuid.uuid4().hex, "custom_id": custom_id, "response": None, "error": {"message": error}}
+    body = {"choices": [{"index": 0, "message": {"role": "assistant", "content": text}}]}
+    return {"id": uuid.uuid4().hex, "custom_id": custom_id, "response": {"status_code": 200, "body": body}, "error": None}
+
+
+def result_text(record):
+    """Response text of a result line, None when the request failed."""
+    response = record.get("response") or {}
+    if record.get("error") or response.get("status_code") != 200:
+        return None
+    text = response["body"]["choices"][0]["message"]["content"].strip()
+    return None if text.startswith(LLM_ERROR_PREFIX) else text  # a failure recorded as a response by older versions
+
+
+def read_jsonl(path):
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+
+class LocalBatchProcessor:
+    """Offline stand-in for the batch API with the same calls (upload, create, retrieve, download). A batch is
+    processed in a background thread that answers its requests one by one with `respond(prompt)` (default: `call_llm`
+    paced by LLM_RATE_LIMITER) and appends the results to its output file; a batch left unfinished by a stopped
+    process resumes after its last written result on the next `retrieve`. `respond` raises when a request fails, which
+    writes an error result for it.
+    """
+    def __init__(self, path=os.path.join(dir_batches, "local"), respond=None):
+        self.path = path
+        self.respond = respond or (lambda prompt: call_llm(prompt, limiter=LLM_RATE_LIMITER, raise_errors=True))
+        self._threads = {}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, file_id):
+        return os.path.join(self.path, file_id + ".jsonl")
+
+    def _load(self, batch_id):
+        with open(os.path.join(self.path, batch_id + ".json")) as f:
+            return json.load(f)
+
+    def _save(self, batch):
+        path = os.path.join(self.path, batch["id"] + ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(batch, f)
+        os.replace(path + ".tmp", path)
+
+    def upload(self, path):
+        file_id = "file-" + uuid.uuid4().hex[:12]
+        with open(path, "rb") as src, open(self._file(file_id), "wb") as dst:
+            dst.write(src.read())
+        return file_id
+
+    def create(self, input_file_id):
+        batch_id = "batch-" + uuid.uuid4().hex[:12]
+        total = len(read_jsonl(self._file(input_file_id)))
+        batch = {"id": batch_id, "status": "in_progress", "input_file_id": input_file_id, "output_file_id": "file-" + batch_id[6:] + "-out",
+                 "created_at": time.time(), "request_counts": {"total": total, "completed": 0, "failed": 0}}
+        self._save(batch)
+        self._start(batch)
+        return batch
+
+    def retrieve(self, batch_id):
+        batch = self._load(batch_id)
+        if batch["status"] == "in_progress":
+            self._start(batch)
+        return batch
+
+    def download(self, file_id):
+        with open(self._file(file_id), "rb") as f:
+            return f.read()
+
+    def _start(self, batch):
+        with self._lock:
+            thread = self._threads.get(batch["id"])
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=self._process, args=(batch["id"],), daemon=True, name=batch["id"])
+                self._threads[batch["id"]] = thread
+                thread.start()
+
+    def _process(self, batch_id):
+        batch = self._load(batch_id)
+        requests = read_jsonl(self._file(batch["input_file_id"]))
+        output = self._file(batch["output_file_id"])
+        done = len(read_jsonl(output)) if os.path.exists(output) else 0
+        counts = batch["request_counts"]
+        with open(output, "a", encoding="utf-8") as f:
+            for request in requests[done:]:
+                try:
+                    record = batch_result(request["custom_id"], self.respond(request["body"]["messages"][0]["content"]))
+                    counts["completed"] += 1
+                except Exception as e:
+                    record = batch_result(request["custom_id"], error=f"{type(e).__name__}: {e}")
+                    counts["failed"] += 1
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                self._save(batch)
+        batch["status"], batch["completed_at"] = "completed", time.time()
+        self._save(batch)
+
+
+class OpenAIBatchBackend:
+    """The batch API of the configured endpoint (LLM_CONFIG), through the openai client's files and raw requests."""
+    def _requestor(self):
+        return api_requestor.APIRequestor(key=LLM_CONFIG.api_key, api_base=LLM_CONFIG.base_url)
+
+    def upload(self, path):
+        with open(path, "rb") as f:
+            return openai.File.create(file=f, purpose="batch", api_key=LLM_CONFIG.api_key, api_base=LLM_CONFIG.base_url)["id"]
+
+    def create(self, input_file_id):
+        response, _, _ = self._requestor().request("post", "/batches", params={
+            "input_file_id": input_file_id, "endpoint": BATCH_ENDPOINT, "completion_window": "24h"})
+        return response.data
+
+    def retrieve(self, batch_id):
+        response, _, _ = self._requestor().request("get", f"/batches/{batch_id}")
+        return response.data
+
+    def download(self, file_id):
+        return openai.File.download(file_id, api_key=LLM_CONFIG.api_key, api_base=LLM_CONFIG.base_url)
+
+
+class BatchMapper:
+    """Runs the map prompts of a pipeline as one batch job of `backend` and returns the responses in chunk order.
+    Prompts the LLM response cache already answers are not sent; requests the batch failed are retried with
+    `call_llm`, and every response is added to the cache. The job state (`job.json`) is updated at every step:
+    created -> submitted -> completed -> merged.
+    """
+    def __init__(self, backend, path=dir_batches, poll_seconds=60):
+        self.backend = backend
+        self.path = path
+        self.poll_seconds = poll_seconds
+
+    def job_id(self, prompts):
+        digest = hashlib.sha256(LLM_CONFIG.model_name.encode("utf-8"))
+        for prompt in prompts:
+            digest.update(hashlib.sha256(prompt.encode("utf-8")).digest())
+        return digest.hexdigest()[:16]
+
+    def load_job(self, job_id):
+        path = os.path.join(self.path, job_id, "job.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _save_job(self, job):
+        path = os.path.join(self.path, job["id"], "job.json")
+        job["updated"] = time.time()
+        with open(path + ".tmp", "w") as f:
+            json.dump(job, f)
+        os.replace(path + ".tmp", path)
+
+    def _create_job(self, job_id, prompts):
+        os.makedirs(os.path.join(self.path, job_id), exist_ok=True)
+        model_name = LLM_CONFIG.model_name
+        cache = llm_utils.LLM_CACHE
+        cached = [i for i, prompt in enumerate(prompts) if cache is not None and LLMResponseCache.key(model_name, prompt) in cache]
+        with open(os.path.join(self.path, job_id, "requests.jsonl"), "w", encoding="utf-8") as f:
+            for i, prompt in enumerate(prompts):
+                if i not in cached:
+                    f.write(json.dumps(batch_request(f"chunk-{i}", prompt, model_name), ensure_ascii=False) + "\n")
+        job = {"id": job_id, "model": model_name, "chunks": len(prompts), "requests": len(prompts) - len(cached),
+               "state": "created", "batch_id": None, "batch_status": None, "request_counts": {}, "created": time.time()}
+        self._save_job(job)
+        return job
+
+    def map(self, prompts, control):
+        """Responses of `prompts`, in order. `control` follows the job ("llm_map" progress, one partial per chunk) and
+        cancels the wait; a cancelled or crashed run leaves the batch running and resumes it when run again.
+        """
+        job_id = self.job_id(prompts)
+        job = self.load_job(job_id) or self._create_job(job_id, prompts)
+        job_dir = os.path.join(self.path, job_id)
+        with TRACER.span("batch", job=job_id, chunks=len(prompts)) as span:
+            if job["state"] == "created" and job["requests"] > 0:
+                file_id = self.backend.upload(os.path.join(job_dir, "requests.jsonl"))
+                job["batch_id"], job["state"] = self.backend.create(file_id)["id"], "submitted"
+                self._save_job(job)
+                print(f"[Runtime Log] -- Submitted batch {job['batch_id']} with {job['requests']} requests (job {job_id}).")
+            while job["state"] == "submitted":
+                batch = self.backend.retrieve(job["batch_id"])
+                job["batch_status"], job["request_counts"] = batch["status"], batch.get("request_counts") or {}
+                control.progress("llm_map", job["request_counts"].get("completed", 0), job["requests"])
+                if batch["status"] in FINISHED_STATES:
+                    self._download(job, batch)
+                    job["state"] = "completed"
+                self._save_job(job)
+                if job["state"] == "submitted":
+                    traced_sleep(self.poll_seconds, reason="batch_poll", cancel_event=control.cancel_event)
+                    control.check()
+            responses = self._merge(job, prompts, control)
+            span.add(cache_hits=job["chunks"] - job["requests"])
+        job["state"] = "merged"
+        self._save_job(job)
+        return responses
+
+    def _download(self, job, batch):
+        with open(os.path.join(self.path, job["id"], "results.jsonl"), "wb") as f:
+            for key in ("output_file_id", "error_file_id"):
+                if batch.get(key):
+                    f.write(self.backend.download(batch[key]))
+
+    def _merge(self, job, prompts, control):
+        results_file = os.path.join(self.path, job["id"], "results.jsonl")
+        texts = {}
+        if os.path.exists(results_file):
+            texts = {record["custom_id"]: result_text(record) for record in read_jsonl(results_file)}
+        cache = llm_utils.LLM_CACHE
+        responses, retried = [], 0
+        for i, prompt in enumerate(prompts):
+            key = LLMResponseCache.key(job["model"], prompt)
+            text = texts.get(f"chunk-{i}")
+            if text is None and cache is not None:
+                text = cache.get(key)
+            if text is None:
+                retried += 1
+                text = call_llm(prompt, cancel_event=control.cancel_event, limiter=control.limiter, raise_errors=control.raise_llm_errors)
+            elif cache is not None and key not in cache:
+                cache.put(key, text)
+            control.partial(i, text)
+            responses.append(text)
+        if retried:
+            print(f"[Runtime Log] -- {retried} chunks missing from batch {job['batch_id']} were sent one by one.")
+        return responses
@@ -0,0 +1,138 @@
+"""Statistical burst detection of terms and hashtags over time windows."""
+
+import re
+import numpy as np
+import pandas as pd
+
+WORD_PATTERN = re.compile(r"[\u0621-\u064A\u067E\u0686\u0698\u06A9\u06AF\u06CC\u200Ca-zA-Z_]{3,}")
+WINDOW_SIZES = (3_600, 6 * 3_600, 86_400, 7 * 86_400)
+# Frequent Persian function words; they never burst in a meaningful way and dominate the counts.
+PERSIAN_STOPWORDS = frozenset("""
+از به با در که این آن برای را تا هم یا اما اگر چه چون نیز بر های ها می نمی شد شده شود کرد کرده کند کنند است هست
+نیست بود بودند باشد دارد داشت داریم خود ما شما آنها ایشان او وی همه هر یک دو سه بین پس پیش روی زیر بعد قبل
+دیگر حتی فقط باید نباید شاید ولی بلکه همین همان چنین چنان اینکه آنکه کجا چرا چگونه کانال گروه عضو لینک
+""".split())
+
+
+def extract_terms(texts, hashtags=None, min_length=3, stopwords=PERSIAN_STOPWORDS):
+    """Flattened (message position, term) pairs, each term counted once per message.
+    Hashtags (comma separated, as stored by the parser) are kept as '#tag' terms next to the words of the text.
+    """
+    positions, terms = [], []
+    for i, text in enumerate(texts):
+        words = set(WORD_PATTERN.findall(text.lower())) if isinstance(text, str) else set()
+        if hashtags is not None and isinstance(hashtags[i], str):
+            words.update(tag.strip().lower() for tag in hashtags[i].split(",") if tag.strip())
+        words = [w for w in words if len(w) >= min_length and w not in stopwords]
+        positions.extend([i] * len(words))
+        terms.extend(words)
+    return np.asarray(positions, dtype=np.int64), np.asarray(terms, dtype=object)
+
+
+def choose_window(timestamps, min_windows=8):
+    """Largest of WINDOW_SIZES giving at least `min_windows` windows over the covered time range."""
+    span = int(timestamps.max() - timestamps.min()) if len(timestamps) else 0
+    for size in reversed(WINDOW_SIZES):
+        if span // size >= min_windows:
+            return size
+    return WINDOW_SIZES[0]
+
+
+class BurstDetector:
+    """Finds terms whose share of messages in a time window is far above their recent baseline.
+    The (window x term) document counts are kept as sparse COO entries sorted by (term, window), and only terms seen
+    at least `min_count` times are kept. For every entry, the expected count of the term is its rate in the previous
+    `baseline_windows` windows (or in the whole range when those hold too few messages) times the number of
+    messages in the window, and the burst score is the Poisson z-score (count - expected) / sqrt(expected + 1).
+    Only the nonzero entries are scored: a term absent from a window cannot burst in it.
+    """
+    def __init__(self, window_seconds=None, baseline_windows=7, min_count=5, min_baseline_messages=50):
+        self.window_seconds = window_seconds
+        self.baseline_windows = baseline_windows
+        self.min_count = min_count
+        self.min_baseline_messages = min_baseline_messages
+
+    def fit(self, table):
+        """`table` needs `timestamp` (unix seconds, -1 if unknown) and `cleaned_text`; `hashtags` is optional."""
+        valid = table['timestamp'].to_numpy() >= 0
+        self.table = table[valid]
+        timestamps = self.table['timestamp'].to_numpy()
+        self.window = self.window_seconds or choose_window(timestamps)
+        self.origin = int(timestamps.min()) // self.window * self.window if len(timestamps) else 0
+        self.message_windows = (timestamps - self.origin) // self.window
+        n_windows = int(self.message_windows.max()) + 1 if len(timestamps) else 0
+        self.window_messages = np.bincount(self.message_windows, minlength=n_windows).astype(np.float64)
+
+        hashtags = self.table['hashtags'].to_numpy() if 'hashtags' in self.table.columns else None
+        self.positions, terms = extract_terms(self.table['cleaned_text'].to_numpy(), hashtags)
+        term_ids, self.vocabulary = pd.factorize(terms)
+        totals = np.bincount(term_ids, minlength=len(self.vocabulary))
+        keep_terms = np.flatnonzero(totals >= self.min_count)
+        remap = np.full(len(self.vocabulary), -1, dtype=np.int64)
+        remap[keep_terms] = np.arange(len(keep_terms))
+        kept = remap[term_ids] >= 0
+        self.positions, self.term_ids = self.positions[kept], remap[term_ids[kept]]
+        self.vocabulary = np.asarray(self.vocabulary)[keep_terms]
+
+        # COO (term, window) -> count over the pruned vocabulary, sorted by term then window
+        self.n_windows = max(n_windows, 1)
+        self.entry_keys, self.entry_counts = np.unique(self.term_ids * self.n_windows + self.message_windows[self.positions], return_counts=True)
+        self.entry_terms, self.entry_windows = self.entry_keys // self.n_windows, self.entry_keys % self.n_windows
+        self.term_totals = np.bincount(self.term_ids, minlength=len(self.vocabulary))
+        return self
+
+    def scores(self):
+        """Burst z-score of every nonzero (term, window) entry, aligned with `entry_terms` / `entry_windows`.
+        The baseline count of an entry is a difference of cumulative sums over the sorted entries: the entries of the
+        same term from window `w - baseline_windows` up to (not including) the entry itself.
+        """
+        cum_counts = np.concatenate([[0.0], np.cumsum(self.entry_counts, dtype=np.float64)])
+        cum_messages = np.concatenate([[0.0], np.cumsum(self.window_messages)])
+        starts = np.maximum(self.entry_windows - self.baseline_windows, 0)
+        first = np.searchsorted(self.entry_keys, self.entry_terms * self.n_windows + starts)
+        base_counts = cum_counts[np.arange(len(self.entry_keys))] - cum_counts[first]
+        base_messages = cum_messages[self.entry_windows] - cum_messages[starts]
+        global_rate = (self.term_totals[self.entry_terms] + 0.5) / (cum_messages[-1] + 1.0)
+        rate = np.where(base_messages >= self.min_baseline_messages, (base_counts + 0.5) / (base_messages + 1.0), global_rate)
+        expected = rate * self.window_messages[self.entry_windows]
+        return (self.entry_counts - expected) / np.sqrt(expected + 1.0)
+
+    def top_bursts(self, k=20, min_z=3.0):
+        """One row per bursting term (its strongest window), best first."""
+        if len(self.entry_keys) == 0:
+            return pd.DataFrame(columns=["term", "term_id", "window", "window_start", "window_end", "count", "messages", "z"])
+        z = self.scores()
+        by_term = np.lexsort((self.entry_windows, -z, self.entry_terms))
+        best = by_term[np.r_[True, self.entry_terms[by_term][1:] != self.entry_terms[by_term][:-1]]]
+        best = best[np.argsort(-z[best], kind="stable")]
+        best = best[z[best] >= min_z][:k]
+        windows = self.entry_windows[best]
+        starts = self.origin + windows * self.window
+        return pd.DataFrame({
+            "term": self.vocabulary[self.entry_terms[best]],
+            "term_id": self.entry_terms[best],
+            "window": windows,
+            "window_start": pd.to_datetime(starts, unit="s"),
+            "window_end": pd.to_datetime(starts + self.window, unit="s"),
+            "count": self.entry_counts[best].astype(np.int64),
+            "messages": self.window_messages[windows].astype(np.int64),
+            "z": z[best],
+        })
+
+    def representative_messages(self, bursts, per_term=5):
+        """Texts of the most engaging messages containing each bursting term inside its burst window."""
+        engagement = self.table['engagement'].to_numpy() if 'engagement' in self.table.columns else np.zeros(len(self.table))
+        texts = self.table['cleaned_text'].to_numpy()
+        examples = {}
+        for term_id, window, term in zip(bursts["term_id"], bursts["window"], bursts["term"]):
+            rows = self.positions[(self.term_ids == term_id) & (self.message_windows[self.positions] == window)]
+            rows = rows[np.argsort(-engagement[rows], kind="stable")]
+            seen, picked = set(), []
+            for row in rows:
+                if texts[row] not in seen:
+                    seen.add(texts[row])
+                    picked.append(texts[row])
+                if len(picked) == per_term:
+                    break
+            examples[term] = picked
+        return examples
@@ -0,0 +1,136 @@
+"""Chart rendering service: content-addressed png cache plus a background pool of Agg renderers.
+Charts are keyed by (media ids, chart type, date range, data version), so a chart is rendered once per data change
+and concurrent requests never overwrite each other's files.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from os.path import dirname, abspath
+
+dir_root = dirname(dirname(abspath(__file__)))
+dir_chart_cache = os.path.join(dir_root, "application", "resources", "charts")
+MONTH_LABELS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def downsample_series(series, max_points=500):
+    """Keeps the first, min, max and last point of each bucket, so peaks survive while long series shrink to ~max_points."""
+    if len(series) <= max_points:
+        return series
+    buckets = np.array_split(np.arange(len(series)), max(1, max_points // 4))
+    keep = set()
+    values = series.to_numpy()
+    for bucket in buckets:
+        keep.update([bucket[0], bucket[-1], bucket[np.argmin(values[bucket])], bucket[np.argmax(values[bucket])]])
+    return series.iloc[sorted(keep)]
+
+
+def render_chart(chart_type, data, output_path, dpi=300):
+    """Renders one chart to `output_path` with the non-interactive Agg backend. Runs inside the worker processes."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    tmp_path = f"{output_path}.{os.getpid()}.tmp.png"
+    if chart_type == "hours":
+        sns.set_theme(style="darkgrid")
+        plt.figure(figsize=(10, 6))
+        plt.bar(range(24), data.reindex(range(24), fill_value=0), width=1.0, edgecolor="white", color=sns.color_palette("magma", 24)[10])
+        plt.title("Distribution of Times (by Hour)", fontsize=18, weight='bold', color="#333333")
+        plt.xlabel("Hour of Day (0–23)", fontsize=14)
+        plt.ylabel("Frequency", fontsize=14)
+        plt.xticks(range(24))
+        plt.yticks(fontsize=12)
+    elif chart_type == "years_pie":
+        sns.set_theme(style="whitegrid")
+        plt.figure(figsize=(6, 6))
+        data.sort_index().plot.pie(autopct="%1.1f%%", colors=sns.color_palette("tab20"))
+        plt.title("Distribution of Years")
+        plt.ylabel("")
+    elif chart_type == "months_pie":
+        sns.set_theme(style="whitegrid")
+        plt.figure(figsize=(6, 6))
+        data.sort_index().reindex(range(1, 13), fill_value=0).plot.pie(autopct="%1.1f%%", labels=MONTH_LABELS, colors=sns.color_palette("tab20c"))
+        plt.title("Distribution of Months")
+        plt.ylabel("")
+    elif chart_type == "month_year_hist":
+        sns.set_theme(style="whitegrid")
+        plt.figure(figsize=(12, 6))
+        data.sort_index().plot(kind="bar", color=sns.color_palette("viridis", len(data)))
+        plt.title("Histogram of Records per Month-Year")
+        plt.xlabel("Month-Year")
+        plt.ylabel("Count")
+        plt.xticks(rotation=45, ha="right")
+    elif chart_type in ("time_series", "daily_series"):
+        sns.set_theme(style="whitegrid")
+        plt.figure(figsize=(12, 6))
+        downsample_series(data.sort_index()).plot(kind="line", marker="o" if len(data) <= 60 else None, color="purple")
+        plt.title("Records per Month Over Time" if chart_type == "time_series" else "Records per Day Over Time")
+        plt.xlabel("Month-Year" if chart_type == "time_series" else "Date")
+        plt.ylabel("Count")
+        plt.xticks(rotation=45, ha="right")
+    else:
+        raise ValueError(f"Unknown chart type: {chart_type}")
+    plt.tight_layout()
+    plt.savefig(tmp_path, dpi=dpi, format="png")
+    plt.close("all")
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+class ChartService:
+    """Returns futures of png paths. Cached charts resolve immediately; others are rendered on a process pool.
+    Identical requests that arrive while a chart is being rendered share the same future.
+    """
+    def __init__(self, cache_dir=dir_chart_cache, max_workers=2, dpi=300):
+        self.cache_dir = cache_dir
+        self.dpi = dpi
+        os.makedirs(cache_dir, exist_ok=True)
+        # spawn: forking a process that runs a Qt event loop is unsafe
+        self._pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def chart_key(self, media_ids, chart_type, start_date, end_date, data_version):
+        key = json.dumps([sorted(media_ids) if media_ids is not None else "all", chart_type,
+                          str(start_date), str(end_date), data_version, self.dpi], default=str)
+        return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+    def request(self, media_ids, chart_type, start_date, end_date, data_version, data):
+        """`data` is the aggregated pandas Series to plot, or a zero-argument callable producing it (only called on a miss)."""
+        path = os.path.join(self.cache_dir, f"{self.chart_key(media_ids, chart_type, start_date, end_date, data_version)}.png")
+        with self._lock:
+            if path in self._pending:
+                return self._pending[path]
+            if os.path.exists(path):
+                future = Future()
+                future.set_result(path)
+                return future
+            future = self._pool.submit(render_chart, chart_type, data() if callable(data) else data, path, self.dpi)
+            self._pending[path] = future
+        future.add_done_callback(lambda _: self._forget(path))
+        return future
+
+    def _forget(self, path):
+        with self._lock:
+            self._pending.pop(path, None)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+_chart_service = None
+
+
+def get_chart_service():
+    """Process wide chart service, created on first use."""
+    global _chart_service
+    if _chart_service is None:
+        _chart_service = ChartService()
+    return _chart_service
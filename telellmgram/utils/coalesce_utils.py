@@ -0,0 +1,78 @@
+"""Single-flight coalescing: concurrent calls with the same key share one execution."""
+
+import threading
+from concurrent.futures import Future, TimeoutError
+from telellmgram.utils.trace_utils import TRACER
+
+
+class SingleFlight:
+    """The first caller of a key (the leader) runs the function; callers arriving while it runs (followers) wait
+    for the same result instead of running it again. Nothing is kept once the call has finished; caching finished
+    results is left to the callers.
+    Args:
+        name: used in the metrics, e.g. 'llm' or 'pipeline'.
+        retry_on: exceptions of the leader that must not be shared, e.g. its own cancellation. Followers then try
+            again, and one of them becomes the new leader.
+    """
+    def __init__(self, name, retry_on=()):
+        self.name = name
+        self.retry_on = retry_on
+        self.leaders = 0
+        self.followers = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, cancel_event=None, cancelled=Exception):
+        """Returns (result, is_leader). A follower stops waiting and raises `cancelled` once `cancel_event` is set."""
+        while True:
+            with self._lock:
+                future = self._pending.get(key)
+                leader = future is None
+                if leader:
+                    future = self._pending[key] = Future()
+                    self.leaders += 1
+            if leader:
+                return self._lead(key, fn, future), True
+            try:
+                result = self._follow(future, cancel_event, cancelled)
+            except self.retry_on:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise
+                continue
+            with self._lock:
+                self.followers += 1
+            self._publish()
+            TRACER.add(coalesced=1)
+            return result, False
+
+    def _lead(self, key, fn, future):
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            self._publish()
+
+    def _follow(self, future, cancel_event, cancelled):
+        if cancel_event is None:
+            return future.result()
+        while True:
+            try:
+                return future.result(timeout=0.5)
+            except TimeoutError:
+                if cancel_event.is_set():
+                    raise cancelled()
+
+    def _publish(self):
+        TRACER.set_gauge(f"singleflight_{self.name}_leaders", self.leaders)
+        TRACER.set_gauge(f"singleflight_{self.name}_followers", self.followers)
+
+    def stats(self):
+        with self._lock:
+            return {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self._pending)}
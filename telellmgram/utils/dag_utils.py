@@ -0,0 +1,155 @@
+"""Dependency graph of analyses, run concurrently with content-addressed caching of every node's output."""
+
+import os
+import json
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from telellmgram.utils.trace_utils import TRACER
+
+
+class NodeCache:
+    """Outputs of graph nodes by key: an in-memory LRU, backed by one pickle per key in `path` when given."""
+    def __init__(self, path=None, max_entries=256):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                return True
+        return self.path is not None and os.path.exists(os.path.join(self.path, key + ".pkl"))
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return True, self._entries[key]
+        if self.path is not None and os.path.exists(os.path.join(self.path, key + ".pkl")):
+            with open(os.path.join(self.path, key + ".pkl"), "rb") as f:
+                value = pickle.load(f)
+            self._remember(key, value)
+            return True, value
+        return False, None
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.path is not None:
+            with open(os.path.join(self.path, key + ".tmp"), "wb") as f:
+                pickle.dump(value, f)
+            os.replace(os.path.join(self.path, key + ".tmp"), os.path.join(self.path, key + ".pkl"))
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class Node:
+    """`fn(inputs, control)` computes the node from `inputs` ({dependency name: output}); `params` are everything
+    else its output depends on. With `cached=False` it always runs (e.g. cheap warm-up steps).
+    """
+    def __init__(self, name, fn, deps=(), params=None, cached=True):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.params = params or {}
+        self.cached = cached
+
+
+class AnalysisGraph:
+    """Nodes are run as soon as their dependencies are done, up to `max_workers` at a time.
+    The key of a node hashes its name, its params and the keys of its dependencies, so after changing one parameter
+    only the nodes that depend on it (directly or through other nodes) get a new key and are recomputed; the others
+    are served from `cache`.
+    """
+    def __init__(self, cache=None, max_workers=4):
+        self.nodes = OrderedDict()
+        self.cache = cache if cache is not None else NodeCache()
+        self.max_workers = max_workers
+        self.status = {}
+
+    def add(self, name, fn, deps=(), params=None, cached=True):
+        missing = [dep for dep in deps if dep not in self.nodes]
+        if missing:
+            raise ValueError(f"Node {name} depends on unknown nodes {missing}; add them first.")
+        self.nodes[name] = Node(name, fn, deps, params, cached)
+        return self
+
+    def key(self, name, _keys=None):
+        keys = {} if _keys is None else _keys
+        if name not in keys:
+            node = self.nodes[name]
+            payload = json.dumps({"name": name, "params": node.params, "deps": [self.key(dep, keys) for dep in node.deps]},
+                                 sort_keys=True, default=str, ensure_ascii=False)
+            keys[name] = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+        return keys[name]
+
+    def is_cached(self, name):
+        """Whether `run()` would serve the node from the cache."""
+        return self.nodes[name].cached and self.key(name) in self.cache
+
+    def _needed(self, targets):
+        needed, stack = set(), list(targets)
+        while stack:
+            name = stack.pop()
+            if name not in needed:
+                needed.add(name)
+                stack.extend(self.nodes[name].deps)
+        return needed
+
+    def run(self, control, targets=None, node_control=None):
+        """Outputs of `targets` (default: every node) and of everything they depend on, as {name: output}.
+        `control` follows and cancels the whole run; the nodes get `node_control` (default: `control`).
+        `self.status` tells for every node whether it was 'cached', 'computed' or 'skipped'.
+        """
+        needed = self._needed(targets or list(self.nodes))
+        keys = {}
+        outputs, self.status = {}, {}
+        for name in needed:
+            node = self.nodes[name]
+            if node.cached:
+                hit, value = self.cache.get(self.key(name, keys))
+                if hit:
+                    outputs[name], self.status[name] = value, "cached"
+                    TRACER.add(cache_hits=1)
+        # Warm-up nodes whose dependents are all cached do not need to run.
+        todo = {name for name in needed if name not in outputs}
+        todo = {name for name in todo if self.nodes[name].cached or any(name in self.nodes[other].deps for other in todo)}
+        for name in needed - todo - set(outputs):
+            outputs[name], self.status[name] = None, "skipped"
+
+        pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        pending = {}
+        try:
+            while todo or pending:
+                for name in [n for n in todo if all(dep in outputs for dep in self.nodes[n].deps)]:
+                    todo.discard(name)
+                    node = self.nodes[name]
+                    inputs = {dep: outputs[dep] for dep in node.deps}
+                    pending[pool.submit(self._run_node, node, inputs, node_control or control)] = name
+                if not pending:
+                    raise RuntimeError(f"Unresolvable nodes: {sorted(todo)}")
+                done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                control.check()
+                for future in done:
+                    name = pending.pop(future)
+                    outputs[name], self.status[name] = future.result(), "computed"
+                    if self.nodes[name].cached:
+                        self.cache.put(self.key(name, keys), outputs[name])
+                    control.progress("report", len(self.status), len(needed))
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        return outputs
+
+    def _run_node(self, node, inputs, control):
+        with TRACER.span("node", node=node.name):
+            return node.fn(inputs, control)
@@ -0,0 +1,182 @@
+"""Local semantic index over media messages. Everything here is CPU only and needs no network access."""
+
+import os
+import json
+import zlib
+import numpy as np
+from os.path import dirname, abspath
+
+dir_root = dirname(dirname(abspath(__file__)))
+dir_index = os.path.join(dir_root, "media", "media_index")
+
+
+class HashedNgramEmbedder:
+    """Embeds texts with hashed character n-grams followed by a sparse random projection.
+    Character n-grams are taken inside word boundaries, so inflected Persian forms of a word share most of their features.
+    """
+    def __init__(self, dim=256, n_buckets=2**18, ngram_range=(2, 4), nnz_per_bucket=4, seed=13):
+        self.dim = dim
+        self.n_buckets = n_buckets
+        self.ngram_range = tuple(ngram_range)
+        self.nnz_per_bucket = nnz_per_bucket
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self._proj_cols = rng.integers(0, dim, size=(n_buckets, nnz_per_bucket), dtype=np.int32)
+        self._proj_signs = rng.choice(np.array([-1.0, 1.0], dtype=np.float32), size=(n_buckets, nnz_per_bucket))
+
+    def config(self):
+        return {"dim": self.dim, "n_buckets": self.n_buckets, "ngram_range": list(self.ngram_range),
+                "nnz_per_bucket": self.nnz_per_bucket, "seed": self.seed}
+
+    def _buckets(self, text):
+        if not isinstance(text, str):
+            return []
+        low, high = self.ngram_range
+        buckets = []
+        for word in text.lower().split():
+            word = f" {word} "
+            for n in range(low, high + 1):
+                for i in range(len(word) - n + 1):
+                    buckets.append(zlib.crc32(word[i:i+n].encode("utf-8")) % self.n_buckets)
+        return buckets
+
+    def embed(self, texts):
+        """Returns an L2-normalized float32 matrix with one row per text."""
+        rows, buckets = [], []
+        for r, text in enumerate(texts):
+            b = self._buckets(text)
+            rows.extend([r] * len(b))
+            buckets.extend(b)
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        if buckets:
+            rows = np.repeat(np.asarray(rows, dtype=np.int64), self.nnz_per_bucket)
+            buckets = np.asarray(buckets, dtype=np.int64)
+            cols = self._proj_cols[buckets].ravel()
+            signs = self._proj_signs[buckets].ravel()
+            flat = np.bincount(rows * self.dim + cols, weights=signs, minlength=out.size)
+            out = flat.reshape(out.shape).astype(np.float32)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+
+def _spherical_kmeans(x, n_clusters, n_iter=10, seed=13):
+    x = x[x.any(axis=1)]  # empty texts embed to zero vectors and carry no direction
+    if not len(x):
+        return np.zeros((1, x.shape[1]), dtype=np.float32)
+    n_clusters = min(n_clusters, len(x))
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = ~sums.any(axis=1)
+        sums[empty] = x[rng.choice(len(x), size=int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = sums / norms
+    return centroids
+
+
+class MediaVectorIndex:
+    """Memory-mapped float16 vectors of one media's `cleaned_text`, with an IVF coarse quantizer for sub-linear search.
+    Row ids are row offsets in the media messages csv, so they match the index of a freshly loaded table.
+    Files under `<dir_index>/<media_idx>/`:
+        - vectors.f16 : (n, dim) float16 memmap
+        - centroids.npy : (n_lists, dim) float32
+        - ivf_rows.npy / ivf_offsets.npy : rows grouped by their coarse cluster (CSR layout)
+        - meta.json : sizes, the embedder configuration and the version of the messages csv it was built from
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.embedder = HashedNgramEmbedder(**self.meta["embedder"])
+        self.vectors = np.memmap(os.path.join(path, "vectors.f16"), dtype=np.float16, mode="r",
+                                 shape=(self.meta["n"], self.meta["embedder"]["dim"]))
+        self.centroids = np.load(os.path.join(path, "centroids.npy"))
+        self.ivf_rows = np.load(os.path.join(path, "ivf_rows.npy"), mmap_mode="r")
+        self.ivf_offsets = np.load(os.path.join(path, "ivf_offsets.npy"))
+
+    def __len__(self):
+        return self.meta["n"]
+
+    @classmethod
+    def build(cls, texts, path, embedder=None, n_lists=None, batch_size=4096, train_size=50_000, source_version=None):
+        embedder = embedder or HashedNgramEmbedder()
+        os.makedirs(path, exist_ok=True)
+        n = len(texts)
+        vectors = np.memmap(os.path.join(path, "vectors.f16"), dtype=np.float16, mode="w+", shape=(max(n, 1), embedder.dim))
+        for start in range(0, n, batch_size):
+            vectors[start:start+batch_size] = embedder.embed(texts[start:start+batch_size])
+        vectors.flush()
+
+        if n_lists is None:
+            n_lists = int(np.clip(round(4 * np.sqrt(n)), 1, 4096))
+        n_lists = max(1, min(n_lists, n))
+        rng = np.random.default_rng(embedder.seed)
+        train_rows = np.sort(rng.choice(n, size=min(n, train_size), replace=False)) if n else np.zeros(0, dtype=np.int64)
+        train = np.asarray(vectors[train_rows], dtype=np.float32)
+        centroids = _spherical_kmeans(train, n_lists, seed=embedder.seed) if n else np.zeros((1, embedder.dim), np.float32)
+
+        assign = np.zeros(n, dtype=np.int64)
+        for start in range(0, n, batch_size):
+            block = np.asarray(vectors[start:start+batch_size], dtype=np.float32)
+            assign[start:start+batch_size] = np.argmax(block @ centroids.T, axis=1)
+        ivf_rows = np.argsort(assign, kind="stable")
+        ivf_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(centroids)))])
+
+        np.save(os.path.join(path, "centroids.npy"), centroids.astype(np.float32))
+        np.save(os.path.join(path, "ivf_rows.npy"), ivf_rows)
+        np.save(os.path.join(path, "ivf_offsets.npy"), ivf_offsets)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"n": n, "n_lists": len(centroids), "embedder": embedder.config(), "source_version": source_version}, f)
+        return cls(path)
+
+    def search(self, queries, k=100, n_probe=8, row_mask=None):
+        """Batched cosine top-k.
+        Args:
+            queries: list of query strings or an already embedded (q, dim) matrix.
+            k: number of rows returned per query.
+            n_probe: number of coarse clusters scanned per query. `n_probe >= n_lists` gives an exact search.
+            row_mask: optional boolean array of length n; rows where it is False are never returned.
+        Returns:
+            (rows, scores), both shaped (q, k). Missing results are padded with row -1 and score -inf.
+        """
+        q = self.embedder.embed(queries) if not isinstance(queries, np.ndarray) else queries.astype(np.float32)
+        n_probe = min(n_probe, len(self.centroids))
+        probes = np.argsort(-(q @ self.centroids.T), axis=1)[:, :n_probe]
+        rows_out = np.full((len(q), k), -1, dtype=np.int64)
+        scores_out = np.full((len(q), k), -np.inf, dtype=np.float32)
+        for qi in range(len(q)):
+            candidates = np.concatenate([self.ivf_rows[self.ivf_offsets[c]:self.ivf_offsets[c+1]] for c in probes[qi]])
+            if row_mask is not None:
+                candidates = candidates[row_mask[candidates]]
+            if not len(candidates):
+                continue
+            candidates = np.sort(candidates)  # sequential reads from the memmap
+            scores = np.asarray(self.vectors[candidates], dtype=np.float32) @ q[qi]
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            rows_out[qi, :len(top)] = candidates[top]
+            scores_out[qi, :len(top)] = scores[top]
+        return rows_out, scores_out
+
+
+def get_media_index(media_idx, table, rebuild=False, version=None):
+    """Opens the vector index of a media, building it from `table['cleaned_text']` when missing or stale.
+    `version` (see message_arena.file_version) identifies the messages csv of `table`: the index is rebuilt when it
+    was built from another version. Without it, only a change in the number of rows is detected.
+    With a `version`, `table` can be a function returning the table, called only when the index is built.
+    """
+    path = os.path.join(dir_index, str(media_idx))
+    if not rebuild and os.path.exists(os.path.join(path, "meta.json")):
+        index = MediaVectorIndex(path)
+        if version is not None and index.meta.get("source_version") == version:
+            return index
+        if version is None and len(index) == len(table):
+            return index
+    print(f"[Runtime Log] -- Building vector index for media {media_idx} ...")
+    table = table() if callable(table) else table
+    return MediaVectorIndex.build(table["cleaned_text"].tolist(), path, source_version=version)
@@ -1,6 +1,16 @@
 """Required functions and classes to work with llm"""
+import os
+import json
+import hashlib
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from collections import OrderedDict
 from dataclasses import dataclass
 import openai
+from telellmgram.utils.trace_utils import TRACER, traced_sleep
+from telellmgram.utils.coalesce_utils import SingleFlight
+from telellmgram.utils.text_utils import CHARS_PER_TOKEN
 
 
 @dataclass
@@ -8,23 +18,207 @@ class LLMConfig:
     base_url = 'https://api.avalapis.ir/v1'
     api_key  = 'XXXX'
     model_name = "gpt-4o-mini"
+    requests_per_minute = 2      # shared limit of the pipelines running LLM calls concurrently
+    max_concurrent_requests = 4
 
 
 LLM_CONFIG = LLMConfig()
 
 
-def call_llm(prompt_text):
+class LLMResponseCache:
+    """LRU of successful responses keyed by (model, prompt), optionally persisted as JSON lines so a restarted
+    process (e.g. the analysis server) starts warm. Identical prompts are common: re-running an analysis on the
+    same medium and dates rebuilds exactly the same chunks. The file only grows while the process runs; it is compacted
+    to the kept entries when loaded.
+    """
+    def __init__(self, path=None, max_entries=20_000):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            lines = 0
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    self._entries.pop(record["key"], None)
+                    self._entries[record["key"]] = record["response"]
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+            if lines > len(self._entries):
+                self._compact()
+
+    def _compact(self):
+        """Rewrites the file with one line per kept entry (drops repeated, evicted and broken lines)."""
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            for key, response in self._entries.items():
+                f.write(json.dumps({"key": key, "response": response}, ensure_ascii=False) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+
+    @staticmethod
+    def key(model_name, prompt_text):
+        return hashlib.sha256(f"{model_name}\x00{prompt_text}".encode("utf-8")).hexdigest()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        return None
+
+    def put(self, key, response):
+        with self._lock:
+            self._entries[key] = response
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if self.path is not None:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"key": key, "response": response}, ensure_ascii=False) + "\n")
+
+
+LLM_CACHE = None
+LLM_ERROR_PREFIX = "An error occurred: "  # text `call_llm` returns for a failed call (without `raise_errors`)
+
+
+def enable_llm_cache(path=None, max_entries=20_000):
+    """Turns on response caching for every `call_llm` in this process."""
+    global LLM_CACHE
+    LLM_CACHE = LLMResponseCache(path, max_entries)
+    return LLM_CACHE
+
+
+class LLMCallCancelled(Exception):
+    """Raised when a run is cancelled while waiting for, or streaming, an LLM response."""
+
+
+class LLMCallFailed(Exception):
+    """Raised by `call_llm(..., raise_errors=True)` when the API call failed."""
+
+
+LLM_FLIGHT = SingleFlight("llm", retry_on=(LLMCallCancelled,))
+
+
+class RateLimiter:
+    """Spaces requests `60 / requests_per_minute` seconds apart (allowing `burst` back to back requests) and caps the
+    number of requests in flight. Shared by all threads of a process, unlike the fixed sleeps of a single pipeline.
+    """
+    def __init__(self, requests_per_minute, max_concurrent=None, burst=1):
+        self.interval = 60.0 / requests_per_minute
+        self.burst = burst
+        self._next = 0.0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+
+    def _wait_turn(self, cancel_event):
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now - (self.burst - 1) * self.interval)
+            self._next = start + self.interval
+        if start > now:
+            traced_sleep(start - now, reason="rate_limiter", cancel_event=cancel_event)
+        if cancel_event is not None and cancel_event.is_set():
+            raise LLMCallCancelled()
+
+    @contextmanager
+    def slot(self, cancel_event=None):
+        if self._slots is not None:
+            while not self._slots.acquire(timeout=0.5):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise LLMCallCancelled()
+        try:
+            self._wait_turn(cancel_event)
+            yield
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+
+LLM_RATE_LIMITER = RateLimiter(LLM_CONFIG.requests_per_minute, LLM_CONFIG.max_concurrent_requests)
+
+
+def call_llm(prompt_text, on_token=None, cancel_event=None, limiter=None, raise_errors=False):
+    """Sends one prompt and returns the response text.
+    With `on_token` or `cancel_event` the response is streamed: every received piece of text is passed to `on_token`,
+    and setting `cancel_event` drops the connection and raises LLMCallCancelled.
+    With a `limiter` (e.g. LLM_RATE_LIMITER) the request waits for its turn; cached and coalesced calls never wait.
+    A failed call is returned as an "An error occurred: ..." text, or raised as LLMCallFailed with `raise_errors`
+    (for outputs that are stored, so an error is never kept as a response). Errors are never cached.
+    """
     openai.api_key = LLM_CONFIG.api_key
     openai.api_base = LLM_CONFIG.base_url
     model_name = LLM_CONFIG.model_name
+    if cancel_event is not None and cancel_event.is_set():
+        raise LLMCallCancelled()
+    cache_key = LLMResponseCache.key(model_name, prompt_text)
+    if LLM_CACHE is not None:
+        cached = LLM_CACHE.get(cache_key)
+        if cached is not None:
+            TRACER.add(cache_hits=1)
+            if on_token is not None:
+                on_token(cached)
+            return cached
+
+    # The same prompt already in flight (another pipeline or analyst sending the same chunk) is awaited, not re-sent.
+    def request():
+        with limiter.slot(cancel_event) if limiter is not None else nullcontext():
+            return _request_llm(model_name, prompt_text, on_token, cancel_event)
 
+    try:
+        text, leader = LLM_FLIGHT.do(cache_key, request, cancel_event, LLMCallCancelled)
+    except LLMCallFailed as e:
+        if raise_errors:
+            raise
+        return f"{LLM_ERROR_PREFIX}{e}"
+    if not leader and on_token is not None:
+        on_token(text)
+    return text
+
+
+def _request_llm(model_name, prompt_text, on_token, cancel_event):
     try:
         response = openai.ChatCompletion.create(
             model=model_name,
             messages=[{'role': 'user', 'content': prompt_text}],
             temperature=0.2,
-            max_tokens=1000
+            max_tokens=1000,
+            stream=on_token is not None or cancel_event is not None
         )
-        return response.choices[0].message['content'].strip()
+        if on_token is None and cancel_event is None:
+            usage = response.get('usage') or {}
+            TRACER.add(llm_calls=1, prompt_tokens=usage.get('prompt_tokens', 0), completion_tokens=usage.get('completion_tokens', 0))
+            text = response.choices[0].message['content'].strip()
+        else:
+            text = _consume_stream(response, prompt_text, on_token, cancel_event)
+    except LLMCallCancelled:
+        raise
     except Exception as e:
-        return f"An error occurred: {str(e)}"
+        raise LLMCallFailed(str(e)) from e
+    if LLM_CACHE is not None:
+        LLM_CACHE.put(LLMResponseCache.key(model_name, prompt_text), text)
+    return text
+
+
+def _consume_stream(response, prompt_text, on_token, cancel_event):
+    pieces = []
+    for event in response:
+        if cancel_event is not None and cancel_event.is_set():
+            if hasattr(response, 'close'):
+                response.close()
+            raise LLMCallCancelled()
+        piece = event.choices[0].delta.get('content') if event.choices else None
+        if piece:
+            pieces.append(piece)
+            if on_token is not None:
+                on_token(piece)
+    text = "".join(pieces)
+    # Streamed responses carry no usage block, so token counts are estimated from the text lengths.
+    TRACER.add(llm_calls=1, prompt_tokens=int(len(prompt_text) / CHARS_PER_TOKEN), completion_tokens=int(len(text) / CHARS_PER_TOKEN))
+    return text.strip()
@@ -2,10 +2,38 @@
 
 import os 
 import pickle
+import threading
+import numpy as np
 import pandas as pd
 from os.path import dirname, abspath
 from tqdm import tqdm
-from dataclasses import dataclass
+from typing import Callable, Optional
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from telellmgram.utils import llm_utils
+from telellmgram.utils.llm_utils import LLMCallCancelled
+from telellmgram.utils.trace_utils import TRACER, traced_sleep
+from telellmgram.utils.text_utils import count_persian_letters_series, add_message_features, CHARS_PER_TOKEN
+
+FEATURE_COLUMNS = ['persian_letters', 'token_count', 'est_tokens', 'persian_ratio', 'has_link', 'has_hashtag',
+                   'engagement', 'timestamp', 'hour', 'thread_id', 'reply_depth', 'spam_score']
+
+# Compact dtypes of the parsed messages tables. Text columns use pandas' "str" dtype, which is backed by Arrow when
+# pyarrow is installed; repetitive strings are categorical.
+MESSAGE_DTYPES = {
+    'message_id': 'int32', 'reply_to_message_id': 'Int32', 'cleaned_text': 'str', 'raw_text': 'str',
+    'sender_name': 'category', 'sender_id': 'category', 'time': 'str', 'date': 'str', 'reactions': 'str',
+    'links': 'category', 'hashtags': 'category',
+    'persian_letters': 'int16', 'token_count': 'int16', 'est_tokens': 'int16', 'persian_ratio': 'float32',
+    'has_link': 'bool', 'has_hashtag': 'bool', 'engagement': 'int32', 'timestamp': 'int64', 'hour': 'int8',
+    'thread_id': 'int32', 'reply_depth': 'int16', 'spam_score': 'float32',
+}
+# Columns no pipeline reads: the raw text next to `cleaned_text`, the send time as strings (see `timestamp`) and names.
+UNUSED_COLUMNS = ('raw_text', 'time', 'date', 'sender_name')
+FEATURE_INPUTS = ['cleaned_text', 'links', 'hashtags', 'reactions', 'date', 'time', 'message_id', 'reply_to_message_id']
+# Messages with a `spam_score` at or above it are not sent to the LLM; pipelines take it as `spam_threshold`.
+SPAM_THRESHOLD = 0.8
 
 dir_root = dirname(dirname(abspath(__file__)))
 metadata_file = os.path.join(dir_root, "media", "metadata.csv")
@@ -43,4 +71,356 @@ def get_basic_stat_info():
     NUM_MEDIA_IN_DATABASE = len(metadata)
     NUM_GROUPS = len(metadata[metadata['type'] == 'group'])
     NUM_CHANNELS = NUM_MEDIA_IN_DATABASE - NUM_GROUPS
-    
\ No newline at end of file
+    
+
+def read_messages_table(messages_file, columns=None):
+    """Reads a parsed messages csv with compact dtypes, keeping only `columns` (default: all but UNUSED_COLUMNS).
+    Tables parsed before the feature columns existed get them computed from their inputs first, which are then dropped
+    unless requested.
+    """
+    available = pd.read_csv(messages_file, nrows=0).columns.tolist()
+    wanted = [c for c in available + FEATURE_COLUMNS if c not in UNUSED_COLUMNS] if columns is None else list(columns)
+    wanted = list(dict.fromkeys(wanted))
+    missing_features = [c for c in FEATURE_COLUMNS if c not in available]
+    if not missing_features or not any(c in missing_features for c in wanted):
+        usecols = [c for c in wanted if c in available]
+        return pd.read_csv(messages_file, usecols=usecols, dtype={c: MESSAGE_DTYPES[c] for c in usecols if c in MESSAGE_DTYPES})[usecols]
+    usecols = list(dict.fromkeys([c for c in FEATURE_INPUTS + wanted if c in available]))
+    table = add_message_features(pd.read_csv(messages_file, usecols=usecols))
+    return compact_table(table[[c for c in wanted if c in table.columns]])
+
+
+def compact_table(table):
+    """Casts the columns of a messages table to MESSAGE_DTYPES."""
+    return table.astype({c: MESSAGE_DTYPES[c] for c in table.columns if c in MESSAGE_DTYPES and table[c].dtype != MESSAGE_DTYPES[c]})
+
+
+def table_memory(table):
+    """Bytes held by a table, strings included."""
+    return int(table.memory_usage(deep=True).sum())
+
+
+def memory_report(messages_files, columns=None):
+    """Memory of each table loaded the old way (every column, default dtypes, features added) and with
+    `read_messages_table(columns)`, in MB.
+    """
+    report = []
+    for messages_file in messages_files:
+        before = table_memory(add_message_features(pd.read_csv(messages_file)))
+        lean = read_messages_table(messages_file, columns)
+        report.append({"file": os.path.basename(messages_file), "rows": len(lean), "before_mb": before / 2**20,
+                       "after_mb": table_memory(lean) / 2**20, "reduction": before / max(table_memory(lean), 1)})
+    return pd.DataFrame(report)
+
+
+def ensure_message_features(table):
+    """Adds the ingest-time feature columns to tables parsed before they existed."""
+    if not all(column in table.columns for column in FEATURE_COLUMNS):
+        table = add_message_features(table)
+    return table
+
+
+def backfill_feature_columns():
+    """Rewrites every parsed media csv with the feature columns, without re-parsing the raw exports."""
+    for messages_file in tqdm(metadata['messages']):
+        table = pd.read_csv(messages_file)
+        if not all(column in table.columns for column in FEATURE_COLUMNS):
+            add_message_features(table).to_csv(messages_file, index=False)
+
+
+def valid_text_mask(table, min_persian_letters):
+    """Rows whose `cleaned_text` is a string with at least `min_persian_letters` Persian letters."""
+    if 'persian_letters' in table.columns:
+        return (table['persian_letters'] >= min_persian_letters).to_numpy()
+    return (count_persian_letters_series(table['cleaned_text']) >= min_persian_letters).to_numpy()
+
+
+def spam_mask(table, threshold=SPAM_THRESHOLD):
+    """Rows whose `spam_score` is at or above `threshold` (none with `threshold=None`). The messages and estimated
+    tokens they would have added to the prompts are counted on a 'spam' span and logged.
+    """
+    if threshold is None or 'spam_score' not in table.columns:
+        return np.zeros(len(table), dtype=bool)
+    spam = (table['spam_score'] >= threshold).to_numpy()
+    tokens = int(table['est_tokens'].to_numpy()[spam].sum()) if 'est_tokens' in table.columns else 0
+    with TRACER.span("spam", rows_in=len(table), threshold=threshold) as span:
+        span.add(rows_out=int(len(table) - spam.sum()), tokens_removed=tokens)
+    if spam.any():
+        print(f"[Runtime Log] -- Spam filter removed {int(spam.sum())} of {len(table)} messages (~{tokens} tokens).")
+    return spam
+
+
+def build_chunks(lines, prefix, suffix="", limit=200_000, inclusive=True, keep_last=True):
+    """Packs pre-formatted lines into prompts without growing strings row by row.
+    Produces exactly what this loop produces:
+        chunk = prefix
+        for line in lines:
+            chunk += line
+            if len(chunk) >= limit:        # `>` when inclusive=False
+                chunks.append(chunk + suffix)
+                chunk = prefix
+        if keep_last and len(chunk) > len(prefix):
+            chunks.append(chunk + suffix)
+    Chunk boundaries are found with a binary search on the cumulative line lengths, then each chunk is joined once.
+    """
+    lines = list(lines)
+    cum_lengths = np.concatenate([[0], np.cumsum([len(line) for line in lines], dtype=np.int64)])
+    side = "left" if inclusive else "right"
+    chunks, start = [], 0
+    while start < len(lines):
+        end = int(np.searchsorted(cum_lengths, cum_lengths[start] + limit - len(prefix), side=side))
+        end = max(end, start + 1)
+        if end > len(lines):
+            if keep_last:
+                chunks.append(prefix + "".join(lines[start:]) + suffix)
+            break
+        chunks.append(prefix + "".join(lines[start:end]) + suffix)
+        start = end
+    return chunks
+
+
+def build_thread_chunks(lines, thread_ids, prefix, suffix="", limit=200_000):
+    """Like `build_chunks`, but keeps the consecutive lines of one thread (equal `thread_ids`) in the same chunk.
+    A chunk is closed before a thread that does not fit in it anymore; only a thread longer than a whole chunk is
+    split, with `build_chunks`.
+    """
+    lines, thread_ids = list(lines), np.asarray(thread_ids)
+    if not lines:
+        return []
+    starts = np.flatnonzero(np.r_[True, thread_ids[1:] != thread_ids[:-1]])
+    ends = np.r_[starts[1:], len(lines)]
+    cum_lengths = np.concatenate([[0], np.cumsum([len(line) for line in lines], dtype=np.int64)])
+    room = limit - len(prefix)
+    chunks, chunk_start = [], 0
+    for start, end in zip(starts, ends):
+        if cum_lengths[end] - cum_lengths[chunk_start] <= room:
+            continue
+        if start > chunk_start:
+            chunks.append(prefix + "".join(lines[chunk_start:start]) + suffix)
+        if cum_lengths[end] - cum_lengths[start] > room:
+            chunks.extend(build_chunks(lines[start:end], prefix, suffix, limit=limit, inclusive=False))
+            chunk_start = end
+        else:
+            chunk_start = start
+    if chunk_start < len(lines):
+        chunks.append(prefix + "".join(lines[chunk_start:]) + suffix)
+    return chunks
+
+
+@dataclass
+class RunControl:
+    """Hooks a caller (e.g. the GUI) passes to `pipeline.run(control)` to follow and steer a running pipeline."""
+    on_progress: Optional[Callable] = field(
+        default=None, metadata={"help": "Called as on_progress(stage, done, total)."}
+    )
+    on_partial: Optional[Callable] = field(
+        default=None, metadata={"help": "Called as on_partial(index, text) for every finished map response."}
+    )
+    on_token: Optional[Callable] = field(
+        default=None, metadata={"help": "Receives the final (reduce) response piece by piece while it streams."}
+    )
+    cancel_event: Optional[threading.Event] = field(
+        default=None, metadata={"help": "Set it to cancel the run, including in-flight LLM calls."}
+    )
+    limiter: Optional[object] = field(
+        default=None, metadata={"help": "Rate limiter shared with concurrent runs (e.g. LLM_RATE_LIMITER); it paces the "
+                                        "LLM calls instead of the fixed pauses of `sleep`."}
+    )
+    batch: Optional[object] = field(
+        default=None, metadata={"help": "Runs the map prompts of the run instead of one LLM call each: a BatchMapper "
+                                        "(batch_utils, one batch job) or a WorkQueueMapper (queue_utils, on several nodes)."}
+    )
+    raise_llm_errors: bool = field(
+        default=False, metadata={"help": "Fail the run (LLMCallFailed) when an LLM call fails, instead of going on with the "
+                                         "error text as its response; for outputs that are cached (e.g. report nodes)."}
+    )
+
+    def progress(self, stage, done, total):
+        self.check()
+        if self.on_progress is not None:
+            self.on_progress(stage, done, total)
+
+    def partial(self, index, text):
+        if self.on_partial is not None:
+            self.on_partial(index, text)
+
+    def check(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise LLMCallCancelled()
+
+    def sleep(self, seconds):
+        """Rate limit pause that returns early, raising LLMCallCancelled, when the run is cancelled."""
+        if self.limiter is None:
+            traced_sleep(seconds, cancel_event=self.cancel_event)
+        self.check()
+
+
+NO_CONTROL = RunControl()  # used by `run()` when the caller passes no control: plain, non-streaming LLM calls
+
+# LLM speed assumed by `RunPlan` until calls have been timed in this process, and the response length it plans for
+# (the `max_tokens` of `call_llm`).
+LLM_BASE_SECONDS = 2.0
+PROMPT_TOKENS_PER_SECOND = 4_000
+COMPLETION_TOKENS_PER_SECOND = 60
+MAX_RESPONSE_TOKENS = 1_000
+
+
+def estimate_tokens(text):
+    return int(np.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def estimate_call_seconds(prompt_tokens):
+    """Duration of one LLM call: the mean of the calls timed so far in this process, else LLM_BASE_SECONDS plus the
+    prompt and a full response at the assumed token rates.
+    """
+    measured = TRACER.stage_mean_seconds("llm_map")
+    if measured is not None:
+        return measured
+    return LLM_BASE_SECONDS + prompt_tokens / PROMPT_TOKENS_PER_SECOND + MAX_RESPONSE_TOKENS / COMPLETION_TOKENS_PER_SECOND
+
+
+def is_cached_prompt(prompt):
+    """Whether the LLM response cache (when enabled) already holds the response to `prompt`."""
+    cache = llm_utils.LLM_CACHE
+    return cache is not None and llm_utils.LLMResponseCache.key(llm_utils.LLM_CONFIG.model_name, prompt) in cache
+
+
+@dataclass
+class RunPlan:
+    """Cost of a pipeline run, estimated by its `plan()` from the prompts `run()` would send, without any LLM call.
+    Calls are timed like `run()` makes them: one after the other with the pipeline's fixed pauses, or spaced by a
+    shared `limiter` (then the pauses are skipped, see `RunControl.sleep`).
+    """
+    pipeline: str
+    messages: int = 0         # messages sent to the LLM
+    chunks: int = 0           # map prompts
+    llm_calls: int = 0        # every call of the run, the cached ones included
+    cache_hits: int = 0       # calls the LLM response cache would answer
+    prompt_tokens: int = 0    # estimated prompt tokens actually sent (cache hits excluded)
+    est_seconds: float = 0.0
+    map_seconds: float = 0.0  # part of `est_seconds` spent on the map prompts
+    suggestion: str = ""
+
+    def add_calls(self, prompts, pause=0.0, limiter=None, map_calls=False):
+        """Adds calls, given as prompt texts or, for prompts that depend on earlier responses, estimated token counts."""
+        for prompt in prompts:
+            self.llm_calls += 1
+            if isinstance(prompt, str) and is_cached_prompt(prompt):
+                self.cache_hits += 1
+                seconds = 0.0
+            else:
+                tokens = estimate_tokens(prompt) if isinstance(prompt, str) else int(prompt)
+                self.prompt_tokens += tokens
+                seconds = estimate_call_seconds(tokens)
+                seconds = max(seconds, limiter.interval) if limiter is not None else seconds
+            seconds += 0.0 if limiter is not None else pause
+            self.est_seconds += seconds
+            if map_calls:
+                self.map_seconds += seconds
+        return self
+
+    def suggest(self, target_seconds, timestamps=None, costs=None, chunk_limit=200_000):
+        """Sets `suggestion` when the run is estimated to take longer than `target_seconds`: the number of map chunks
+        that fits, and with the `timestamps` and prompt `costs` (characters) of the candidate messages, the start date
+        from which the most recent messages fill those chunks.
+        """
+        if target_seconds is None or self.est_seconds <= target_seconds:
+            self.suggestion = ""
+            return self
+        fixed = self.est_seconds - self.map_seconds
+        per_chunk = self.map_seconds / max(self.chunks, 1)
+        max_chunks = int((target_seconds - fixed) // per_chunk) if per_chunk > 0 else self.chunks
+        if max_chunks < 1:
+            self.suggestion = f"Even one chunk exceeds {target_seconds:.0f} s (about {fixed + per_chunk:.0f} s); use a shared rate limiter or raise the target."
+            return self
+        self.suggestion = f"Keep at most {max_chunks} of {self.chunks} chunks to finish in {target_seconds:.0f} s"
+        if timestamps is not None and costs is not None and len(timestamps):
+            order = np.argsort(-np.asarray(timestamps), kind="stable")
+            newest_cost = np.cumsum(np.asarray(costs)[order])
+            fits = int(np.searchsorted(newest_cost, max_chunks * chunk_limit, side="right"))
+            if 0 < fits < len(order):
+                start = pd.to_datetime(np.asarray(timestamps)[order][fits - 1], unit="s")
+                self.suggestion += f": narrow the date range to start on {start:%d/%m/%y}, or sample messages into {max_chunks} chunks"
+        self.suggestion += "."
+        return self
+
+    def summary(self):
+        lines = [f"{self.pipeline}: {self.messages} messages in {self.chunks} chunks, {self.llm_calls} LLM calls "
+                 f"({self.cache_hits} cached), ~{self.prompt_tokens} prompt tokens, ~{self.est_seconds / 60:.1f} min"]
+        if self.suggestion:
+            lines.append(self.suggestion)
+        return "\n".join(lines)
+
+
+class MediaTableCache:
+    """Thread safe LRU of loaded media tables, their date-filtered views and their search indexes.
+    Entries can be prefetched in the background; a request for an entry that is still loading waits for that load
+    instead of starting a second one, so a prefetch started when a medium is selected is never wasted.
+    Cached tables are shared between pipelines and must be treated as read-only.
+    Args:
+        load_table: load_table(code) returns the full messages table of a medium.
+        filter_table: filter_table(table, start_date, end_date) returns the rows of a date range.
+        load_index: load_index(code, table) returns the search index of a medium.
+    """
+    def __init__(self, load_table, filter_table, load_index=None, max_entries=12, max_workers=2):
+        self.load_table = load_table
+        self.filter_table = filter_table
+        self.load_index = load_index
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+
+    def _get(self, key, build):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                TRACER.add(cache_hits=1)
+                return self._entries[key]
+            owner = key not in self._pending
+            if owner:
+                self._pending[key] = Future()
+            future = self._pending[key]
+        if not owner:
+            return future.result()
+        try:
+            value = build()
+        except BaseException as e:
+            with self._lock:
+                self._pending.pop(key)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._pending.pop(key)
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def table(self, code):
+        return self._get(("table", code), lambda: self.load_table(code))
+
+    def filtered(self, code, start_date, end_date):
+        return self._get(("filtered", code, start_date, end_date),
+                         lambda: self.filter_table(self.table(code), start_date, end_date))
+
+    def index(self, code):
+        return self._get(("index", code), lambda: self.load_index(code, self.table(code)))
+
+    def prefetch(self, code, start_date=None, end_date=None, with_index=False):
+        """Loads (and filters / indexes) a medium on the background pool. Returns a future of the filtered table."""
+        def run():
+            if with_index and self.load_index is not None:
+                self.index(code)
+            if start_date is None or end_date is None:
+                return self.table(code)
+            return self.filtered(code, start_date, end_date)
+        return self._pool.submit(run)
+
+    def clear(self, code=None):
+        """Drops every entry, or only those of one medium (e.g. after it was re-parsed)."""
+        with self._lock:
+            for key in [key for key in self._entries if code is None or key[1] == code]:
+                del self._entries[key]
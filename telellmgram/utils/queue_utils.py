@@ -0,0 +1,344 @@
+"""Work queue in a shared directory, to run ingestion and map tasks on several machines (or processes) at once.
+A coordinator submits tasks as JSON files; stateless workers claim them with an atomic rename, keep their lease alive
+with heartbeats and write their results next to them. The tasks of a worker that stops heartbeating are put back in
+the queue after `lease_seconds`, so a dead machine only delays its tasks. Every node must mount the queue directory
+(and the media folders the tasks name) at the same path, on a filesystem with atomic renames (local disk, NFS).
+
+Layout of the queue directory:
+    tasks/<id>.json      waiting tasks
+    leases/<id>.json     claimed tasks; the file's mtime is the last heartbeat of the worker running it
+    results/<id>.json    outputs of finished tasks
+    failed/<id>.json     tasks that failed `max_attempts` times
+    workers/<name>.json  last heartbeat of every running worker; the live workers share the LLM request rate
+    STOP                 workers exit when this file exists
+
+Example, on every node:
+    python -m telellmgram.utils.queue_utils --root /shared/queue --processes 4
+"""
+
+import os
+import json
+import time
+import socket
+import hashlib
+import functools
+import argparse
+import threading
+import multiprocessing
+from telellmgram.utils import llm_utils
+from telellmgram.utils.llm_utils import LLM_CONFIG, LLM_ERROR_PREFIX, LLM_RATE_LIMITER, LLMCallCancelled, LLMCallFailed, LLMResponseCache, \
+    RateLimiter, call_llm
+from telellmgram.utils.trace_utils import TRACER, traced_sleep
+
+QUEUE_DIRS = ("tasks", "leases", "results", "failed", "workers")
+
+
+def task_id(kind, args, version=""):
+    """Tasks are named by their content, so submitting the same task twice queues it once."""
+    payload = json.dumps({"kind": kind, "args": args, "version": version}, sort_keys=True, ensure_ascii=False)
+    return f"{kind}-{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:20]}"
+
+
+def _write_json(path, data):
+    tmp = f"{path}.{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, default=str)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class WorkQueue:
+    """One queue directory, used by the coordinator (`submit`, `wait`) and the workers (`claim`, `complete`, `fail`).
+    Results are JSON: a task returns its output, and the coordinator merges the outputs in its own order, so the merged
+    result does not depend on which worker ran what, or how many times a task was run.
+    """
+    def __init__(self, root, lease_seconds=60, max_attempts=3):
+        self.root = root
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        for name in QUEUE_DIRS:
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+
+    def _path(self, state, tid):
+        return os.path.join(self.root, state, tid + ".json")
+
+    def submit(self, kind, args, version=""):
+        """Queues a task unless it is already waiting, running or done; `version` (e.g. of its input file) is part
+        of the task id, so a changed input is run again. Returns the task id.
+        """
+        tid = task_id(kind, args, version)
+        if any(os.path.exists(self._path(state, tid)) for state in ("tasks", "leases", "results")):
+            return tid
+        _remove(self._path("failed", tid))
+        _write_json(self._path("tasks", tid), {"id": tid, "kind": kind, "args": args, "attempts": 0, "submitted": time.time(), "error": None})
+        return tid
+
+    def discard(self, tid):
+        """Forgets the result of a task, so submitting it again runs it again."""
+        _remove(self._path("results", tid))
+
+    def claim(self, worker):
+        """Takes the oldest waiting task, or returns None. The rename from tasks/ to leases/ succeeds for one worker only."""
+        tasks_dir = os.path.join(self.root, "tasks")
+        names = [name for name in os.listdir(tasks_dir) if name.endswith(".json")]
+        for name in sorted(names, key=lambda name: self._mtime(os.path.join(tasks_dir, name))):
+            tid = name[:-len(".json")]
+            try:
+                os.utime(self._path("tasks", tid))  # the rename keeps the mtime: start the lease from now
+                os.rename(self._path("tasks", tid), self._path("leases", tid))
+            except FileNotFoundError:
+                continue  # claimed by another worker
+            task = _read_json(self._path("leases", tid))
+            if task is None:
+                continue
+            if os.path.exists(self._path("results", tid)):
+                _remove(self._path("leases", tid))  # a requeued copy of a task that finished meanwhile
+                continue
+            task.update(worker=worker, claimed=time.time())
+            _write_json(self._path("leases", tid), task)
+            return task
+        return None
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except FileNotFoundError:
+            return float("inf")
+
+    def heartbeat(self, worker, task_ids=()):
+        """Extends the leases of the tasks a worker is running."""
+        for tid in task_ids:
+            try:
+                os.utime(self._path("leases", tid))
+            except FileNotFoundError:
+                pass  # requeued; the result is still accepted when it finishes
+        _write_json(self._path("workers", worker), {"worker": worker, "heartbeat": time.time(), "tasks": list(task_ids)})
+
+    def live_workers(self):
+        """Number of workers that heartbeated within the lease (by the mtime of their file, like the leases)."""
+        workers_dir, now = os.path.join(self.root, "workers"), time.time()
+        return len([name for name in os.listdir(workers_dir)
+                    if name.endswith(".json") and now - self._mtime(os.path.join(workers_dir, name)) <= self.lease_seconds])
+
+    def complete(self, task, result):
+        _write_json(self._path("results", task["id"]), {"id": task["id"], "kind": task["kind"], "result": result,
+                                                       "worker": task.get("worker"), "finished": time.time()})
+        _remove(self._path("leases", task["id"]))
+        _remove(self._path("tasks", task["id"]))
+
+    def fail(self, task, error):
+        """Queues a failed task again, or moves it to failed/ after `max_attempts` attempts."""
+        task = {**task, "attempts": task["attempts"] + 1, "error": error}
+        _write_json(self._path("failed" if task["attempts"] >= self.max_attempts else "tasks", task["id"]), task)
+        _remove(self._path("leases", task["id"]))
+
+    def requeue_expired(self):
+        """Queues again the tasks whose worker stopped heartbeating. Safe to call from several nodes at once: a lease
+        is first renamed to a name private to the caller. Returns the number of requeued tasks.
+        """
+        leases_dir = os.path.join(self.root, "leases")
+        requeued, now = 0, time.time()
+        for name in os.listdir(leases_dir):
+            if not name.endswith(".json") or now - self._mtime(os.path.join(leases_dir, name)) <= self.lease_seconds:
+                continue
+            private = os.path.join(leases_dir, f"{name}.{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}.expired")
+            try:
+                os.rename(os.path.join(leases_dir, name), private)
+            except FileNotFoundError:
+                continue
+            task = _read_json(private)
+            os.remove(private)
+            if task is None or os.path.exists(self._path("results", task["id"])):
+                continue
+            print(f"[Runtime Log] -- Task {task['id']} of worker {task.get('worker')} expired; queued again.")
+            self.fail(task, f"lease expired: worker {task.get('worker')} stopped heartbeating")
+            requeued += 1
+        return requeued
+
+    def results(self, task_ids):
+        """{task id: output} of the finished tasks among `task_ids`."""
+        outputs = {}
+        for tid in task_ids:
+            record = _read_json(self._path("results", tid))
+            if record is not None:
+                outputs[tid] = record["result"]
+        return outputs
+
+    def wait(self, task_ids, poll_seconds=1.0, on_progress=None, cancel_event=None):
+        """Outputs of `task_ids` ({task id: output}) once all are done. Requeues expired leases while waiting and
+        raises RuntimeError when a task failed for good.
+        """
+        task_ids = list(dict.fromkeys(task_ids))
+        outputs = {}
+        while True:
+            outputs.update(self.results([tid for tid in task_ids if tid not in outputs]))
+            if on_progress is not None:
+                on_progress(len(outputs), len(task_ids))
+            if len(outputs) == len(task_ids):
+                return outputs
+            failed = [tid for tid in task_ids if tid not in outputs and os.path.exists(self._path("failed", tid))]
+            if failed:
+                errors = {tid: (_read_json(self._path("failed", tid)) or {}).get("error") for tid in failed}
+                raise RuntimeError(f"{len(failed)} tasks failed: {errors}")
+            self.requeue_expired()
+            traced_sleep(poll_seconds, reason="queue_wait", cancel_event=cancel_event)
+            if cancel_event is not None and cancel_event.is_set():
+                raise LLMCallCancelled()
+
+    def status(self):
+        counts = {state: len([n for n in os.listdir(os.path.join(self.root, state)) if n.endswith(".json")]) for state in QUEUE_DIRS}
+        workers = [_read_json(os.path.join(self.root, "workers", name)) for name in sorted(os.listdir(os.path.join(self.root, "workers")))
+                   if name.endswith(".json")]
+        return {**counts, "workers": [worker for worker in workers if worker is not None]}
+
+    def stop_workers(self):
+        open(os.path.join(self.root, "STOP"), "w").close()
+
+
+class QueueRateLimiter(RateLimiter):
+    """The share of one worker in the LLM budget of the whole queue: `requests_per_minute` (default the configured
+    rate) is divided by the number of live workers, counted again every `refresh_seconds`, so adding nodes does not
+    multiply the request rate the endpoint sees.
+    """
+    def __init__(self, queue, requests_per_minute=None, max_concurrent=None, refresh_seconds=10):
+        self.queue = queue
+        self.requests_per_minute = requests_per_minute or LLM_CONFIG.requests_per_minute
+        self.refresh_seconds = refresh_seconds
+        self._counted = None
+        super().__init__(self.requests_per_minute, max_concurrent)
+
+    def _wait_turn(self, cancel_event):
+        now = time.monotonic()
+        if self._counted is None or now - self._counted > self.refresh_seconds:
+            self._counted = now
+            self.interval = 60.0 * max(1, self.queue.live_workers()) / self.requests_per_minute
+        super()._wait_turn(cancel_event)
+
+
+def map_chunk_task(prompt, limiter=LLM_RATE_LIMITER):
+    """Response of one map prompt. A failed LLM call raises, so the task is retried (`fail`) instead of storing the error."""
+    return call_llm(prompt, limiter=limiter, raise_errors=True)
+
+
+def task_handlers(queue=None):
+    """Functions running each kind of task, called with the task's args. With `queue`, LLM calls are paced by the
+    worker's share of the queue-wide rate (QueueRateLimiter) instead of the per-process limiter.
+    """
+    from telellmgram.media.parse_all_media import parse_export_task
+    limiter = QueueRateLimiter(queue) if queue is not None else LLM_RATE_LIMITER
+    return {"parse_export": parse_export_task, "map_chunk": functools.partial(map_chunk_task, limiter=limiter)}
+
+
+def run_worker(root, worker=None, lease_seconds=60, poll_seconds=1.0, idle_exit=None, max_tasks=None):
+    """Runs tasks of the queue at `root` until its STOP file appears, `idle_exit` seconds pass without a task or
+    `max_tasks` tasks are done. A heartbeat thread keeps the lease of the running task alive. Returns the tasks done.
+    """
+    queue = WorkQueue(root, lease_seconds)
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    handlers = task_handlers(queue)
+    running, stopped = set(), threading.Event()
+
+    def beat():
+        while not stopped.wait(lease_seconds / 3):
+            queue.heartbeat(worker, list(running))
+
+    threading.Thread(target=beat, daemon=True, name=f"heartbeat-{worker}").start()
+    queue.heartbeat(worker)
+    done, idle_since = 0, time.time()
+    try:
+        while not os.path.exists(os.path.join(root, "STOP")) and (max_tasks is None or done < max_tasks):
+            task = queue.claim(worker)
+            if task is None:
+                queue.requeue_expired()
+                if idle_exit is not None and time.time() - idle_since > idle_exit:
+                    break
+                time.sleep(poll_seconds)
+                continue
+            running.add(task["id"])
+            try:
+                with TRACER.span("task", kind=task["kind"], worker=worker):
+                    result = handlers[task["kind"]](**task["args"])
+            except Exception as e:
+                print(f"[Runtime Log] -- Task {task['id']} failed on {worker}: {type(e).__name__}: {e}")
+                queue.fail(task, f"{type(e).__name__}: {e}")
+            else:
+                queue.complete(task, result)
+            finally:
+                running.discard(task["id"])
+            done, idle_since = done + 1, time.time()
+    finally:
+        stopped.set()
+        _remove(os.path.join(root, "workers", worker + ".json"))  # no longer counted in the rate budget
+    return done
+
+
+class WorkQueueMapper:
+    """Runs the map prompts of a pipeline as "map_chunk" tasks of a work queue (`RunControl(batch=...)`) and returns
+    the responses in chunk order. Prompts the LLM response cache already answers are not queued. A chunk whose task
+    failed for good raises (RuntimeError from `wait`); only real responses are added to the cache.
+    """
+    def __init__(self, queue, poll_seconds=2.0):
+        self.queue = queue
+        self.poll_seconds = poll_seconds
+
+    def map(self, prompts, control):
+        cache, model_name = llm_utils.LLM_CACHE, llm_utils.LLM_CONFIG.model_name
+        keys = [LLMResponseCache.key(model_name, prompt) for prompt in prompts]
+        cached = {i: cache.get(key) for i, key in enumerate(keys) if cache is not None and key in cache}
+        ids = {i: self.queue.submit("map_chunk", {"prompt": prompt}, model_name) for i, prompt in enumerate(prompts) if i not in cached}
+        with TRACER.span("queue_map", chunks=len(prompts), cache_hits=len(cached)):
+            outputs = self.queue.wait(ids.values(), self.poll_seconds, cancel_event=control.cancel_event,
+                                      on_progress=lambda done, total: control.progress("llm_map", done, total))
+        failed = [i for i in ids if outputs[ids[i]].startswith(LLM_ERROR_PREFIX)]  # stored by workers of older versions
+        for i in failed:
+            self.queue.discard(ids[i])
+        if failed:
+            raise LLMCallFailed(f"{len(failed)} map chunks failed: {outputs[ids[failed[0]]]}")
+        responses = []
+        for i, prompt in enumerate(prompts):
+            text = cached[i] if i in cached else outputs[ids[i]]
+            if cache is not None and i not in cached:
+                cache.put(keys[i], text)
+            control.partial(i, text)
+            responses.append(text)
+        return responses
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Worker of a shared-directory work queue (ingestion and map tasks).")
+    parser.add_argument("--root", required=True, help="Queue directory, mounted at the same path on every node.")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes started on this node.")
+    parser.add_argument("--lease-seconds", type=float, default=60)
+    parser.add_argument("--idle-exit", type=float, default=None, help="Exit after this many seconds without a task.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    kwargs = {"lease_seconds": args.lease_seconds, "idle_exit": args.idle_exit}
+    if args.processes == 1:
+        return run_worker(args.root, **kwargs)
+    processes = [multiprocessing.Process(target=run_worker, args=(args.root,), kwargs=kwargs) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
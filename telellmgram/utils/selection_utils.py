@@ -0,0 +1,91 @@
+"""Selecting a small, diverse and engaging subset of messages to spend the LLM token budget on."""
+
+import numpy as np
+from telellmgram.utils.index_utils import HashedNgramEmbedder
+from telellmgram.utils.text_utils import engagement_from_reactions
+
+
+def minibatch_kmeans(x, n_clusters, batch_size=1024, n_iter=50, seed=13):
+    """Mini-batch k-means (Sculley, 2010). Returns (centroids, labels)."""
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, min(n_clusters, len(x)))
+    centroids = x[rng.choice(len(x), size=n_clusters, replace=False)].astype(np.float32)
+    seen = np.zeros(n_clusters, dtype=np.int64)
+    for _ in range(n_iter):
+        batch = x[rng.integers(0, len(x), size=min(batch_size, len(x)))]
+        nearest = np.argmin(_sq_distances(batch, centroids), axis=1)
+        for c in np.unique(nearest):
+            members = batch[nearest == c]
+            seen[c] += len(members)
+            centroids[c] += (members.sum(axis=0) - len(members) * centroids[c]) / seen[c]
+    labels = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), 65_536):
+        labels[start:start+65_536] = np.argmin(_sq_distances(x[start:start+65_536], centroids), axis=1)
+    return centroids, labels
+
+
+def _sq_distances(x, centroids):
+    return (x * x).sum(axis=1)[:, None] - 2 * x @ centroids.T + (centroids * centroids).sum(axis=1)[None, :]
+
+
+def _mmr(features, weights, costs, budget, diversity, shortlist):
+    """Greedy maximal marginal relevance under a cost budget. Returns picked positions and the spent cost."""
+    order = np.argsort(-weights, kind="stable")[:shortlist]
+    features, weights, costs = features[order], weights[order], costs[order]
+    max_sim = np.zeros(len(order), dtype=np.float32)
+    available = costs <= budget
+    picked, spent = [], 0
+    while available.any():
+        gain = np.where(available, (1 - diversity) * weights - diversity * max_sim, -np.inf)
+        j = int(np.argmax(gain))
+        picked.append(order[j])
+        spent += costs[j]
+        available[j] = False
+        available &= costs <= budget - spent
+        max_sim = np.maximum(max_sim, features @ features[j])
+    return picked, spent
+
+
+def select_messages(texts, budget, costs=None, engagement=None, n_clusters=None, diversity=0.5, seed=13):
+    """Picks a budget-constrained, diverse and engagement-weighted subset of messages.
+    Messages are clustered with mini-batch k-means over hashed n-gram features. Each cluster gets a share of the budget
+    proportional to the square root of its size, so minority topics are still covered, and is filled with MMR.
+    Budget left over by small clusters is spent on the best remaining messages of the whole set.
+    Args:
+        texts: list of message texts.
+        budget: total cost allowed; with `costs=None` it is simply the number of messages.
+        costs: per message cost, e.g. the formatted length in characters.
+        engagement: per message engagement (reaction totals). Higher engagement is preferred.
+        diversity: MMR trade-off between engagement (0) and novelty (1).
+    Returns:
+        Sorted positions of the selected messages, so callers keep the original (chronological) order.
+    """
+    n = len(texts)
+    costs = np.ones(n, dtype=np.int64) if costs is None else np.asarray(costs, dtype=np.int64)
+    if n == 0 or costs.sum() <= budget:
+        return np.arange(n)
+    engagement = np.zeros(n) if engagement is None else np.asarray(engagement, dtype=np.float64)
+    weights = np.log1p(np.maximum(engagement, 0))
+    weights = (weights / weights.max() if weights.max() > 0 else weights).astype(np.float32)
+
+    features = HashedNgramEmbedder(dim=128, ngram_range=(3, 4), seed=seed).embed(texts)
+    n_clusters = n_clusters or int(np.clip(np.sqrt(n / 2), 2, 64))
+    _, labels = minibatch_kmeans(features, n_clusters, seed=seed)
+
+    sizes = np.bincount(labels, minlength=n_clusters)
+    shares = np.sqrt(sizes) / np.sqrt(sizes).sum()
+    selected, spent = [], 0
+    for c in np.flatnonzero(sizes):
+        members = np.flatnonzero(labels == c)
+        quota = int(budget * shares[c])
+        shortlist = max(64, 20 * int(quota / max(np.median(costs[members]), 1)))
+        picked, used = _mmr(features[members], weights[members], costs[members], quota, diversity, shortlist)
+        selected.extend(members[picked])
+        spent += used
+
+    rest = np.setdiff1d(np.arange(n), selected)
+    for i in rest[np.argsort(-weights[rest], kind="stable")]:
+        if spent + costs[i] <= budget:
+            selected.append(i)
+            spent += costs[i]
+    return np.sort(np.asarray(selected, dtype=np.int64))
@@ -0,0 +1,95 @@
+"""Fixed-memory streaming summaries: count-min sketch and SpaceSaving heavy hitters."""
+
+import zlib
+import heapq
+import numpy as np
+
+
+class CountMinSketch:
+    """Approximate counts of arbitrary string keys in a `depth x width` table (Cormode & Muthukrishnan, 2005).
+    Estimates never undercount; the overcount is at most 2 * total / width with probability 1 - 2^-depth.
+    Rows are addressed with double hashing, (h1 + row * h2) mod width, from two crc32 hashes of the key.
+    """
+    def __init__(self, width=2048, depth=4, seed=13):
+        self.width = width
+        self.depth = depth
+        self.seed = seed
+        self.table = np.zeros((depth, width), dtype=np.int32)
+        self.total = 0
+
+    def _indexes(self, keys):
+        encoded = [key.encode("utf-8") for key in keys]
+        h1 = np.fromiter((zlib.crc32(key) for key in encoded), dtype=np.uint64, count=len(encoded))
+        h2 = np.fromiter((zlib.crc32(key, self.seed) | 1 for key in encoded), dtype=np.uint64, count=len(encoded))
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        return ((h1[None, :] + rows * h2[None, :]) % np.uint64(self.width)).astype(np.int64)
+
+    def add(self, keys, counts):
+        counts = np.asarray(counts, dtype=np.int32)
+        indexes = self._indexes(keys)
+        for row in range(self.depth):
+            np.add.at(self.table[row], indexes[row], counts)
+        self.total += int(counts.sum())
+
+    def estimate(self, keys):
+        if not len(keys):
+            return np.zeros(0, dtype=np.int64)
+        indexes = self._indexes(keys)
+        return self.table[np.arange(self.depth)[:, None], indexes].min(axis=0).astype(np.int64)
+
+    def clear(self):
+        self.table[:] = 0
+        self.total = 0
+
+
+class SpaceSaving:
+    """Top-`capacity` heavy hitters (Metwally et al., 2005). A new key evicts the smallest counter and inherits its
+    count as error, so every key with a true count above total / capacity is guaranteed to be tracked.
+    The smallest counter is found with a min-heap holding one (count, key) entry per tracked key. Increments do not
+    touch the heap: counts only grow, so a stale entry is too low and is pushed back down with the current count
+    when it reaches the top, before an eviction.
+    """
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self._heap = []
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "_heap" not in state:  # pickled before the heap existed
+            self._heap = [(count, key) for key, count in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def add(self, key, count=1):
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+            heapq.heappush(self._heap, (count, key))
+        else:
+            while self._heap[0][0] != self.counts[self._heap[0][1]]:
+                stale = self._heap[0][1]
+                heapq.heapreplace(self._heap, (self.counts[stale], stale))
+            floor, smallest = self._heap[0]
+            del self.counts[smallest]
+            self.errors.pop(smallest)
+            self.counts[key] = floor + count
+            self.errors[key] = floor
+            heapq.heapreplace(self._heap, (floor + count, key))
+
+    def add_counts(self, counter):
+        # Largest first, so frequent keys of the batch are not evicted by the rare ones that follow them.
+        for key, count in sorted(counter.items(), key=lambda item: -item[1]):
+            self.add(key, count)
+
+    def top(self, k=None):
+        """[(key, count, error)] by decreasing count."""
+        items = sorted(self.counts.items(), key=lambda item: -item[1])[:k]
+        return [(key, count, self.errors[key]) for key, count in items]
+
+    def clear(self):
+        self.counts.clear()
+        self.errors.clear()
+        self._heap.clear()
@@ -0,0 +1,182 @@
+"""Local spam and advert scoring of messages, cheap enough to run in batch at ingest.
+A logistic model over hashed word unigrams and bigrams of `cleaned_text` plus a few dense heuristics: link, mention
+and hashtag density, digits and symbols, and how often the same text is repeated in the media.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from os.path import dirname
+
+dir_root = dirname(dirname(__file__))
+spam_model_file = os.path.join(dir_root, "media", "spam_model.npz")
+
+DENSE_FEATURES = ("links_per_token", "mentions_per_token", "hashtags_per_token", "repeats", "digit_ratio", "symbol_ratio")
+# Starting weights of the model, used as is until it is trained on the corpus (`build_spam_model`).
+SEED_BIAS = -4.0
+SEED_DENSE_WEIGHTS = (3.0, 5.0, 2.0, 1.0, 3.0, 3.0)
+SEED_LEXICON = {
+    # advert, gambling and "join our channel" vocabulary; phrases are matched as word bigrams
+    "تبلیغات": 1.5, "کازینو": 2.0, "بونوس": 2.0, "شرط بندی": 2.0, "شرطبندی": 2.0, "ایردراپ": 2.0, "سیگنال": 1.2,
+    "کد تخفیف": 1.5, "جوین": 1.5, "درآمد دلاری": 1.5, "سود تضمینی": 1.5, "casino": 2.0, "bonus": 1.5, "airdrop": 2.0,
+    "تخفیف": 0.8, "سفارش": 0.8, "رایگان": 0.8, "درآمد": 0.8, "ثبت نام": 0.8, "ثبتنام": 0.8, "واتساپ": 0.8, "فالو": 0.8,
+    "vip": 0.8, "free": 0.8, "عضو": 0.4, "لینک": 0.4, "کلیک": 0.4, "خرید": 0.4, "فروش": 0.4, "قیمت": 0.4, "تومان": 0.4,
+}
+_BIGRAM_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _word_hashes(texts):
+    """(message position, 64-bit hash) of the words and word bigrams of every text."""
+    words = pd.Series(texts, dtype=object).where(lambda t: t.map(lambda v: isinstance(v, str)), "")
+    words = words.str.replace("\u200c", "", regex=False).str.lower().str.split().explode().dropna()
+    positions = words.index.to_numpy(dtype=np.int64)
+    hashes = pd.util.hash_array(words.to_numpy(dtype=object))
+    same = positions[1:] == positions[:-1]
+    with np.errstate(over="ignore"):
+        bigrams = hashes[:-1][same] * _BIGRAM_MIX + hashes[1:][same]
+    return np.concatenate([positions, positions[:-1][same]]), np.concatenate([hashes, bigrams])
+
+
+def _text_column(table, column):
+    if column not in table.columns:
+        return pd.Series("", index=range(len(table)), dtype=object)
+    values = table[column].to_numpy(dtype=object)
+    return pd.Series(values, dtype=object).where(lambda t: t.map(lambda v: isinstance(v, str)), "")
+
+
+def dense_features(table):
+    """(n_messages, len(DENSE_FEATURES)) float32 heuristics of a messages table (`cleaned_text`, `links`, `hashtags`).
+    `repeats` is log(1 + other copies) of the text in the table, digits and whitespace ignored, for texts of 3+ words.
+    """
+    texts = _text_column(table, "cleaned_text")
+    links = _text_column(table, "links")
+    hashtags = _text_column(table, "hashtags")
+    tokens = texts.str.count(r"\S+").to_numpy(dtype=np.float32) + 1.0
+    n_links = np.where(links.str.len() > 0, links.str.count(",") + 1, 0)
+    n_mentions = (links.str.count(r"(?:^|,)@") + links.str.count(r"t(?:elegram)?\.me/")).to_numpy()
+    n_hashtags = np.where(hashtags.str.len() > 0, hashtags.str.count(",") + 1, 0)
+    fingerprints = texts.str.replace(r"[\d۰-۹\s]+", "", regex=True).str.lower()
+    copies = fingerprints.map(fingerprints.value_counts()).to_numpy(dtype=np.float32)
+    copies = np.where((tokens > 3) & (fingerprints.str.len() > 0).to_numpy(), copies - 1, 0)
+    chars = texts.str.count(r"\S").to_numpy(dtype=np.float32) + 1.0
+    digits = texts.str.count(r"[\d۰-۹]").to_numpy(dtype=np.float32)
+    symbols = texts.str.count(r"[^\w\s]").to_numpy(dtype=np.float32)
+    return np.stack([np.maximum(n_links - n_mentions, 0) / tokens, n_mentions / tokens, n_hashtags / tokens,
+                     np.log1p(copies), digits / chars, symbols / chars], axis=1).astype(np.float32)
+
+
+class SpamModel:
+    """Logistic model: P(spam) = sigmoid(bias + dense . dense_weights + sum of the weights of the hashed n-grams / sqrt(words)).
+    n-grams are hashed into `n_buckets` weights, so the model has a fixed size whatever the vocabulary.
+    """
+    def __init__(self, weights=None, dense_weights=None, bias=SEED_BIAS, n_buckets=2**18):
+        self.n_buckets = int(n_buckets)
+        self.weights = np.asarray(weights, dtype=np.float32) if weights is not None else np.zeros(self.n_buckets, dtype=np.float32)
+        self.dense_weights = np.asarray(dense_weights if dense_weights is not None else SEED_DENSE_WEIGHTS, dtype=np.float32)
+        self.bias = float(bias)
+
+    @classmethod
+    def seed(cls, n_buckets=2**18):
+        """Untrained model: heuristic dense weights and the advert lexicon."""
+        model = cls(n_buckets=n_buckets)
+        for phrase, weight in SEED_LEXICON.items():
+            # the last n-gram of a phrase is the word itself, or the bigram of a two word phrase
+            _, hashes = _word_hashes([phrase])
+            model.weights[hashes[-1] % np.uint64(model.n_buckets)] += weight
+        return model
+
+    @classmethod
+    def load(cls, path=spam_model_file):
+        if not os.path.exists(path):
+            return cls.seed()
+        with np.load(path) as data:
+            return cls(data["weights"], data["dense_weights"], float(data["bias"]), len(data["weights"]))
+
+    def save(self, path=spam_model_file):
+        np.savez_compressed(path, weights=self.weights, dense_weights=self.dense_weights, bias=np.float64(self.bias))
+
+    def features(self, table):
+        """(message position, bucket, value) of the hashed n-grams and the dense features of a messages table."""
+        positions, hashes = _word_hashes(table["cleaned_text"].to_numpy(dtype=object) if "cleaned_text" in table.columns
+                                         else np.full(len(table), ""))
+        n_words = np.bincount(positions, minlength=len(table))
+        values = 1.0 / np.sqrt(np.maximum(n_words[positions], 1)).astype(np.float32)
+        return positions, (hashes % np.uint64(self.n_buckets)).astype(np.int64), values, dense_features(table)
+
+    def _logits(self, features, n):
+        positions, buckets, values, dense = features
+        return np.bincount(positions, weights=self.weights[buckets] * values, minlength=n) + dense @ self.dense_weights + self.bias
+
+    def scores(self, table):
+        """Spam probability of every message, float32."""
+        if not len(table):
+            return np.zeros(0, dtype=np.float32)
+        logits = self._logits(self.features(table), len(table))
+        return (1.0 / (1.0 + np.exp(-np.clip(logits, -30, 30)))).astype(np.float32)
+
+    def fit(self, tables, labels, iterations=200, lr=0.5, l2=1e-3):
+        """Trains on messages tables with one label per message (1 spam, 0 not spam, -1 ignored) by full batch
+        logistic regression with Adagrad steps, the two classes weighted equally. The L2 penalty pulls the parameters
+        towards their values before training (e.g. the seed model) rather than towards zero.
+        """
+        prior_w, prior_dense, prior_bias = self.weights.astype(np.float64), self.dense_weights.astype(np.float64), self.bias
+        features = [self.features(table) for table in tables]
+        labels = [np.asarray(label, dtype=np.float64) for label in labels]
+        n_pos = max(sum(int((label == 1).sum()) for label in labels), 1)
+        n_neg = max(sum(int((label == 0).sum()) for label in labels), 1)
+        sample_weights = [np.where(label == 1, 0.5 / n_pos, np.where(label == 0, 0.5 / n_neg, 0.0)) for label in labels]
+        history = [np.zeros(self.n_buckets), np.zeros(len(self.dense_weights)), 0.0]
+        for _ in range(iterations):
+            grad_w = l2 * (self.weights - prior_w)
+            grad_dense, grad_bias = l2 * (self.dense_weights - prior_dense), l2 * (self.bias - prior_bias)
+            for (positions, buckets, values, dense), label, weight in zip(features, labels, sample_weights):
+                logits = self._logits((positions, buckets, values, dense), len(label))
+                error = (1.0 / (1.0 + np.exp(-np.clip(logits, -30, 30))) - np.maximum(label, 0)) * weight
+                grad_w += np.bincount(buckets, weights=error[positions] * values, minlength=self.n_buckets)
+                grad_dense += dense.T @ error
+                grad_bias += error.sum()
+            for i, grad in enumerate((grad_w, grad_dense, grad_bias)):
+                history[i] = history[i] + grad ** 2
+            self.weights -= (lr * grad_w / (np.sqrt(history[0]) + 1e-8)).astype(np.float32)
+            self.dense_weights -= (lr * grad_dense / (np.sqrt(history[1]) + 1e-8)).astype(np.float32)
+            self.bias -= lr * grad_bias / (np.sqrt(history[2]) + 1e-8)
+        return self
+
+
+def weak_labels(scores, low=0.05, high=0.8):
+    """Labels of the seed model's confident decisions: 1 above `high`, 0 below `low`, -1 (ignored) in between."""
+    return np.where(scores >= high, 1, np.where(scores <= low, 0, -1))
+
+
+SPAM_MODEL = None
+
+
+def get_spam_model():
+    global SPAM_MODEL
+    if SPAM_MODEL is None:
+        SPAM_MODEL = SpamModel.load()
+    return SPAM_MODEL
+
+
+def spam_scores(table):
+    return get_spam_model().scores(table)
+
+
+def build_spam_model(metadata_table, read_table, iterations=200, min_positives=50):
+    """Trains the model on every media in `metadata_table` without hand labels: the confident decisions of the seed
+    model (lexicon and heuristics) are the labels, and the hashed n-grams learn the rest of the advert vocabulary from
+    them. With fewer than `min_positives` confident spam messages the seed model is kept, as the labels would only
+    teach it the few spam messages seen. `read_table(path)` returns a parsed messages table.
+    """
+    global SPAM_MODEL
+    seed = SpamModel.seed()
+    tables = [read_table(messages_file) for messages_file in dict.fromkeys(metadata_table['messages'])]
+    labels = [weak_labels(seed.scores(table)) for table in tables]
+    positives = sum(int((label == 1).sum()) for label in labels)
+    if positives < min_positives:
+        print(f"[Runtime Log] -- Only {positives} confident spam messages; keeping the seed spam model.")
+        SPAM_MODEL = seed
+    else:
+        SPAM_MODEL = seed.fit(tables, labels, iterations=iterations)
+    SPAM_MODEL.save()
+    return SPAM_MODEL
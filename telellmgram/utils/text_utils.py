@@ -2,6 +2,10 @@
 
 import re
 import hashlib
+import numpy as np
+import pandas as pd
+from telellmgram.utils.thread_utils import ThreadIndex
+from telellmgram.utils.spam_utils import spam_scores
 
 persian_alphabets_normalized = {
     'ي': 'ی',  # Arabic ي to Persian ی
@@ -82,13 +86,74 @@ def generate_unique_key(input_string):
     return unique_key
 
 
+# Persian alphabet letters
+persian_letters = "ابپتثجچحخدذرزژسشصضطظعغفقکگلمنوهی"
+_persian_letters_lut = np.zeros(0x10000, dtype=bool)
+_persian_letters_lut[[ord(c) for c in persian_letters]] = True
+
+
 def count_persian_letters(text):
-    # Persian alphabet letters
-    persian_letters = "ابپتثجچحخدذرزژسشصضطظعغفقکگلمنوهی"
-    
     count = 0
     for char in text:
         if char in persian_letters:
             count += 1
     return count
 
+
+def count_persian_letters_series(texts):
+    """Vectorized `count_persian_letters` over a pandas Series. Non-string values count as 0.
+    All strings are concatenated into one UTF-32 code point array, letters are flagged with a lookup table and
+    counted per string through a cumulative sum.
+    """
+    is_str = texts.map(lambda t: isinstance(t, str)).to_numpy(dtype=bool)
+    strings = texts[is_str].tolist()
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+    code_points = np.frombuffer("".join(strings).encode("utf-32-le"), dtype=np.uint32)
+    hits = np.concatenate([[0], np.cumsum(_persian_letters_lut[np.minimum(code_points, 0xFFFF)], dtype=np.int64)])
+    ends = np.cumsum(lengths)
+    counts = np.zeros(len(texts), dtype=np.int64)
+    counts[is_str] = hits[ends] - hits[ends - lengths]
+    return pd.Series(counts, index=texts.index)
+
+
+# Rough number of characters per LLM token for our mostly Persian messages.
+CHARS_PER_TOKEN = 3.0
+
+
+def engagement_from_reactions(reactions):
+    """Total reaction count per message from the `emoji:count,emoji:count` strings written by the parser."""
+    counts = pd.Series(reactions, dtype=object).fillna("").map(str).str.findall(r":(\d+)")
+    return counts.map(lambda c: sum(map(int, c))).to_numpy(dtype=np.int64)
+
+
+def add_message_features(table):
+    """Adds the per-message feature columns pipelines filter on, so they never have to touch the text again:
+        - persian_letters : number of Persian letters in `cleaned_text`
+        - token_count : number of whitespace separated tokens in `cleaned_text`
+        - est_tokens : estimated length of `cleaned_text` in LLM tokens
+        - persian_ratio : share of Persian letters among all letters of `cleaned_text`
+        - has_link, has_hashtag : whether the message carried links / hashtags
+        - engagement : total number of reactions
+        - timestamp, hour : send time as unix seconds and hour of day
+        - thread_id, reply_depth : message id of the reply thread root and number of replies up to it
+        - spam_score : probability that the message is spam or an advert (see spam_utils)
+    Returns the same table with the columns added.
+    """
+    texts = table['cleaned_text'].where(table['cleaned_text'].map(lambda t: isinstance(t, str)), "").astype(object)
+    persian = count_persian_letters_series(texts)
+    letters = texts.str.count(r"[^\W\d_]")
+    table['persian_letters'] = persian.astype("int32")
+    table['token_count'] = texts.str.count(r"\S+").astype("int32")
+    table['est_tokens'] = np.ceil(texts.str.len() / CHARS_PER_TOKEN).astype("int32")
+    table['persian_ratio'] = (persian / letters.clip(lower=1)).astype("float32")
+    table['has_link'] = table['links'].fillna("").astype(str).str.len().gt(0) if 'links' in table else False
+    table['has_hashtag'] = table['hashtags'].fillna("").astype(str).str.len().gt(0) if 'hashtags' in table else False
+    table['engagement'] = engagement_from_reactions(table['reactions']).astype("int32") if 'reactions' in table else 0
+    sent = pd.to_datetime(table['date'].astype(str) + " " + table['time'].astype(str), format="%d/%m/%y %H:%M:%S", errors="coerce")
+    table['timestamp'] = ((sent - pd.Timestamp("1970-01-01")) // pd.Timedelta(seconds=1)).fillna(-1).astype("int64")
+    table['hour'] = sent.dt.hour.fillna(-1).astype("int8")
+    threads = ThreadIndex(table)
+    table['thread_id'] = threads.message_ids[threads.root]
+    table['reply_depth'] = threads.depth.astype("int16")
+    table['spam_score'] = spam_scores(table)
+    return table
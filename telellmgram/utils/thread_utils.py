@@ -0,0 +1,113 @@
+"""Reply threads of group messages, as arrays keyed by row offset."""
+
+import numpy as np
+import pandas as pd
+
+
+class ThreadIndex:
+    """Reply tree of a messages table (`message_id`, `reply_to_message_id`), one entry per row:
+        - parent : row of the replied message, -1 for thread roots
+        - first_child, next_sibling : the replies of a row, in row order, as linked lists (-1 ends a list)
+        - root : row of the thread root, depth : number of replies up to it
+    A reply to a message missing from the table (deleted, or outside a date filter) starts its own thread. Only replies
+    to older messages are linked, so the index is always a forest.
+    """
+    def __init__(self, table):
+        n = len(table)
+        ids = table['message_id'].to_numpy(dtype=np.int64)
+        self.parent = np.full(n, -1, dtype=np.int64)
+        if 'reply_to_message_id' in table.columns and n:
+            reply_to = pd.to_numeric(table['reply_to_message_id'], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+            order = np.argsort(ids, kind="stable")
+            replies = np.flatnonzero(~np.isnan(reply_to))
+            targets = reply_to[replies].astype(np.int64)
+            found = np.minimum(np.searchsorted(ids[order], targets), n - 1)
+            linked = (ids[order][found] == targets) & (targets < ids[replies])
+            self.parent[replies[linked]] = order[found[linked]]
+
+        # children grouped by parent, in row order: first_child of a parent and the next row of the same group
+        self.first_child = np.full(n, -1, dtype=np.int64)
+        self.next_sibling = np.full(n, -1, dtype=np.int64)
+        children = np.flatnonzero(self.parent >= 0)
+        children = children[np.argsort(self.parent[children], kind="stable")]
+        parents = self.parent[children]
+        group_starts = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]]) if len(children) else children
+        self.first_child[parents[group_starts]] = children[group_starts]
+        same_parent = parents[1:] == parents[:-1]
+        self.next_sibling[children[:-1][same_parent]] = children[1:][same_parent]
+
+        # pointer jumping: log(max depth) vectorised passes instead of walking every reply chain
+        self.root = np.where(self.parent >= 0, self.parent, np.arange(n, dtype=np.int64))
+        self.depth = (self.parent >= 0).astype(np.int64)
+        jump = self.parent.copy()
+        while True:
+            active = np.flatnonzero(jump >= 0)
+            if not len(active):
+                break
+            ancestors = jump[active]
+            self.depth[active] += self.depth[ancestors]
+            jump[active] = jump[ancestors]
+            self.root = self.root[self.root]
+        self.message_ids = ids
+
+    def __len__(self):
+        return len(self.parent)
+
+    def children(self, row):
+        child, result = self.first_child[row], []
+        while child >= 0:
+            result.append(int(child))
+            child = self.next_sibling[child]
+        return result
+
+    def subtree(self, row):
+        """Rows of `row` and all its replies, depth first (each reply right after the message it answers)."""
+        result, stack = [], [int(row)]
+        while stack:
+            node = stack.pop()
+            result.append(node)
+            child, kids = self.first_child[node], []
+            while child >= 0:
+                kids.append(int(child))
+                child = self.next_sibling[child]
+            stack.extend(reversed(kids))
+        return np.asarray(result, dtype=np.int64)
+
+    def thread_order(self, roots=None):
+        """Rows of the threads of `roots` (default: all threads, by first message) depth first, one thread after the other."""
+        roots = np.flatnonzero(self.parent < 0) if roots is None else roots
+        if not len(roots):
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([self.subtree(root) for root in roots])
+
+    def with_ancestors(self, rows):
+        """`rows` plus every message they (indirectly) reply to, in row order."""
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        keep = np.zeros(len(self.parent), dtype=bool)
+        while len(rows):
+            keep[rows] = True
+            rows = self.parent[rows]
+            rows = rows[(rows >= 0) & ~keep[np.maximum(rows, 0)]]
+        return np.flatnonzero(keep)
+
+    def thread_stats(self, table):
+        """One row per thread: its root row and message id, size, depth (longest reply chain), participants,
+        first/last message time, duration in seconds and total engagement.
+        """
+        columns = {"root": self.root, "depth": self.depth}
+        columns["sender"] = table['sender_id'].to_numpy() if 'sender_id' in table.columns else np.zeros(len(self))
+        columns["timestamp"] = table['timestamp'].to_numpy() if 'timestamp' in table.columns else np.full(len(self), -1)
+        columns["engagement"] = table['engagement'].to_numpy() if 'engagement' in table.columns else np.zeros(len(self))
+        grouped = pd.DataFrame(columns).groupby("root", sort=True)
+        stats = grouped.agg(size=("depth", "size"), depth=("depth", "max"), participants=("sender", "nunique"),
+                            start=("timestamp", "min"), end=("timestamp", "max"), engagement=("engagement", "sum"))
+        stats["duration"] = np.where(stats["start"] >= 0, stats["end"] - stats["start"], 0)
+        stats.insert(0, "thread_id", self.message_ids[stats.index.to_numpy()])
+        return stats.rename_axis("root_row").reset_index()
+
+    def top_threads(self, table, k=20, min_size=2):
+        """Most active threads first: ranked by replies times participants, then engagement."""
+        stats = self.thread_stats(table)
+        stats = stats[stats["size"] >= min_size]
+        stats = stats.assign(activity=(stats["size"] - 1) * stats["participants"])
+        return stats.sort_values(["activity", "engagement"], ascending=False).head(k).reset_index(drop=True)
@@ -0,0 +1,215 @@
+"""Structured tracing and metrics for pipeline stages.
+Spans are written as JSON lines to a trace file and aggregated into Prometheus text exposition metrics.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SPAN_COUNTERS = ("rows_in", "rows_out", "prompt_tokens", "completion_tokens", "llm_calls", "cache_hits", "coalesced", "bytes_read",
+                 "tokens_removed")
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id, attrs):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attrs = {k: v for k, v in attrs.items() if k not in SPAN_COUNTERS}
+        self.counters = Counter({k: v for k, v in attrs.items() if k in SPAN_COUNTERS})
+        self.start = time.time()
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, **counts):
+        self.counters.update(counts)
+
+    def to_dict(self):
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+                "start": self.start, "duration": self.duration, "attrs": self.attrs, **self.counters}
+
+
+class Tracer:
+    """Collects spans of pipeline stages (load, filter, retrieve, chunk, llm_map, sleep, reduce, ...).
+    Spans nest per thread; counters added with `Tracer.add` go to the innermost open span of the calling thread.
+    """
+    def __init__(self, trace_file=None):
+        self.trace_file = trace_file
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._seconds = defaultdict(float)
+        self._spans = Counter()
+        self._counters = defaultdict(Counter)
+        self._gauges = {}
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, name, **attrs):
+        parent = self.current()
+        span = Span(name, parent.trace_id if parent else uuid.uuid4().hex, parent.span_id if parent else None, attrs)
+        self._stack().append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=repr(e))
+            raise
+        finally:
+            self._stack().pop()
+            span.duration = time.time() - span.start
+            self._record(span)
+
+    def add(self, **counts):
+        """Adds counters (e.g. prompt_tokens, cache_hits) to the current span, or straight to the metrics if there is none."""
+        span = self.current()
+        if span is not None:
+            span.add(**counts)
+        else:
+            with self._lock:
+                self._counters[""].update(counts)
+
+    def stage_mean_seconds(self, stage):
+        """Mean duration of the finished spans of a stage, None before the first one."""
+        with self._lock:
+            return self._seconds[stage] / self._spans[stage] if self._spans.get(stage) else None
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def _record(self, span):
+        with self._lock:
+            self._seconds[span.name] += span.duration
+            self._spans[span.name] += 1
+            self._counters[span.name].update(span.counters)
+            if self.trace_file:
+                with open(self.trace_file, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+    def prometheus_text(self):
+        lines = ["# HELP telellmgram_stage_seconds_total Wall time spent in each pipeline stage.",
+                 "# TYPE telellmgram_stage_seconds_total counter"]
+        with self._lock:
+            for stage, seconds in sorted(self._seconds.items()):
+                lines.append(f'telellmgram_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}')
+            lines += ["# HELP telellmgram_stage_spans_total Number of finished spans per pipeline stage.",
+                      "# TYPE telellmgram_stage_spans_total counter"]
+            for stage, n in sorted(self._spans.items()):
+                lines.append(f'telellmgram_stage_spans_total{{stage="{stage}"}} {n}')
+            for counter in SPAN_COUNTERS:
+                lines += [f"# TYPE telellmgram_{counter}_total counter"]
+                for stage, counts in sorted(self._counters.items()):
+                    if counts.get(counter):
+                        lines.append(f'telellmgram_{counter}_total{{stage="{stage}"}} {counts[counter]}')
+            for name, value in sorted(self._gauges.items()):
+                lines += [f"# TYPE telellmgram_{name} gauge", f"telellmgram_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)  # scrapers never see a half written file
+
+    def serve_metrics(self, port=9464, host="127.0.0.1"):
+        """Serves `/metrics` from a daemon thread and returns the server."""
+        tracer = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = tracer.prometheus_text().encode()
+                self.send_response(200 if self.path.startswith("/metrics") else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+TRACER = Tracer()
+
+
+def traced_sleep(seconds, reason="rate_limit", cancel_event=None):
+    with TRACER.span("sleep", reason=reason, seconds=seconds):
+        if cancel_event is None:
+            time.sleep(seconds)
+        else:
+            cancel_event.wait(seconds)
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads every `interval` seconds and writes them as collapsed stacks
+    (one `frame;frame;frame count` line per stack), the input format of flamegraph tools.
+    """
+    def __init__(self, output_file, interval=0.01):
+        self.output_file = output_file
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        with open(self.output_file, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def profiled(mode, output_file):
+    """Profiles the enclosed block. `mode` is 'cprofile' (deterministic, pstats dump) or 'sampling' (collapsed stacks)."""
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output_file)
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    elif mode == "sampling":
+        with SamplingProfiler(output_file):
+            yield
+    else:
+        yield